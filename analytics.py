@@ -0,0 +1,281 @@
+"""
+Columnar event analytics.
+
+Events (from /api/log/pull replies, the device history with include=all, or an EventStore) are loaded into NumPy
+columns: utcTime, interned device and event type codes and interned codes of the parameters used for reports.
+Reports run as vectorised operations over these columns instead of Python loops over dicts.
+
+Requires NumPy.
+
+Example:
+    frame = EventFrame.from_store(store, since=time.time() - 30 * 86400)
+    doors = frame.select(event='SwitchStateChanged', state=True)
+    print(doors.bucket_counts(3600))
+    print(frame.pair_latency('CallStateChanged', {'state': 'ringing'}, {'state': 'connected'}, key='session'))
+"""
+
+import json
+from array import array
+
+import numpy as np
+
+PARAM_COLUMNS = ('state', 'session', 'uid', 'code', 'valid', 'port', 'switch', 'direction', 'key')
+
+MISSING = -1
+
+
+class _Interner(object):
+    """
+    Codes of names. Codes are keyed by type and value, so True and 1 (equal and of equal hash) stay apart.
+    """
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.codes = dict(((type(name), name), i) for i, name in enumerate(self.names))
+
+    def code(self, name):
+        key = (type(name), name)
+        code = self.codes.get(key)
+        if code is None:
+            code = self.codes[key] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def lookup(self, name):
+        return self.codes.get((type(name), name), MISSING - 1)
+
+    def labels(self):
+        """
+        :return: JSON texts of the names, usable as dict keys also when names like True and 1 are equal
+        """
+        return [json.dumps(name) for name in self.names]
+
+
+class EventFrame(object):
+    """
+    Column store of events. All columns are NumPy arrays of equal length:
+        utc: int64 utcTime
+        device: int32 device code (names in self.devices.names)
+        event: int16 event type code (names in self.events.names)
+        params[name]: int32 code of the parameter value (values in self.values[name].names), -1 if missing
+    """
+
+    def __init__(self, utc, device, event, params, devices, events, values):
+        self.utc = utc
+        self.device = device
+        self.event = event
+        self.params = params
+        self.devices = devices
+        self.events = events
+        self.values = values
+
+    def __len__(self):
+        return len(self.utc)
+
+    @classmethod
+    def from_events(cls, rows, param_columns=PARAM_COLUMNS):
+        """
+        :param rows: iterable of (device, event dict) tuples or of event dicts with a 'device' key
+        """
+        devices = _Interner()
+        events = _Interner()
+        values = dict((name, _Interner()) for name in param_columns)
+        utc = array('q')
+        device = array('i')
+        event = array('h')
+        params = dict((name, array('i')) for name in param_columns)
+
+        for row in rows:
+            if isinstance(row, tuple):
+                name, row = row
+            else:
+                name = row.get('device')
+            utc.append(int(row.get('utcTime', 0)))
+            device.append(devices.code(name))
+            event.append(events.code(row['event']))
+            row_params = row.get('params') or {}
+            for column in param_columns:
+                value = row_params.get(column)
+                params[column].append(MISSING if value is None else values[column].code(_hashable(value)))
+
+        return cls(np.frombuffer(utc, dtype=np.int64).copy(), np.frombuffer(device, dtype=np.int32).copy(),
+                   np.frombuffer(event, dtype=np.int16).copy(),
+                   dict((k, np.frombuffer(v, dtype=np.int32).copy()) for k, v in params.items()),
+                   devices, events, values)
+
+    @classmethod
+    def from_store(cls, store, param_columns=PARAM_COLUMNS, **query):
+        """
+        Loads events from an eventstore.EventStore, keyword arguments are passed to EventStore.query().
+        """
+        return cls.from_events(store.query(**query), param_columns)
+
+    @classmethod
+    def from_pull(cls, device, reply, param_columns=PARAM_COLUMNS):
+        """
+        Loads the events of a /api/log/pull reply (text or parsed dict), e.g. the 500 event device history
+        read through a subscription with include=all.
+        """
+        if isinstance(reply, (str, bytes)):
+            reply = json.loads(reply)
+        return cls.from_events(((device, e) for e in reply['result']['events']), param_columns)
+
+    # --- selection ---
+
+    def mask(self, event=None, device=None, since=None, until=None, **params):
+        selected = np.ones(len(self), dtype=bool)
+        if event is not None:
+            selected &= self.event == self.events.lookup(event)
+        if device is not None:
+            selected &= self.device == self.devices.lookup(device)
+        if since is not None:
+            selected &= self.utc >= since
+        if until is not None:
+            selected &= self.utc <= until
+        for name, value in params.items():
+            selected &= self.params[name] == self.values[name].lookup(_hashable(value))
+        return selected
+
+    def select(self, event=None, device=None, since=None, until=None, **params):
+        return self.take(self.mask(event, device, since, until, **params))
+
+    def take(self, selector):
+        return EventFrame(self.utc[selector], self.device[selector], self.event[selector],
+                          dict((k, v[selector]) for k, v in self.params.items()), self.devices, self.events,
+                          self.values)
+
+    # --- reports ---
+
+    def count_by(self, column='event'):
+        """
+        :param column: 'event', 'device' or a parameter column
+        :return: dict name -> count, for a parameter column the names are the JSON texts of the values ('true',
+        '1', '"in1"'), so that values like True and 1 get keys of their own
+        """
+        codes, labels = self._column(column)
+        present = codes[codes >= 0]
+        counts = np.bincount(present, minlength=len(labels))
+        return dict((labels[i], int(n)) for i, n in enumerate(counts) if n)
+
+    def bucket_counts(self, bucket=3600, by=None):
+        """
+        Counts events per time bucket (bucket size in seconds, aligned to the unix epoch).
+        :param by: optional 'event', 'device' or parameter column to split the counts
+        :return: {bucket start: count} or {bucket start: {name: count}} if by is given, names as in count_by
+        """
+        if not len(self):
+            return {}
+        buckets = self.utc // bucket
+        first = int(buckets.min())
+        index = buckets - first
+        if by is None:
+            counts = np.bincount(index)
+            return dict((int((first + i) * bucket), int(n)) for i, n in enumerate(counts) if n)
+
+        codes, labels = self._column(by)
+        valid = codes >= 0
+        width = len(labels)
+        if not width:
+            return {}
+        counts = np.bincount(index[valid] * width + codes[valid], minlength=(int(index.max()) + 1) * width)
+        counts = counts.reshape(-1, width)
+        result = {}
+        for row, col in zip(*np.nonzero(counts)):
+            result.setdefault(int((first + row) * bucket), {})[labels[col]] = int(counts[row, col])
+        return result
+
+    def hourly_profile(self):
+        """
+        :return: array of 24 counts by hour of day (UTC)
+        """
+        return np.bincount((self.utc // 3600) % 24, minlength=24)
+
+    def pair_latency(self, event, start, end, key=None, max_delay=None):
+        """
+        Pairs every start event with the next event of the same device (and key parameter) if that is an end
+        event and returns the delays, e.g. CallStateChanged ringing -> connected per session. A start followed by
+        another start (a missed call) is not paired, so every end is paired with one start at most.
+
+        :param event: event type of both ends
+        :param start: dict of parameters identifying the start event
+        :param end: dict of parameters identifying the end event
+        :param key: optional parameter column linking start and end (e.g. 'session')
+        :param max_delay: pairs with a longer delay are dropped
+        :return: dict with count, mean, p50, p90, max (seconds) and the raw delays array
+        """
+        starts = np.flatnonzero(self.mask(event, **start))
+        ends = np.flatnonzero(self.mask(event, **end))
+        group = self.device.astype(np.int64)
+        if key is not None:
+            group = group * (len(self.values[key].names) + 1) + (self.params[key] + 1)
+
+        # merge starts and ends sorted by (group, time), a start before an end at the same time, and pair the
+        # starts directly followed by an end of their group
+        rows = np.concatenate((starts, ends))
+        is_end = np.concatenate((np.zeros(len(starts), dtype=bool), np.ones(len(ends), dtype=bool)))
+        order = np.lexsort((is_end, self.utc[rows], group[rows]))
+        rows = rows[order]
+        is_end = is_end[order]
+        paired = ~is_end[:-1] & is_end[1:] & (group[rows[:-1]] == group[rows[1:]])
+        delays = self.utc[rows[1:][paired]] - self.utc[rows[:-1][paired]]
+        if max_delay is not None:
+            delays = delays[delays <= max_delay]
+        return summarize(delays)
+
+    def bursts(self, event, window=60, threshold=3, **params):
+        """
+        Finds bursts of at least threshold matching events per device within window seconds, e.g. keypad errors:
+        frame.bursts('CodeEntered', valid=False, window=30, threshold=3)
+
+        :return: list of (device name, burst start utc, number of events) sorted by start
+        """
+        selected = self.select(event, **params)
+        if not len(selected):
+            return []
+        order = np.lexsort((selected.utc, selected.device))
+        device = selected.device[order].astype(np.int64)
+        utc = selected.utc[order]
+        span = int(utc.max() - utc.min()) + window + 1
+        composite = device * span + (utc - utc.min())
+        counts = np.searchsorted(composite, composite + window, side='right') - np.arange(len(composite))
+        hits = np.nonzero(counts >= threshold)[0]
+        result = []
+        last_end = {}
+        for i in hits:
+            name = selected.devices.names[device[i]]
+            # report overlapping windows of one device once
+            if last_end.get(name, -1) >= utc[i]:
+                continue
+            last_end[name] = utc[i] + window
+            result.append((name, int(utc[i]), int(counts[i])))
+        return sorted(result, key=lambda r: r[1])
+
+    def _column(self, column):
+        """
+        :return: codes of the column and the report keys of the codes
+        """
+        if column == 'event':
+            return self.event.astype(np.int64), self.events.names
+        if column == 'device':
+            return self.device.astype(np.int64), self.devices.names
+        return self.params[column].astype(np.int64), self.values[column].labels()
+
+
+def summarize(delays):
+    delays = np.asarray(delays, dtype=np.float64)
+    if not len(delays):
+        return {'count': 0, 'mean': None, 'p50': None, 'p90': None, 'max': None, 'delays': delays}
+    return {
+        'count': int(len(delays)),
+        'mean': float(delays.mean()),
+        'p50': float(np.percentile(delays, 50)),
+        'p90': float(np.percentile(delays, 90)),
+        'max': float(delays.max()),
+        'delays': delays
+    }
+
+
+def _hashable(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
@@ -0,0 +1,390 @@
+"""
+Benchmark suite for the hot paths of CommandService, run against the local simulator (simulator.py).
+
+Every scenario runs in a fresh child process so that peak RSS is reported per scenario. Results are written as JSON
+and can be compared against an earlier run to catch regressions:
+
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json --threshold 0.1
+
+The comparison exits with status 1 if any metric got worse by more than the threshold.
+Metric names encode their direction: "*_per_s" is higher-is-better, "*_ms", "*_s" and "*_kb" are lower-is-better.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+SCENARIOS = ['small_calls', 'events', 'snapshots', 'transfers', 'fanout', 'tls_reconnect', 'cold_start']
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def latency_stats(name, samples, elapsed):
+    return {
+        name + '_per_s': len(samples) / elapsed,
+        name + '_p50_ms': percentile(samples, 0.5) * 1000,
+        name + '_p99_ms': percentile(samples, 0.99) * 1000
+    }
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def _cam(address, options):
+    from core import IPCam
+    return IPCam(address, auth_type=options['auth_type'], user='admin', password='2n')
+
+
+def bench_small_calls(addresses, options):
+    commands = _cam(addresses[0], options).commands
+    results = {}
+    for name, call in (('switch_status', lambda: commands.switch_status(1)),
+                       ('switch_control', lambda: commands.switch_control(1, 'trigger'))):
+        for _ in range(options['warmup']):
+            call()
+        samples = []
+        started = time.perf_counter()
+        for _ in range(options['iterations']):
+            t0 = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - t0)
+        results.update(latency_stats(name, samples, time.perf_counter() - started))
+    return results
+
+
+def bench_events(addresses, options):
+    import threading
+    from simulator import Simulator
+
+    # events are injected by a simulator owned by this process so that emit time and delivery time share a clock
+    sim = Simulator(base_port=options['port'] + 5000)
+    device = sim.add_device()
+    sim.start_in_thread()
+    try:
+        commands = _cam(device.address, dict(options, auth_type=0)).commands
+        sid = json.loads(commands.log_subscribe(duration=60))['result']['id']
+        sent = {}
+        samples = []
+        count = options['events']
+
+        def emitter():
+            for i in range(count):
+                time.sleep(0.002)
+                sent[i] = time.perf_counter()
+                device.emit('CardEntered', {'uid': str(i)})
+
+        thread = threading.Thread(target=emitter)
+        started = time.perf_counter()
+        thread.start()
+        while len(samples) < count:
+            events = json.loads(commands.log_pull(sid, timeout=5))['result']['events']
+            now = time.perf_counter()
+            if not events and not thread.is_alive():
+                break
+            for event in events:
+                samples.append(now - sent[int(event['params']['uid'])])
+        elapsed = time.perf_counter() - started
+        thread.join()
+        commands.log_unsubscribe(sid)
+    finally:
+        sim.stop()
+    return {
+        'events_per_s': len(samples) / elapsed,
+        'event_delivery_p50_ms': percentile(samples, 0.5) * 1000,
+        'event_delivery_p99_ms': percentile(samples, 0.99) * 1000
+    }
+
+
+def bench_snapshots(addresses, options):
+    commands = _cam(addresses[0], options).commands
+    workdir = tempfile.mkdtemp(prefix='2n-bench-')
+    filename = os.path.join(workdir, 'snapshot.jpg')
+    total = 0
+    started = time.perf_counter()
+    for _ in range(options['frames']):
+        commands.camera_snapshot(640, 480, filename)
+        total += os.path.getsize(filename)
+    elapsed = time.perf_counter() - started
+    os.unlink(filename)
+    os.rmdir(workdir)
+    return {'snapshot_frames_per_s': options['frames'] / elapsed, 'snapshot_bytes_per_s': total / elapsed}
+
+
+def bench_transfers(addresses, options):
+    commands = _cam(addresses[0], options).commands
+    workdir = tempfile.mkdtemp(prefix='2n-bench-')
+    config = os.path.join(workdir, 'config.xml')
+    firmware = os.path.join(workdir, 'firmware.bin')
+    results = {}
+
+    started = time.perf_counter()
+    total = 0
+    for _ in range(options['transfers']):
+        commands.config_get(config)
+        total += os.path.getsize(config)
+    results['config_download_bytes_per_s'] = total / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(options['transfers']):
+        commands.config_upload(config)
+    results['config_upload_bytes_per_s'] = total / (time.perf_counter() - started)
+
+    with open(firmware, 'wb') as f:
+        f.write(b'2.10.0.19.3\0'.ljust(64, b'\0'))
+        f.write(os.urandom(options['firmware_size']))
+    started = time.perf_counter()
+    commands.firmware_upload(firmware)
+    results['firmware_upload_bytes_per_s'] = os.path.getsize(firmware) / (time.perf_counter() - started)
+
+    for path in (config, firmware):
+        os.unlink(path)
+    os.rmdir(workdir)
+    return results
+
+
+def bench_fanout(addresses, options):
+    cams = [_cam(address, options) for address in addresses]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+        list(pool.map(lambda cam: cam.commands.system_status(), cams))
+    elapsed = time.perf_counter() - started
+    return {'fanout_devices': len(cams), 'fanout_total_s': elapsed, 'fanout_devices_per_s': len(cams) / elapsed}
+
+
+def bench_tls_reconnect(addresses, options):
+    import threading
+    import urllib3
+    from core import IPCam
+    from simulator import Simulator, make_ssl_context
+    from transport import PooledTransport, TLSSessionCache
+
+    # https devices owned by this process, the CPU time of the simulator thread stands in for the device load
+    urllib3.disable_warnings()
+    sim = Simulator(base_port=options['port'] + 6000, ssl_context=make_ssl_context())
+    devices = sim.add_devices(len(addresses))
+    sim.start_in_thread()
+    clock = time.pthread_getcpuclockid(sim._thread.ident)
+    results = {}
+    try:
+        for mode, cache in (('full', None), ('resumed', TLSSessionCache())):
+            pool = PooledTransport(hosts=len(devices), tls_sessions=cache)
+            cams = [IPCam(device.address, ssl=True, transport=pool) for device in devices]
+            lock = threading.Lock()
+            samples = []
+
+            def call(cam):
+                t0 = time.perf_counter()
+                cam.commands.system_status()
+                with lock:
+                    samples.append(time.perf_counter() - t0)
+
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                list(executor.map(call, cams))  # first contact, the sessions get cached
+                pool.close()  # fleet-wide reconnect: every connection is gone
+                del samples[:]
+                handshakes = sum(device.tls_handshakes for device in devices)
+                resumed = sum(device.tls_resumed for device in devices)
+                cpu = time.clock_gettime(clock)
+                started = time.perf_counter()
+                list(executor.map(call, cams))
+                elapsed = time.perf_counter() - started
+            cpu = time.clock_gettime(clock) - cpu
+            handshakes = sum(device.tls_handshakes for device in devices) - handshakes
+            resumed = sum(device.tls_resumed for device in devices) - resumed
+            pool.close()
+            results.update({
+                'tls_{0}_reconnect_s'.format(mode): elapsed,
+                'tls_{0}_connect_p50_ms'.format(mode): percentile(samples, 0.5) * 1000,
+                'tls_{0}_connect_p99_ms'.format(mode): percentile(samples, 0.99) * 1000,
+                'tls_{0}_device_cpu_ms'.format(mode): cpu * 1000,
+                'tls_{0}_resumptions'.format(mode): resumed,
+                'tls_{0}_handshakes'.format(mode): handshakes
+            })
+    finally:
+        sim.stop()
+    return results
+
+
+COLD_START = """
+import json, resource, sys, time
+started = time.perf_counter()
+from core import IPCam
+{imports}
+imported = time.perf_counter()
+ip_cam = IPCam({address!r}, auth_type={auth_type}, user='admin', password='2n', transport={transport})
+ip_cam.commands.switch_control(1, 'on')
+usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'import': imported - started, 'call': time.perf_counter() - imported, 'modules': len(sys.modules),
+                  'rss_kb': usage // 1024 if sys.platform == 'darwin' else usage}}))
+"""
+
+
+def bench_cold_start(addresses, options):
+    # a short-lived job toggling one switch, every run in a fresh interpreter
+    transports = {'requests': ('', 'None'),
+                  'httpclient': ('from httptransport import HTTPClientTransport', 'HTTPClientTransport()')}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, (imports, transport) in sorted(transports.items()):
+        code = COLD_START.format(imports=imports, address=addresses[0], auth_type=options['auth_type'],
+                                 transport=transport)
+        runs = []
+        for i in range(6):
+            started = time.perf_counter()
+            output = subprocess.check_output([sys.executable, '-c', code], cwd=directory)
+            if i:  # the first run only compiles the modules
+                runs.append(dict(json.loads(output.decode('utf-8')), total=time.perf_counter() - started))
+        results.update({
+            'cold_{0}_import_ms'.format(name): percentile([run['import'] for run in runs], 0.5) * 1000,
+            'cold_{0}_call_ms'.format(name): percentile([run['call'] for run in runs], 0.5) * 1000,
+            'cold_{0}_total_ms'.format(name): percentile([run['total'] for run in runs], 0.5) * 1000,
+            'cold_{0}_rss_kb'.format(name): max(run['rss_kb'] for run in runs),
+            'cold_{0}_modules'.format(name): runs[0]['modules']
+        })
+    return results
+
+
+def _child(name, addresses, options, conn):
+    try:
+        result = globals()['bench_' + name](addresses, options)
+        result['peak_rss_kb'] = peak_rss_kb()
+        conn.send(result)
+    except Exception as err:
+        conn.send({'error': repr(err)})
+    finally:
+        conn.close()
+
+
+def run(scenarios, options):
+    from simulator import DeviceProfile, Simulator
+
+    sim = Simulator(base_port=options['port'])
+    sim.add_devices(options['devices'], DeviceProfile(latency=options['latency'],
+                                                      auth_type=options['auth_type']))
+    sim.start_in_thread()
+    addresses = [device.address for device in sim.devices]
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    try:
+        for name in scenarios:
+            parent, child = context.Pipe(duplex=False)
+            process = context.Process(target=_child, args=(name, addresses, options, child))
+            process.start()
+            child.close()
+            results[name] = parent.recv()
+            process.join()
+            log.info("{name}: {result}".format(name=name, result=results[name]))
+    finally:
+        sim.stop()
+    return {'meta': metadata(options), 'results': results}
+
+
+def metadata(options):
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'revision': revision,
+        'options': options
+    }
+
+
+def compare(baseline, current, threshold):
+    """
+    Compares two result documents.
+    :return: list of (scenario, metric, old, new, relative change, regression flag)
+    """
+    rows = []
+    for scenario, metrics in sorted(current['results'].items()):
+        old_metrics = baseline['results'].get(scenario, {})
+        for metric, new in sorted(metrics.items()):
+            old = old_metrics.get(metric)
+            if not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (new - old) / float(old)
+            if metric.endswith('_per_s'):
+                regression = change < -threshold
+            elif metric.endswith(('_ms', '_s', '_kb')):
+                regression = change > threshold
+            else:
+                regression = False
+            rows.append((scenario, metric, old, new, change, regression))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CommandService benchmark suite')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare the results with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as regression')
+    parser.add_argument('--devices', type=int, default=200, help='simulated devices for the fan-out scenario')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--transfers', type=int, default=20)
+    parser.add_argument('--firmware-size', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated device latency in seconds')
+    parser.add_argument('--auth', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--port', type=int, default=23000)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario(s): ' + ', '.join(sorted(unknown)))
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    options = {
+        'devices': args.devices, 'concurrency': args.concurrency, 'iterations': args.iterations,
+        'warmup': max(1, args.iterations // 10), 'events': args.events, 'frames': args.frames,
+        'transfers': args.transfers, 'firmware_size': args.firmware_size, 'latency': args.latency,
+        'auth_type': args.auth, 'port': args.port
+    }
+    report = run(args.scenarios or SCENARIOS, options)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = 0
+        for scenario, metric, old, new, change, regression in compare(baseline, report, args.threshold):
+            regressions += regression
+            print('{flag} {scenario:12} {metric:32} {old:14.3f} {new:14.3f} {change:+7.1%}'.format(
+                flag='!' if regression else ' ', scenario=scenario, metric=metric, old=old, new=new, change=change))
+        if regressions:
+            print('{n} regression(s) above {t:.0%}'.format(n=regressions, t=args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
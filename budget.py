@@ -0,0 +1,223 @@
+"""
+Memory budget for the event pipeline.
+
+BufferedSink decouples an event consumer (any sink, see events.EventListener) from the listener threads with its own
+queue and delivery thread. All BufferedSinks sharing a MemoryBudget, together with the batches the EventListeners
+created with that budget are dispatching (the per-device buffers: a listener has no queue of its own, it holds one
+pulled batch until its sinks took it), keep at most `limit` bytes of events in memory. Each consumer may use an
+equal share of the limit. Once a consumer lags beyond its share (or the budget is exhausted), its further events are
+appended to its spill queue on disk (spill.SpillQueue) and replayed in order after the in-memory backlog has been
+delivered. Memory therefore stays bounded while a consumer is slow or down, and
+no events are dropped. lag() reports how far behind every consumer is.
+
+Event sizes are measured as the length of their compact JSON encoding.
+
+Not covered: the per-client socket buffers of fanout.FanoutServer, which max_buffer bounds on its own, and the
+worker processes of fleetrunner.FleetRunner, which would each need their own budget.
+
+Example:
+    budget = MemoryBudget(256 * 1024 * 1024)
+    audit = BufferedSink(WebhookSink('http://audit.local/events'), budget, '/var/lib/2n/spill/audit', name='audit')
+    rules = BufferedSink(RuleEngine(rules), budget, '/var/lib/2n/spill/rules', name='rules')
+    listeners = [EventListener(ip_cam, budget=budget) for ip_cam in ip_cams]
+    for listener in listeners:
+        listener.add_sink(audit)
+        listener.add_sink(rules)
+    ...
+    print(budget.lag())
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class MemoryBudget(object):
+    """
+    :param limit: bytes of queued events allowed in memory across all registered consumers and listener batches
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.in_flight = 0
+        self.consumers = []
+        self._lock = threading.Lock()
+
+    def register(self, consumer):
+        with self._lock:
+            self.consumers.append(consumer)
+
+    def unregister(self, consumer):
+        with self._lock:
+            self.consumers.remove(consumer)
+
+    @property
+    def share(self):
+        return self.limit // max(1, len(self.consumers))
+
+    def admit(self, held, size):
+        """
+        Reserves size bytes for a consumer currently holding `held` bytes.
+        :return: False if that would exceed the consumer's share or the budget
+        """
+        with self._lock:
+            if self.used + size > self.limit or held + size > self.share:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+    def charge(self, size):
+        """
+        Accounts a batch held by a listener while its sinks run. Always granted, the consumers spill earlier instead.
+        """
+        with self._lock:
+            self.used += size
+            self.in_flight += size
+
+    def discharge(self, size):
+        with self._lock:
+            self.used -= size
+            self.in_flight -= size
+
+    def lag(self):
+        """
+        :return: dict with the budget usage and lag() of every consumer
+        """
+        return {'limit': self.limit, 'used': self.used, 'in_flight': self.in_flight, 'share': self.share,
+                'consumers': [consumer.lag() for consumer in list(self.consumers)]}
+
+
+class _Device(object):
+    """
+    Stand-in passed to the sink for spilled events of devices not seen since a restart.
+    """
+
+    def __init__(self, ip_address):
+        self.ip_address = ip_address
+
+
+class BufferedSink(object):
+    """
+    :param sink: consumer, called as sink(ip_cam, events) from the delivery thread
+    :param budget: MemoryBudget shared with the other consumers
+    :param spill: spill queue directory of this consumer
+    :param name: label in lag metrics
+    """
+
+    def __init__(self, sink, budget, spill, name=None):
+        from spill import SpillQueue
+
+        self.sink = sink
+        self.budget = budget
+        self.name = name or repr(sink)
+        self.spill = SpillQueue(spill)
+        self.held = 0
+        self.delivered = 0
+        self.spilled = 0
+        self._queue = deque()  # (enqueue time, device, events, size)
+        self._devices = {}
+        first = self.spill.peek()
+        self._spilling = first is not None
+        self._spill_since = first[0] if first is not None else None  # time of the oldest spilled event
+        self._cond = threading.Condition()
+        self._closed = False
+        budget.register(self)
+        self._thread = threading.Thread(target=self._run, name='2n-buffer-{name}'.format(name=self.name),
+                                        daemon=True)
+        self._thread.start()
+
+    def __call__(self, ip_cam, events):
+        size = len(json.dumps(events, separators=(',', ':')))
+        now = time.time()
+        with self._cond:
+            self._devices[ip_cam.ip_address] = ip_cam
+            if not self._spilling and self.budget.admit(self.held, size):
+                self._queue.append((now, ip_cam.ip_address, events, size))
+                self.held += size
+            else:
+                if not self._spilling:
+                    log.warning("{name}: lagging, spilling events to disk".format(name=self.name))
+                    self._spilling = True
+                    self._spill_since = now
+                # older events are on disk, queueing in memory would overtake them
+                self.spill.append([now, ip_cam.ip_address, events])
+                self.spilled += len(events)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not (self._spilling and len(self.spill)) and not self._closed:
+                    self._cond.wait()
+                if self._queue:
+                    enqueued, device, events, size = self._queue.popleft()
+                    records = None
+                elif self._spilling and len(self.spill) and not self._closed:
+                    records = self.spill.peek_many(1000, weight=lambda record: len(record[2]))
+                    if not records:
+                        self._spilling = False
+                        self._spill_since = None
+                        continue
+                else:
+                    return
+
+            if records is None:
+                self._deliver(device, events)
+                with self._cond:
+                    self.held -= size
+                self.budget.release(size)
+                continue
+
+            for _, device, events in records:
+                self._deliver(device, events)
+            with self._cond:
+                self.spill.commit()
+                following = self.spill.peek()
+                if following is None:
+                    # drained, new events go to memory again
+                    self._spilling = False
+                    self._spill_since = None
+                    log.info("{name}: caught up with the spilled events".format(name=self.name))
+                else:
+                    self._spill_since = following[0]
+
+    def _deliver(self, device, events):
+        ip_cam = self._devices.get(device) or _Device(device)
+        try:
+            self.sink(ip_cam, events)
+        except Exception as err:
+            log.exception("{name}: sink failed for {ip}: {err}".format(name=self.name, ip=device, err=err))
+        self.delivered += len(events)
+
+    def lag(self):
+        """
+        :return: dict with queued events and bytes in memory, spilled bytes on disk and the age in seconds of the
+        oldest event not yet delivered
+        """
+        with self._cond:
+            oldest = self._queue[0][0] if self._queue else None
+            if self._spill_since is not None:
+                oldest = min(oldest or self._spill_since, self._spill_since)
+            return {'name': self.name, 'queued_events': sum(len(item[2]) for item in self._queue),
+                    'queued_bytes': self.held, 'spilled_bytes': len(self.spill), 'spilled_events': self.spilled,
+                    'delivered_events': self.delivered, 'lag_s': time.time() - oldest if oldest else 0.0}
+
+    def close(self, timeout=30):
+        """
+        Delivers the in-memory backlog (up to timeout seconds); spilled events stay on disk for the next start.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self.budget.unregister(self)
+        self.spill.close()
@@ -0,0 +1,372 @@
+"""
+Record/replay transports for CommandService.
+
+RecordingTransport sits between CommandService and the real transport and writes every request/response exchange
+to a cassette file. ReplayTransport serves the recorded responses again without any network I/O, either as fast as
+possible or with the recorded timing.
+
+Example:
+    recorder = RecordingTransport('/tmp/lobby.cassette')
+    ip_cam = IPCam('192.168.0.2', auth_type=2, user='admin', password='secret', transport=recorder)
+    ...
+    recorder.close()
+
+    ip_cam = IPCam('192.168.0.2', auth_type=2, transport=ReplayTransport('/tmp/lobby.cassette', timing='recorded'))
+
+Cassette layout: the magic bytes followed by records. Every record is a 4 byte big-endian length and a JSON
+header (method, url, request key, status, headers, timings), followed by the body as length-prefixed chunks
+terminated by an empty chunk. Credentials and request bodies are not stored, only a key identifying the request
+parameters.
+"""
+
+import datetime
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlencode, urlsplit
+
+MAGIC = b'2NCASS\x00\x01'
+_LENGTH = struct.Struct('>I')
+
+
+class CassetteError(Exception):
+    pass
+
+
+class CassetteMiss(CassetteError):
+    """
+    Raised on replay if the cassette holds no (more) responses for a request.
+    """
+    pass
+
+
+def request_key(method, url, data=None, files=None):
+    parts = urlsplit(url)
+    key = [method.upper(), parts.netloc, parts.path]
+    params = []
+    if parts.query:
+        params.append(parts.query)
+    if isinstance(data, dict):
+        items = []
+        for name, value in sorted(data.items()):
+            if isinstance(value, (list, tuple)):
+                items.extend((name, v) for v in value)
+            else:
+                items.append((name, value))
+        params.append(urlencode(items))
+    elif data:
+        params.append(data if isinstance(data, str) else repr(len(data)))
+    if files:
+        for name, spec in sorted(files.items()):
+            params.append('{name}={file}'.format(name=name, file=spec[0] if isinstance(spec, tuple) else ''))
+    key.append('&'.join(params))
+    return ' '.join(key)
+
+
+class _Headers(dict):
+    """
+    Minimal case-insensitive header mapping (keys are stored lower-case).
+    """
+
+    def __init__(self, items=()):
+        super(_Headers, self).__init__((k.lower(), v) for k, v in items)
+
+    def __getitem__(self, key):
+        return super(_Headers, self).__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super(_Headers, self).__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super(_Headers, self).get(key.lower(), default)
+
+
+class CassetteResponse(object):
+    """
+    Replayed response providing the parts of the requests.Response interface used by CommandService.
+    The body is kept as a view into the memory-mapped cassette, content and iter_content copy it out.
+    """
+
+    def __init__(self, record, body, pace=None):
+        self.status_code = record['status']
+        self.reason = record.get('reason', '')
+        self.url = record['url']
+        self.headers = _Headers(record['headers'])
+        self.elapsed = datetime.timedelta(seconds=record['ttfb'])
+        self.history = []
+        self.encoding = None
+        self._body = body
+        self._pace = pace
+
+    @property
+    def content(self):
+        return bytes(self._body)
+
+    @property
+    def text(self):
+        charset = 'utf-8'
+        content_type = self.headers.get('content-type', '')
+        if 'charset=' in content_type:
+            charset = content_type.split('charset=', 1)[1].split(';')[0].strip()
+        return self.content.decode(charset, 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1024, decode_unicode=False):
+        body = self._body
+        chunk_size = chunk_size or len(body) or 1
+        delay = self._pace * chunk_size / len(body) if self._pace and len(body) else 0
+        for offset in range(0, len(body), chunk_size):
+            if delay:
+                time.sleep(delay)
+            yield bytes(body[offset:offset + chunk_size])
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            from httptransport import HTTPError
+            raise HTTPError('{code} Error: {reason} for url: {url}'.format(
+                code=self.status_code, reason=self.reason, url=self.url), response=self)
+
+    def close(self):
+        pass
+
+
+class _RecordedStream(object):
+    """
+    Proxy around a streamed requests.Response which tees the body into the cassette while it is consumed.
+    """
+
+    def __init__(self, recorder, record, response):
+        self._recorder = recorder
+        self._record = record
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    @property
+    def content(self):
+        if not self._response._content_consumed:
+            # hand the body back to the real response so that text/json keep working
+            self._response._content = b''.join(self.iter_content(64 * 1024))
+            self._response._content_consumed = True
+        return self._response.content
+
+    @property
+    def text(self):
+        self.content
+        return self._response.text
+
+    def iter_content(self, chunk_size=1024, decode_unicode=False):
+        spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        started = time.perf_counter()
+        try:
+            for chunk in self._response.iter_content(chunk_size=chunk_size):
+                spool.write(chunk)
+                yield chunk
+        finally:
+            self._record['body_time'] = time.perf_counter() - started
+            spool.seek(0)
+            self._recorder.write(self._record, spool)
+            spool.close()
+
+
+class RecordingTransport(object):
+    """
+    Transport recording all exchanges into a cassette file while forwarding them to the wrapped transport.
+
+    :param path: cassette file, created or truncated
+    :param transport: real transport, defaults to the requests module
+    """
+
+    def __init__(self, path, transport=None):
+        if transport is None:
+            import requests
+            transport = requests
+        self.transport = transport
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        if hasattr(transport, 'make_auth'):
+            self.make_auth = transport.make_auth
+
+    def request(self, method, url, **kwargs):
+        offset = time.perf_counter() - self._started
+        response = self.transport.request(method, url, **kwargs)
+        record = {
+            'method': method.upper(),
+            'url': url,
+            'key': request_key(method, url, kwargs.get('data'), kwargs.get('files')),
+            'offset': offset,
+            'ttfb': response.elapsed.total_seconds(),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': sorted(response.headers.items())
+        }
+        if kwargs.get('stream'):
+            return _RecordedStream(self, record, response)
+
+        started = time.perf_counter()
+        body = response.content
+        record['body_time'] = time.perf_counter() - started
+        self.write(record, body)
+        return response
+
+    def write(self, record, body):
+        header = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            write = self._file.write
+            write(_LENGTH.pack(len(header)))
+            write(header)
+            if isinstance(body, (bytes, bytearray)):
+                if body:
+                    write(_LENGTH.pack(len(body)))
+                    write(body)
+            else:
+                while True:
+                    chunk = body.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    write(_LENGTH.pack(len(chunk)))
+                    write(chunk)
+            write(_LENGTH.pack(0))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_cassette(path):
+    """
+    Memory-maps a cassette.
+    :return: (mmap, list of (record, body memoryview))
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            raise CassetteError("{path} is not a cassette".format(path=path))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise CassetteError("{path} is not a cassette".format(path=path))
+
+    def truncated(pos):
+        return CassetteError("{path} is truncated or corrupted at offset {pos}".format(path=path, pos=pos))
+
+    records = []
+    pos = len(MAGIC)
+    while pos < size:
+        if pos + 4 > size:
+            raise truncated(pos)
+        (length,) = _LENGTH.unpack_from(data, pos)
+        pos += 4
+        if pos + length > size:
+            raise truncated(pos)
+        try:
+            record = json.loads(bytes(view[pos:pos + length]).decode('utf-8'))
+        except ValueError:
+            raise truncated(pos)
+        pos += length
+        chunks = []
+        while True:
+            if pos + 4 > size:
+                raise truncated(pos)
+            (length,) = _LENGTH.unpack_from(data, pos)
+            pos += 4
+            if not length:
+                break
+            if pos + length > size:
+                raise truncated(pos)
+            chunks.append((pos, length))
+            pos += length
+        if len(chunks) == 1:
+            body = view[chunks[0][0]:chunks[0][0] + chunks[0][1]]
+        elif chunks:
+            body = memoryview(b''.join(view[start:start + length] for start, length in chunks))
+        else:
+            body = view[0:0]
+        records.append((record, body))
+    return data, records
+
+
+class ReplayTransport(object):
+    """
+    Transport answering requests from a cassette. Responses are matched by request (method, device, path and
+    parameters) in recorded order, so concurrent consumers replay consistently.
+
+    :param path: cassette file
+    :param timing: 'fast' replays immediately, 'recorded' reproduces request offsets, header latency and body
+    transfer time
+    :param speed: time scale for 'recorded' timing (2.0 replays twice as fast)
+    :param loop: start over for a request once its recorded responses are used up instead of raising CassetteMiss
+    """
+
+    def __init__(self, path, timing='fast', speed=1.0, loop=False):
+        if timing not in ('fast', 'recorded'):
+            raise ValueError("Unknown replay timing {timing}".format(timing=timing))
+        self.timing = timing
+        self.speed = float(speed)
+        self.loop = loop
+        self._mmap, self.records = read_cassette(path)
+        self._queues = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._started = None
+        self.rewind()
+
+    def rewind(self):
+        with self._lock:
+            self._queues.clear()
+            for record, body in self.records:
+                self._queues[record['key']].append((record, body))
+            self._started = None
+
+    def make_auth(self, auth_type, user, password):
+        """
+        Authentication object for IPCam.auth_type, used by CommandService. Credentials are not recorded and replayed
+        requests need none, so there is nothing to authenticate with.
+        """
+        return None
+
+    def request(self, method, url, **kwargs):
+        key = request_key(method, url, kwargs.get('data'), kwargs.get('files'))
+        with self._lock:
+            if self._started is None:
+                self._started = time.perf_counter()
+            queue = self._queues.get(key)
+            if not queue:
+                raise CassetteMiss("No recorded response for {key}".format(key=key))
+            record, body = queue.popleft()
+            if self.loop:
+                queue.append((record, body))
+
+        pace = None
+        if self.timing == 'recorded':
+            wait = self._started + record['offset'] / self.speed - time.perf_counter()
+            time.sleep(max(0.0, wait) + record['ttfb'] / self.speed)
+            pace = record.get('body_time', 0) / self.speed
+            if not kwargs.get('stream') and pace:
+                time.sleep(pace)
+                pace = None
+        return CassetteResponse(record, body, pace)
+
+    def close(self):
+        with self._lock:
+            for record, body in self.records:
+                body.release()
+            self.records = []
+            self._queues.clear()
+        self._mmap.close()
@@ -0,0 +1,165 @@
+"""
+Device clock offset and drift estimation.
+
+Event utcTime values and the snapshot time parameter use the device's clock. ClockSync estimates, per device, the
+offset of that clock against the local clock and its drift from system_status samples, so device timestamps can be
+put on the local timeline (and local times converted for the device) with plain arithmetic, without a request per
+event.
+
+Each sample bounds the offset: the device read its clock somewhere between sending and receiving the request, and
+systemTime is truncated to whole seconds, so offset lies in [systemTime - received, systemTime + 1 - sent]. Like NTP's
+clock filter only the samples with the lowest round-trip times are used. The drift is a least-squares fit over the
+sample window, and the offset is the centre of the intersection of the drift-corrected bounds, which narrows well
+below one second as samples hit different phases of the device's second. If the bounds contradict each other the
+device clock was stepped (NTP, manual change) and the estimate restarts from the newest samples.
+
+Samples come from sample(), or for free from the health monitor:
+    clock = ClockSync()
+    monitor.add_probe_handler(clock.observe)
+    ...
+    local = clock.to_local(ip_cam.ip_address, event['utcTime'])
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class ClockEstimate(object):
+    """
+    offset(t) = offset + drift * (t - reference), t and reference in local time, offset in device minus local seconds.
+    """
+
+    __slots__ = ('offset', 'drift', 'reference', 'error', 'samples', 'updated')
+
+    def __init__(self, offset, drift, reference, error, samples, updated):
+        self.offset = offset
+        self.drift = drift
+        self.reference = reference
+        self.error = error
+        self.samples = samples
+        self.updated = updated
+
+    def to_device(self, local_time):
+        return local_time + self.offset + self.drift * (local_time - self.reference)
+
+    def to_local(self, device_time):
+        return (device_time - self.offset + self.drift * self.reference) / (1.0 + self.drift)
+
+    def as_dict(self):
+        return {'offset_s': self.offset, 'drift_ppm': self.drift * 1e6, 'error_s': self.error,
+                'samples': self.samples, 'updated': self.updated}
+
+
+class ClockSync(object):
+    """
+    :param window: samples kept per device
+    :param best: fraction of the samples with the lowest RTT used for the estimate
+    :param min_span: seconds the samples must span before a drift is estimated
+    :param step: seconds a new sample may be off the estimate before the device clock is considered stepped
+    """
+
+    def __init__(self, window=64, best=0.5, min_span=600, step=1.0):
+        self.window = window
+        self.best = best
+        self.min_span = min_span
+        self.step = step
+        self.estimates = {}
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, ip_cam, sent, received, result):
+        """
+        Adds a system_status sample. Signature of a health.HealthMonitor probe handler.
+
+        :param sent, received: time.time() before sending the request and after receiving the reply
+        :param result: the result dict of the system_status reply
+        """
+        system_time = result.get('systemTime')
+        if system_time is None:
+            return
+        address = ip_cam.ip_address
+        sample = ((sent + received) / 2, system_time - received, system_time + 1 - sent, received - sent)
+        with self._lock:
+            samples = self._samples.setdefault(address, deque(maxlen=self.window))
+            samples.append(sample)
+            self.estimates[address] = self._estimate(address, samples)
+
+    def sample(self, ip_cam, count=8):
+        """
+        Takes count system_status samples at different phases of the device's second.
+        :return: ClockEstimate
+        """
+        for i in range(count):
+            sent = time.time()
+            reply = json.loads(ip_cam.commands.system_status())
+            received = time.time()
+            if reply.get('success'):
+                self.observe(ip_cam, sent, received, reply['result'])
+            if i + 1 < count:
+                time.sleep(random.uniform(0.05, 0.35))
+        return self.estimates.get(ip_cam.ip_address)
+
+    def _estimate(self, address, samples):
+        ordered = sorted(samples, key=lambda s: s[3])
+        chosen = ordered[:max(1, int(len(ordered) * self.best))]
+        reference = samples[-1][0]
+
+        drift = 0.0
+        span = max(s[0] for s in chosen) - min(s[0] for s in chosen)
+        if span >= self.min_span and len(chosen) >= 4:
+            # least squares of the bound centres over time, weighted by the inverse bound width
+            weights = [1.0 / (s[2] - s[1]) ** 2 for s in chosen]
+            total = sum(weights)
+            mean_t = sum(w * s[0] for w, s in zip(weights, chosen)) / total
+            mean_o = sum(w * (s[1] + s[2]) / 2 for w, s in zip(weights, chosen)) / total
+            var = sum(w * (s[0] - mean_t) ** 2 for w, s in zip(weights, chosen))
+            if var > 0:
+                drift = sum(w * (s[0] - mean_t) * ((s[1] + s[2]) / 2 - mean_o) for w, s in zip(weights, chosen)) / var
+
+        lo = max(s[1] - drift * (s[0] - reference) for s in chosen)
+        hi = min(s[2] - drift * (s[0] - reference) for s in chosen)
+        latest = samples[-1]
+        if len(samples) > 1 and (latest[1] - hi > self.step or lo - latest[2] > self.step):
+            log.info("{address}: device clock stepped, restarting the estimate".format(address=address))
+            samples.clear()
+            samples.append(latest)
+            lo, hi, drift = latest[1], latest[2], 0.0
+        # lo > hi: bounds slightly inconsistent (asymmetric RTT), the centre of the gap is used
+        return ClockEstimate((lo + hi) / 2, drift, reference, abs(hi - lo) / 2, len(samples), latest[0])
+
+    def estimate(self, address):
+        """
+        :return: ClockEstimate of the device, None before the first sample
+        """
+        return self.estimates.get(address)
+
+    def to_local(self, address, device_time):
+        """
+        Converts a device timestamp (e.g. an event's utcTime) to local time; unchanged for unknown devices.
+        """
+        estimate = self.estimates.get(address)
+        return device_time if estimate is None else estimate.to_local(device_time)
+
+    def to_device(self, address, local_time):
+        """
+        Converts a local time to the device clock, e.g. for the time parameter of camera_snapshot.
+        """
+        estimate = self.estimates.get(address)
+        return local_time if estimate is None else estimate.to_device(local_time)
+
+    def align(self, ip_cam, events):
+        """
+        Adds 'localTime' to the events (in place) and returns them. Can be used in a sink chain.
+        """
+        estimate = self.estimates.get(ip_cam.ip_address)
+        for event in events:
+            utc = event.get('utcTime')
+            if utc is not None:
+                event['localTime'] = utc if estimate is None else estimate.to_local(utc)
+        return events
@@ -1,9 +1,9 @@
 import json
 import logging
 import os
-import requests
 from urllib.parse import urljoin
-from requests.auth import HTTPBasicAuth, HTTPDigestAuth
+from jsonstream import iter_event_batches, iter_events
+from tracing import Span, dispatch
 
 ns = {
     'event2n': 'http://www.2n.cz/2013/event',
@@ -17,18 +17,142 @@ class CommandService(object):
     def __init__(self, ip_cam):
         self.ip_cam = ip_cam
 
-        self.auth = None
-
-        if self.ip_cam.auth_type == 1:
-            self.auth = HTTPBasicAuth(self.ip_cam.user, self.ip_cam.password)
-        if self.ip_cam.auth_type == 2:
-            self.auth = HTTPDigestAuth(self.ip_cam.user, self.ip_cam.password)
-
         schema = 'http'
         if self.ip_cam.ssl:
             schema = 'https'
         self.base_url = "{schema}://{ip}".format(schema=schema, ip=self.ip_cam.ip_address)
 
+        # anything with a requests-compatible request(method, url, **kwargs), e.g. a requests.Session, one of the
+        # cassette transports or httptransport.HTTPClientTransport; requests is only imported when it is used
+        self.transport = getattr(self.ip_cam, 'transport', None)
+        if self.transport is None:
+            import requests
+            self.transport = requests
+        self.auth = self._make_auth()
+        self.hooks = []
+
+    def _make_auth(self):
+        if self.ip_cam.auth_type not in (1, 2):
+            return None
+        make_auth = getattr(self.transport, 'make_auth', None)
+        if make_auth is not None:
+            return make_auth(self.ip_cam.auth_type, self.ip_cam.user, self.ip_cam.password)
+
+        from requests.auth import HTTPBasicAuth, HTTPDigestAuth
+        if self.ip_cam.auth_type == 1:
+            return HTTPBasicAuth(self.ip_cam.user, self.ip_cam.password)
+        return HTTPDigestAuth(self.ip_cam.user, self.ip_cam.password)
+
+    def add_hook(self, hook):
+        """
+        Registers a trace hook (see tracing.TraceHook) which is called before every request, after the response
+        headers and body arrived and on errors. Without registered hooks requests are not instrumented at all.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _request(self, method, path, **kwargs):
+        if not self.hooks:
+            response = self.transport.request(method, urljoin(self.base_url, path), auth=self.auth, verify=False,
+                                              **kwargs)
+            response.raise_for_status()
+            return response
+
+        hooks = list(self.hooks)
+        span = Span(self.ip_cam.ip_address, method, path)
+        stream = kwargs.pop('stream', False)
+        dispatch(hooks, 'before_request', span)
+
+        response = None
+        try:
+            response = self.transport.request(method, urljoin(self.base_url, path), auth=self.auth, verify=False,
+                                              stream=True, **kwargs)
+            headers_time = span.phase('headers')
+            # the digest handshake is hidden inside the transport, the 401 responses are kept in the history
+            challenge = sum(r.elapsed.total_seconds() for r in response.history)
+            if challenge:
+                span.phases['challenge'] = min(challenge, headers_time)
+                span.phases['headers'] = headers_time - span.phases['challenge']
+            span.status = response.status_code
+            dispatch(hooks, 'after_headers', span)
+            response.raise_for_status()
+
+            if stream:
+                # the body is consumed by _download, which closes the span
+                response.trace = (hooks, span)
+                return response
+
+            span.bytes = len(response.content)
+            span.phase('body')
+        except Exception as err:
+            span.phase('error')
+            span.error = str(err)
+            dispatch(hooks, 'on_error', span, err)
+            if response is not None:
+                # the response is streamed, give its connection back to the pool
+                response.close()
+            raise
+
+        dispatch(hooks, 'after_body', span)
+        return response
+
+    def _json_reply(self, response, error=None):
+        """
+        Reads the JSON reply a device sent instead of a streamed body and closes the span of a traced response.
+
+        :param error: message of the IOError raised with the reply ({reply}), None to return the reply
+        """
+        text = response.text
+        err = None if error is None else IOError(error.format(reply=text))
+        trace = getattr(response, 'trace', None)
+        if trace is not None:
+            hooks, span = trace
+            span.bytes = len(response.content)
+            span.phase('body')
+            if err is None:
+                dispatch(hooks, 'after_body', span)
+            else:
+                span.error = str(err)
+                dispatch(hooks, 'on_error', span, err)
+        if err is not None:
+            raise err
+        return text
+
+    def _download(self, response, filename):
+        if response.headers['Content-Type'] == 'application/json':
+            return self._json_reply(response)
+
+        with open(filename, 'wb') as f:
+            for chunk in self._stream(response, 1024):
+                f.write(chunk)
+
+        return json.dumps({'success': True})
+
+    def _stream(self, response, chunk_size):
+        trace = getattr(response, 'trace', None)
+        if trace is None:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:  # filter out keep-alive new chunks
+                    yield chunk
+            return
+
+        hooks, span = trace
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    span.bytes += len(chunk)
+                    yield chunk
+        except (Exception, GeneratorExit) as err:
+            # GeneratorExit: the consumer stopped reading before the end of the body
+            span.phase('body')
+            span.error = str(err) or type(err).__name__
+            dispatch(hooks, 'on_error', span, err)
+            raise
+        span.phase('body')
+        dispatch(hooks, 'after_body', span)
+
     def system_info(self):
         """
         The /api/system/info function provides basic information on the device: type, serial
@@ -58,8 +182,7 @@ class CommandService(object):
         deviceName: Device name set in the configuration interface on the Services / Web Server tab
 
         """
-        response = requests.get(urljoin(self.base_url, "/api/system/info"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('GET', "/api/system/info")
         return response.text
 
     def system_status(self):
@@ -86,8 +209,7 @@ class CommandService(object):
         upTime: Device operation time since the last restart in seconds
         """
 
-        response = requests.get(urljoin(self.base_url, "/api/system/status"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('GET', "/api/system/status")
         return response.text
 
     def system_restart(self):
@@ -108,8 +230,7 @@ class CommandService(object):
 
         """
 
-        response = requests.get(urljoin(self.base_url, "/api/system/restart"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('GET', "/api/system/restart")
         return response.text
 
     def firmware_upload(self, filename):
@@ -141,10 +262,9 @@ class CommandService(object):
         returns error code 12 – invalid parameter value.
         """
 
-        response = requests.put(urljoin(self.base_url, "/api/firmware"), auth=self.auth, verify=False,
-                                files={'blob-fw': (
-                                    os.path.basename(filename), open(filename, 'rb'), 'application/octet-stream')})
-        response.raise_for_status()
+        response = self._request('PUT', "/api/firmware",
+                                 files={'blob-fw': (
+                                     os.path.basename(filename), open(filename, 'rb'), 'application/octet-stream')})
         return response.text
 
     def firmware_apply(self):
@@ -164,8 +284,7 @@ class CommandService(object):
             "success" : true
         }
         """
-        response = requests.get(urljoin(self.base_url, "/api/firmware/apply"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('GET', "/api/firmware/apply")
         return response.text
 
     def config_get(self, filename=None):
@@ -192,20 +311,21 @@ class CommandService(object):
             if not os.access(save_dir, os.W_OK):
                 raise IOError("No write permissions to {dir}.".format(dir=save_dir))
 
-            response = requests.get(urljoin(self.base_url, "/api/config"), auth=self.auth, verify=False, stream=True)
-            response.raise_for_status()
-
-            if response.headers['Content-Type'] == 'application/json':
-                return response.text
+            response = self._request('GET', "/api/config", stream=True)
+            return self._download(response, filename)
 
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
+        raise ValueError("Parameter filename cannot be empty or None")
 
-            return json.dumps({'success': True})
+    def config_data(self):
+        """
+        Same as config_get, but the configuration XML is returned as bytes instead of being saved to a file.
 
-        raise ValueError("Parameter filename cannot be empty or None")
+        :raise IOError: the device replied with an error instead of the configuration
+        """
+        response = self._request('GET', "/api/config", stream=True)
+        if response.headers['Content-Type'] == 'application/json':
+            self._json_reply(response, "Config download failed: {reply}")
+        return b''.join(self._stream(response, 64 * 1024))
 
     def config_upload(self, filename):
         """
@@ -215,7 +335,7 @@ class CommandService(object):
         Control privilege for authentication if required . The function is available with the
         Enhanced Integration licence key only.
 
-        :type filename: config file to upload (xml)
+        :type filename: config file to upload (xml), or the configuration itself as bytes
         :return: The reply is in the application/json format and includes no other parameters.
 
         Example:
@@ -224,10 +344,14 @@ class CommandService(object):
             "success" : true
         }
         """
-        response = requests.put(urljoin(self.base_url, "/api/config"), auth=self.auth, verify=False,
-                                files={'blob-cfg': (
-                                    os.path.basename(filename), open(filename, 'rb'), 'application/octet-stream')})
-        response.raise_for_status()
+        if isinstance(filename, (bytes, bytearray, memoryview)):
+            response = self._request('PUT', "/api/config",
+                                     files={'blob-cfg': ('config.xml', filename, 'application/octet-stream')})
+            return response.text
+
+        with open(filename, 'rb') as f:
+            response = self._request('PUT', "/api/config",
+                                     files={'blob-cfg': (os.path.basename(filename), f, 'application/octet-stream')})
         return response.text
 
     def factory_reset(self):
@@ -247,8 +371,7 @@ class CommandService(object):
             "success" : true
         }
         """
-        response = requests.get(urljoin(self.base_url, "/api/config/factoryreset"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('GET', "/api/config/factoryreset")
         return response.text
 
     def switch_caps(self):
@@ -303,8 +426,7 @@ class CommandService(object):
         type: Switch type ( normal , security )
 
         """
-        response = requests.get(urljoin(self.base_url, "/api/switch/caps"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('GET', "/api/switch/caps")
         return response.text
 
     def switch_status(self, switch=None):
@@ -350,8 +472,7 @@ class CommandService(object):
         if switch is not None and switch > 0:
             data = {'switch': switch}
 
-        response = requests.post(urljoin(self.base_url, "/api/switch/status"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/switch/status", data=data)
         return response.text
 
     def switch_control(self, switch, action, response=None):
@@ -392,8 +513,7 @@ class CommandService(object):
                 'action': action
             }
 
-        response = requests.post(urljoin(self.base_url, "/api/switch/ctrl"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/switch/ctrl", data=data)
         return response.text
 
     def io_caps(self, port=None):
@@ -439,8 +559,7 @@ class CommandService(object):
                 'port': port
             }
 
-        response = requests.post(urljoin(self.base_url, "/api/io/caps"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/io/caps", data=data)
         return response.text
 
     def io_status(self, port=None):
@@ -483,8 +602,7 @@ class CommandService(object):
                 'port': port
             }
 
-        response = requests.post(urljoin(self.base_url, "/api/io/status"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/io/status", data=data)
         return response.text
 
     def io_control(self, port, action, response=None):
@@ -525,8 +643,7 @@ class CommandService(object):
                 'action': action
             }
 
-        response = requests.post(urljoin(self.base_url, "/api/io/ctrl"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/io/ctrl", data=data)
         return response.text
 
     def phone_status(self, account=None):
@@ -576,8 +693,7 @@ class CommandService(object):
                 'account': account
             }
 
-        response = requests.post(urljoin(self.base_url, "/api/phone/status"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/phone/status", data=data)
         return response.text
 
     def call_status(self, session=None):
@@ -621,8 +737,7 @@ class CommandService(object):
                 'session': session
             }
 
-        response = requests.post(urljoin(self.base_url, "/api/call/status"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/call/status", data=data)
         return response.text
 
     def call_dial(self, number):
@@ -656,8 +771,7 @@ class CommandService(object):
             'number': number
         }
 
-        response = requests.post(urljoin(self.base_url, "/api/call/dial"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/call/dial", data=data)
         return response.text
 
     def call_answer(self, session):
@@ -683,8 +797,7 @@ class CommandService(object):
             'session': session
         }
 
-        response = requests.post(urljoin(self.base_url, "/api/call/answer"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/call/answer", data=data)
         return response.text
 
     def call_hangup(self, session, reason=None):
@@ -718,8 +831,7 @@ class CommandService(object):
                 'session': session
             }
 
-        response = requests.post(urljoin(self.base_url, "/api/call/hangup"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/call/hangup", data=data)
         return response.text
 
     def camera_caps(self):
@@ -779,8 +891,7 @@ class CommandService(object):
         source: Video source identifier
         """
 
-        response = requests.post(urljoin(self.base_url, "/api/camera/caps"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('POST', "/api/camera/caps")
         return response.text
 
     def camera_snapshot(self, width, height, filename, source=None, time=None):
@@ -829,19 +940,31 @@ class CommandService(object):
             if not os.access(save_dir, os.W_OK):
                 raise IOError("No write permissions to {dir}.".format(dir=save_dir))
 
-            response = requests.post(urljoin(self.base_url, "/api/camera/snapshot"), auth=self.auth, verify=False,
-                                     stream=True, data=data)
-            response.raise_for_status()
+            response = self._request('POST', "/api/camera/snapshot", stream=True, data=data)
+            return self._download(response, filename)
 
-            if response.headers['Content-Type'] == 'application/json':
-                return response.text
+        return json.dumps({'success': True})
 
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
+    def camera_snapshot_data(self, width, height, source=None, time=None):
+        """
+        Same as camera_snapshot, but the JPEG image is returned as bytes instead of being saved to a file.
 
-        return json.dumps({'success': True})
+        :raise IOError: the device replied with an error instead of an image
+        """
+        data = {
+            'width': width,
+            'height': height
+        }
+
+        if source:
+            data['source'] = source
+        if time:
+            data['time'] = time
+
+        response = self._request('POST', "/api/camera/snapshot", stream=True, data=data)
+        if response.headers['Content-Type'] == 'application/json':
+            self._json_reply(response, "Snapshot failed: {reply}")
+        return b''.join(self._stream(response, 64 * 1024))
 
     def display_caps(self):
         """
@@ -873,8 +996,7 @@ class CommandService(object):
         display: Display identifier
         resolution: Display resolution in pixels
         """
-        response = requests.post(urljoin(self.base_url, "/api/display/caps"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('POST', "/api/display/caps")
         return response.text
 
     def display_upload_image(self, display, gif_filename):
@@ -888,7 +1010,8 @@ class CommandService(object):
         Enhanced Integration licence key only.
 
         :param display: Mandatory display identifier ( internal )
-        :param gif_filename: Mandatory parameter file path to a GIF image with display resolution
+        :param gif_filename: Mandatory parameter file path to a GIF image with display resolution, or the GIF image
+        itself as bytes
         :return: The reply is in the application/json format and includes no parameters.
 
         Example:
@@ -902,10 +1025,15 @@ class CommandService(object):
             'display': display
         }
 
-        response = requests.put(urljoin(self.base_url, "/api/display/image"), auth=self.auth, verify=False, data=data,
-                                files={'blob-image': (os.path.basename(gif_filename), open(gif_filename, 'rb'),
-                                                      'application/octet-stream')})
-        response.raise_for_status()
+        if isinstance(gif_filename, (bytes, bytearray, memoryview)):
+            response = self._request('PUT', "/api/display/image", data=data,
+                                     files={'blob-image': ('image.gif', gif_filename, 'application/octet-stream')})
+            return response.text
+
+        with open(gif_filename, 'rb') as f:
+            response = self._request('PUT', "/api/display/image", data=data,
+                                     files={'blob-image': (os.path.basename(gif_filename), f,
+                                                           'application/octet-stream')})
         return response.text
 
     def display_delete_image(self, display):
@@ -932,9 +1060,7 @@ class CommandService(object):
             'display': display
         }
 
-        response = requests.delete(urljoin(self.base_url, "/api/display/image"), auth=self.auth, verify=False,
-                                   data=data)
-        response.raise_for_status()
+        response = self._request('DELETE', "/api/display/image", data=data)
         return response.text
 
     def log_caps(self):
@@ -968,8 +1094,7 @@ class CommandService(object):
 
         events: Array of strings including a list of supported event types
         """
-        response = requests.post(urljoin(self.base_url, "/api/log/caps"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('POST', "/api/log/caps")
         return response.text
 
     def log_subscribe(self, include=None, filter=None, duration=None):
@@ -1049,8 +1174,7 @@ class CommandService(object):
         if filter:
             data['filter'] = filter
 
-        response = requests.post(urljoin(self.base_url, "/api/log/subscribe"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/log/subscribe", data=data)
         return response.text
 
     def log_unsubscribe(self, id):
@@ -1076,9 +1200,7 @@ class CommandService(object):
             'id': id
         }
 
-        response = requests.post(urljoin(self.base_url, "/api/log/unsubscribe"), auth=self.auth, verify=False,
-                                 data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/log/unsubscribe", data=data)
         return response.text
 
     def log_pull(self, id, timeout=0):
@@ -1134,11 +1256,31 @@ class CommandService(object):
             'timeout': timeout
         }
 
-        response = requests.post(urljoin(self.base_url, "/api/log/pull"), auth=self.auth, verify=False,
-                                 data=data, timeout=timeout + 5)
-        response.raise_for_status()
+        response = self._request('POST', "/api/log/pull", data=data, timeout=timeout + 5)
         return response.text
 
+    def log_pull_events(self, id, timeout=0, batches=False):
+        """
+        Streaming variant of log_pull: the reply body is decoded incrementally and every event is yielded as soon
+        as it has been received completely, without building the whole reply first. Use it for large batches, e.g.
+        subscriptions with include=all or after a long disconnect.
+
+        :param id: Identifier of the existing channel (see log_pull)
+        :param timeout: read-timeout for an open channel (see log_pull)
+        :param batches: yield lists of the events completed by each received chunk instead of single events
+        :return: generator of event dicts (see log_pull for the event format). A reply with success=false raises
+        jsonstream.PullError.
+        """
+
+        data = {
+            'id': id,
+            'timeout': timeout
+        }
+
+        response = self._request('POST', "/api/log/pull", data=data, timeout=timeout + 5, stream=True)
+        chunks = self._stream(response, 8192)
+        return iter_event_batches(chunks) if batches else iter_events(chunks)
+
     def audio_test(self):
         """
         The /api/audio/test function launches an automatic test of the intecom built-in
@@ -1156,8 +1298,7 @@ class CommandService(object):
             "success" : true
         }
         """
-        response = requests.post(urljoin(self.base_url, "/api/audio/test"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('POST', "/api/audio/test")
         return response.text
 
     def email_send(self, to, subject, width=None, height=None, body=None, picture_count=None, timespan=None):
@@ -1209,8 +1350,7 @@ class CommandService(object):
         if timespan:
             data['timeSpan'] = timespan
 
-        response = requests.post(urljoin(self.base_url, "/api/email/send"), auth=self.auth, verify=False, data=data)
-        response.raise_for_status()
+        response = self._request('POST', "/api/email/send", data=data)
         return response.text
 
     def pcap(self, pcap_file):
@@ -1237,18 +1377,8 @@ class CommandService(object):
             if not os.access(save_dir, os.W_OK):
                 raise IOError("No write permissions to {dir}.".format(dir=save_dir))
 
-            response = requests.post(urljoin(self.base_url, "/api/pcap"), auth=self.auth, verify=False, stream=True)
-            response.raise_for_status()
-
-            if response.headers['Content-Type'] == 'application/json':
-                return response.text
-
-            with open(pcap_file, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-
-            return json.dumps({'success': True})
+            response = self._request('POST', "/api/pcap", stream=True)
+            return self._download(response, pcap_file)
 
     def pcap_restart(self):
         """
@@ -1267,8 +1397,7 @@ class CommandService(object):
             "success" : true
         }
         """
-        response = requests.post(urljoin(self.base_url, "/api/pcap/restart"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('POST', "/api/pcap/restart")
         return response.text
 
     def pcap_stop(self):
@@ -1287,6 +1416,5 @@ class CommandService(object):
             "success" : true
         }
         """
-        response = requests.post(urljoin(self.base_url, "/api/pcap/stop"), auth=self.auth, verify=False)
-        response.raise_for_status()
+        response = self._request('POST', "/api/pcap/stop")
         return response.text
\ No newline at end of file
@@ -0,0 +1,475 @@
+"""
+Deduplicating, compressed backup of device configurations.
+
+ConfigBackup downloads the configurations of many devices concurrently (config_data) and stores each one, as soon as
+it arrives, split into content-defined chunks: a chunk ends after a line whose hash matches a pattern, so an edit
+only changes the chunks around it, and the parts devices have in common (templates, directory entries) end up as the
+same chunks for all of them. Every chunk is stored once, zlib compressed. A new chunk that replaces a similar one
+(the same section of the device's previous configuration, or, on a device's first backup, of the configuration stored
+before it) is compressed with that chunk as preset dictionary, which stores little more than the difference.
+
+Every backup of a device is a version: the list of its chunks, stored as a delta of the device's previous version.
+A configuration identical to the previous one only adds a reference to it. Chunk and version delta chains are both
+cut after max_chain links, so restoring any version reads a bounded number of records.
+
+Example:
+    backup = ConfigBackup('/var/lib/2n/config-backup')
+    report = backup.backup(ip_cams)
+    ...
+    data = backup.restore('10.0.0.5', at=time.time() - 7 * 86400)
+    backup.restore_to(ip_cam, at=time.time() - 7 * 86400)  # config_upload of that version
+
+Run "python configbackup.py --help" for the command line interface.
+
+Pack layout: chunks of header (blake2b digest 16 bytes, kind uint8 (0 full, 1 delta), base chunk uint32, raw length
+uint32, stored length uint32, crc32 uint32) followed by the compressed data. Chunks are numbered in the order they
+were written. Versions (versions.jsonl): one JSON object per line with device, time, sha (of the configuration),
+size, depth and either ref (index of the identical version), chunks (complete list) or base and ops (delta of
+version base: [start, count] copies chunks of the base, [-1, chunk, ...] inserts chunks).
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from difflib import SequenceMatcher
+
+log = logging.getLogger(__name__)
+
+CHUNK = struct.Struct('<16sBIIII')
+NO_BASE = 0xFFFFFFFF
+
+
+def split(data, average_lines=32, minimum=256, maximum=16384):
+    """
+    Content-defined chunking at line boundaries.
+    :return: list of chunks (bytes), joined they are data
+    """
+    chunks = []
+    current = []
+    size = 0
+    for line in data.splitlines(True):
+        current.append(line)
+        size += len(line)
+        if size >= maximum or (size >= minimum and zlib.crc32(line) % average_lines == 0):
+            chunks.append(b''.join(current))
+            current = []
+            size = 0
+    if current:
+        chunks.append(b''.join(current))
+    return chunks
+
+
+class ConfigBackup(object):
+    """
+    :param directory: backup directory, created if missing
+    :param max_chain: maximum length of chunk and version delta chains
+    :param pack_size: packs are closed and a new one is started when they reach this size in bytes
+    :param level: zlib compression level
+    :param cache_size: decompressed chunks kept in memory for restores and delta compression
+    """
+
+    def __init__(self, directory, max_chain=16, pack_size=64 * 1024 * 1024, level=9, cache_size=4096):
+        self.directory = directory
+        self.max_chain = max_chain
+        self.pack_size = pack_size
+        self.level = level
+        self.cache_size = cache_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.RLock()
+        self._readers = {}
+        self._cache = OrderedDict()
+        self._load_chunks()
+        self._load_versions()
+
+    # --- loading ---
+
+    def _pack_path(self, number):
+        return os.path.join(self.directory, '{0:08d}.pack'.format(number))
+
+    def _load_chunks(self):
+        self._digests = {}  # digest -> chunk number
+        self._locations = []  # chunk number -> (pack, offset, kind, base, raw length, stored length)
+        self._depths = array('H')
+        packs = sorted(int(name[:-5]) for name in os.listdir(self.directory) if name.endswith('.pack'))
+        for number in packs:
+            path = self._pack_path(number)
+            size = os.path.getsize(path)
+            offset = 0
+            with open(path, 'rb') as f:
+                while offset + CHUNK.size <= size:
+                    f.seek(offset)
+                    digest, kind, base, length, stored, _ = CHUNK.unpack(f.read(CHUNK.size))
+                    if offset + CHUNK.size + stored > size:
+                        break
+                    self._register(digest, (number, offset, kind, base, length, stored))
+                    offset += CHUNK.size + stored
+            if offset < size:
+                log.warning("Truncating torn tail of {path}".format(path=path))
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+        self._pack_number = packs[-1] if packs else 1
+        self._pack = open(self._pack_path(self._pack_number), 'ab')
+        self._pack_offset = self._pack.tell()
+        self.stored_bytes = sum(os.path.getsize(self._pack_path(number)) for number in packs)
+
+    def _register(self, digest, location):
+        self._digests[digest] = len(self._locations)
+        self._locations.append(location)
+        kind, base = location[2], location[3]
+        self._depths.append(self._depths[base] + 1 if kind == 1 else 0)
+
+    def _load_versions(self):
+        self.versions = []
+        self._devices = {}  # device -> (time array, version indices)
+        self._latest = {}  # device -> (version index, chunks) of the newest version
+        path = os.path.join(self.directory, 'versions.jsonl')
+        valid = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        version = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    valid += len(line)
+                    self._index(version)
+            if valid < os.path.getsize(path):
+                log.warning("Truncating torn tail of {path}".format(path=path))
+                with open(path, 'r+b') as f:
+                    f.truncate(valid)
+        self._versions = open(path, 'ab')
+
+    def _index(self, version):
+        index = len(self.versions)
+        self.versions.append(version)
+        times, indices = self._devices.setdefault(version['device'], (array('d'), []))
+        at = bisect_right(times, version['time'])
+        times.insert(at, version['time'])
+        indices.insert(at, index)
+        latest = self._latest.get(version['device'])
+        if latest is None or version['time'] >= self.versions[latest[0]]['time']:
+            self._latest[version['device']] = (index, None)  # chunks resolved on demand
+        return index
+
+    # --- chunks ---
+
+    def _reader(self, number):
+        fd = self._readers.get(number)
+        if fd is None:
+            fd = self._readers[number] = os.open(self._pack_path(number), os.O_RDONLY)
+        return fd
+
+    def _chunk(self, number):
+        raw = self._cache.get(number)
+        if raw is not None:
+            self._cache.move_to_end(number)
+            return raw
+        pack, offset, kind, base, length, stored = self._locations[number]
+        if pack == self._pack_number:
+            self._pack.flush()
+        data = os.pread(self._reader(pack), CHUNK.size + stored, offset)
+        crc = CHUNK.unpack_from(data)[5]
+        payload = data[CHUNK.size:]
+        if len(payload) != stored or zlib.crc32(payload) != crc:
+            raise IOError("Corrupted chunk {number} in {path}".format(number=number, path=self._pack_path(pack)))
+        if kind == 1:
+            decompressor = zlib.decompressobj(zdict=self._chunk(base))
+            raw = decompressor.decompress(payload) + decompressor.flush()
+        else:
+            raw = zlib.decompress(payload)
+        self._cache[number] = raw
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return raw
+
+    def _store_chunk(self, digest, raw, base):
+        payload = zlib.compress(raw, self.level)
+        kind = 0
+        if base is not None and self._depths[base] < self.max_chain:
+            compressor = zlib.compressobj(self.level, zdict=self._chunk(base))
+            delta = compressor.compress(raw) + compressor.flush()
+            if len(delta) < len(payload):
+                payload, kind = delta, 1
+        if self._pack_offset >= self.pack_size:
+            self._pack.close()
+            self._pack_number += 1
+            self._pack = open(self._pack_path(self._pack_number), 'ab')
+            self._pack_offset = 0
+        location = (self._pack_number, self._pack_offset, kind, base if kind == 1 else NO_BASE, len(raw),
+                    len(payload))
+        self._pack.write(CHUNK.pack(digest, kind, location[3], len(raw), len(payload), zlib.crc32(payload)))
+        self._pack.write(payload)
+        self._pack_offset += CHUNK.size + len(payload)
+        self.stored_bytes += CHUNK.size + len(payload)
+        self._register(digest, location)
+        self._cache[len(self._locations) - 1] = raw
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return len(self._locations) - 1
+
+    # --- versions ---
+
+    def _manifest(self, index):
+        version = self.versions[index]
+        if 'ref' in version:
+            return self._manifest(version['ref'])
+        if 'chunks' in version:
+            return version['chunks']
+        base = self._manifest(version['base'])
+        chunks = []
+        for op in version['ops']:
+            if op[0] == -1:
+                chunks.extend(op[1:])
+            else:
+                chunks.extend(base[op[0]:op[0] + op[1]])
+        return chunks
+
+    def _newest(self, device):
+        """
+        :return: (version index, chunks) of the newest version of the device, None if there is none
+        """
+        latest = self._latest.get(device)
+        if latest is None:
+            return None
+        if latest[1] is None:
+            latest = self._latest[device] = (latest[0], self._manifest(latest[0]))
+        return latest
+
+    def _append(self, version):
+        self._versions.write(json.dumps(version, separators=(',', ':')).encode('utf-8') + b'\n')
+        return self._index(version)
+
+    def add(self, device, data, when=None):
+        """
+        Stores a configuration of the device.
+
+        :param when: time of the backup, now by default
+        :return: 'stored' or 'unchanged' (identical to the device's previous version)
+        """
+        when = time.time() if when is None else when
+        sha = hashlib.blake2b(data, digest_size=16).hexdigest()
+        version = {'device': device, 'time': when, 'sha': sha, 'size': len(data)}
+        with self._lock:
+            previous = self._newest(device)
+            if previous is not None and self.versions[previous[0]]['sha'] == sha:
+                target = self.versions[previous[0]].get('ref', previous[0])
+                version.update(ref=target, depth=self.versions[target]['depth'])
+                index = self._append(version)
+                if self._latest[device][0] == index:  # not when backfilling an older version
+                    self._latest[device] = (index, previous[1])
+                return 'unchanged'
+
+            if previous is not None:
+                reference = previous[1]
+            else:
+                # first backup of the device: configurations stored before it are the best guess for similar chunks
+                peer = next(reversed(self._latest.values()), None) if self._latest else None
+                reference = self._newest(self.versions[peer[0]]['device'])[1] if peer is not None else []
+
+            pieces = split(data)
+            digests = [hashlib.blake2b(piece, digest_size=16).digest() for piece in pieces]
+            chunks = [self._digests.get(digest, -1 - i) for i, digest in enumerate(digests)]  # < 0: new chunk
+            matcher = SequenceMatcher(None, reference, chunks, autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                for j in range(j1, j2):
+                    if chunks[j] >= 0:
+                        continue
+                    existing = self._digests.get(digests[j])  # repeated within this configuration
+                    if existing is not None:
+                        chunks[j] = existing
+                        continue
+                    base = None
+                    if tag == 'replace':
+                        base = reference[i1 + min(j - j1, i2 - i1 - 1)]
+                    elif reference:
+                        base = reference[min(i1, len(reference) - 1)]
+                    chunks[j] = self._store_chunk(digests[j], pieces[j], base)
+
+            if previous is not None and self.versions[previous[0]]['depth'] < self.max_chain:
+                base_index = self.versions[previous[0]].get('ref', previous[0])
+                ops = []
+                for tag, i1, i2, j1, j2 in SequenceMatcher(None, previous[1], chunks, autojunk=False).get_opcodes():
+                    if tag == 'equal':
+                        ops.append([i1, i2 - i1])
+                    elif j2 > j1:
+                        ops.append([-1] + chunks[j1:j2])
+                version.update(base=base_index, ops=ops, depth=self.versions[base_index]['depth'] + 1)
+            else:
+                version.update(chunks=chunks, depth=0)
+            index = self._append(version)
+            if self._latest[device][0] == index:  # not when backfilling an older version
+                self._latest[device] = (index, chunks)
+            self._pack.flush()
+            self._versions.flush()
+            return 'stored'
+
+    def backup(self, ip_cams, workers=16):
+        """
+        Downloads the configurations of the devices concurrently and stores them as they arrive.
+
+        :return: dict with the number of devices, stored and unchanged configurations, failed devices (address ->
+        error), downloaded and written bytes and the duration in seconds
+        """
+        started = time.perf_counter()
+        written = self.stored_bytes
+        report = {'devices': 0, 'stored': 0, 'unchanged': 0, 'failed': {}, 'downloaded_bytes': 0}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='2n-backup') as executor:
+            futures = dict((executor.submit(ip_cam.commands.config_data), ip_cam) for ip_cam in ip_cams)
+            for future in as_completed(futures):
+                address = futures[future].ip_address
+                report['devices'] += 1
+                try:
+                    data = future.result()
+                except Exception as err:
+                    log.warning("{ip}: config backup failed: {err}".format(ip=address, err=err))
+                    report['failed'][address] = str(err) or type(err).__name__
+                    continue
+                report['downloaded_bytes'] += len(data)
+                report[self.add(address, data)] += 1
+        self.sync()
+        report['written_bytes'] = self.stored_bytes - written
+        report['seconds'] = time.perf_counter() - started
+        return report
+
+    # --- restore ---
+
+    def history(self, device):
+        """
+        :return: list of dicts (time, sha, size, changed) of the device's versions, oldest first
+        """
+        with self._lock:
+            times, indices = self._devices.get(device, ((), []))
+            return [{'time': self.versions[i]['time'], 'sha': self.versions[i]['sha'],
+                     'size': self.versions[i]['size'], 'changed': 'ref' not in self.versions[i]} for i in indices]
+
+    def devices(self):
+        return sorted(self._devices)
+
+    def restore(self, device, at=None):
+        """
+        :param at: point in time, the newest version backed up at or before it is returned (default: newest)
+        :return: configuration XML as bytes
+        :raise KeyError: no version of the device at that time
+        """
+        with self._lock:
+            times, indices = self._devices.get(device, ((), []))
+            position = len(indices) if at is None else bisect_right(times, at)
+            if not position:
+                raise KeyError("No configuration backup of {device}{at}".format(
+                    device=device, at='' if at is None else ' before {0}'.format(time.ctime(at))))
+            version = self.versions[indices[position - 1]]
+            data = b''.join(self._chunk(number) for number in self._manifest(indices[position - 1]))
+        if hashlib.blake2b(data, digest_size=16).hexdigest() != version['sha']:
+            raise IOError("Restored configuration of {device} does not match its checksum".format(device=device))
+        return data
+
+    def restore_to(self, ip_cam, at=None, device=None):
+        """
+        Uploads a backed up configuration to the device (config_upload).
+
+        :param device: address the configuration was backed up from, the ip_cam's address by default
+        :return: reply of config_upload
+        """
+        return ip_cam.commands.config_upload(self.restore(device or ip_cam.ip_address, at))
+
+    # --- maintenance ---
+
+    def stats(self):
+        with self._lock:
+            logical = sum(version['size'] for version in self.versions)
+            return {'devices': len(self._devices), 'versions': len(self.versions), 'chunks': len(self._locations),
+                    'delta_chunks': sum(1 for location in self._locations if location[2] == 1),
+                    'logical_bytes': logical, 'stored_bytes': self.stored_bytes,
+                    'ratio': logical / float(self.stored_bytes) if self.stored_bytes else None}
+
+    def sync(self):
+        with self._lock:
+            for f in (self._pack, self._versions):
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._pack.close()
+            self._versions.close()
+            for fd in self._readers.values():
+                os.close(fd)
+            self._readers = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Configuration backup of 2N devices')
+    parser.add_argument('--directory', required=True, help='backup directory')
+    commands = parser.add_subparsers(dest='command')
+    backup = commands.add_parser('backup', help='back up the configurations of the devices')
+    backup.add_argument('--devices', required=True, help="file with one device address per line, '-' for stdin")
+    backup.add_argument('--workers', type=int, default=16, help='concurrent downloads')
+    restore = commands.add_parser('restore', help='write or upload a backed up configuration')
+    restore.add_argument('device', help='address the configuration was backed up from')
+    restore.add_argument('--at', type=float, help='unix time, the newest version before it is restored')
+    restore.add_argument('--output', help='write the configuration to this file instead of uploading it')
+    restore.add_argument('--target', help='upload to this address instead of the device itself')
+    history = commands.add_parser('history', help='list the versions of a device, or the devices')
+    history.add_argument('device', nargs='?')
+    for command in (backup, restore):
+        command.add_argument('--auth', type=int, default=0, choices=[0, 1, 2])
+        command.add_argument('--user')
+        command.add_argument('--password')
+        command.add_argument('--ssl', action='store_true')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('a command is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    store = ConfigBackup(args.directory)
+    try:
+        if args.command == 'history':
+            if args.device:
+                for item in store.history(args.device):
+                    print(json.dumps(item, sort_keys=True))
+            else:
+                print('\n'.join(store.devices()))
+            print(json.dumps(store.stats(), sort_keys=True), file=sys.stderr)
+            return
+
+        from core import IPCam
+        from httptransport import HTTPClientTransport
+
+        transport = HTTPClientTransport(timeout=30)
+        if args.command == 'backup':
+            from fleetctl import read_devices
+
+            ip_cams = [IPCam(address, ssl=args.ssl, auth_type=args.auth, user=args.user, password=args.password,
+                             transport=transport) for address in read_devices(args.devices)]
+            report = store.backup(ip_cams, workers=args.workers)
+            print(json.dumps(report, sort_keys=True))
+            if report['failed']:
+                sys.exit(1)
+        elif args.output:
+            with open(args.output, 'wb') as f:
+                f.write(store.restore(args.device, args.at))
+        else:
+            ip_cam = IPCam(args.target or args.device, ssl=args.ssl, auth_type=args.auth, user=args.user,
+                           password=args.password, transport=transport)
+            print(store.restore_to(ip_cam, args.at, device=args.device))
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
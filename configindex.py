@@ -0,0 +1,353 @@
+"""
+In-memory index of the settings of a fleet's configurations, for queries like "which intercoms have SIP account 2
+enabled" or "which devices use digest authentication on the HTTP API".
+
+parse_config reads a configuration XML (as returned by config_data / config_get) chunk by chunk with expat and maps
+every setting to a path, without building a DOM:
+
+    <DeviceConfig serial="54-0000-0001">               @serial = 54-0000-0001
+     <HttpApi><AuthMethod>digest</AuthMethod>           HttpApi/AuthMethod = digest
+     <SipAccount id="2"><Enabled>0</Enabled>            SipAccount[2]/Enabled = 0
+
+The root element is left out of the paths, an element with an id attribute is addressed by it, an element without
+one that repeats under the same parent gets its position from the second occurrence on (Line, Line[2], ...), other
+attributes become @name path components.
+
+ConfigIndex keeps the parsed settings of every device as two sorted arrays of path and value numbers, the path and
+value strings themselves are stored once for the whole fleet. A configuration is only parsed again when its hash
+differs from the indexed one, so refreshing a fleet whose configurations mostly did not change costs little more
+than the downloads (or nothing, when the index is refreshed from a ConfigBackup).
+
+Example:
+    index = ConfigIndex()
+    index.refresh(ip_cams)
+    index.select('SipAccount[2]/Enabled', '1')  # ['10.0.0.5', '10.0.0.9', ...]
+    index.count('HttpApi/AuthMethod')  # Counter({'digest': 790, 'basic': 10})
+    index.get('10.0.0.5', 'Network/HostName')
+    ...
+    index.refresh(ip_cams)  # only changed configurations are parsed again
+    index.refresh_from_backup(ConfigBackup('/var/lib/2n/config-backup'))
+
+Run "python configindex.py --help" for the command line interface.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from xml.parsers import expat
+
+log = logging.getLogger(__name__)
+
+
+def config_digest(data):
+    """
+    :return: hash of a configuration, the same as the sha of its ConfigBackup versions
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def parse_config(chunks):
+    """
+    Streaming parse of a configuration XML.
+
+    :param chunks: iterable of bytes chunks of the XML, or the XML itself as bytes
+    :return: dict path -> value (str) of all settings, see the module documentation for the paths
+    :raise ValueError: the data is not well-formed XML
+    """
+    if isinstance(chunks, (bytes, bytearray, memoryview)):
+        chunks = (chunks,)
+    settings = {}
+    paths = []  # of the open elements
+    children = []  # per open element: occurrences of its child keys, None before the first child
+    texts = []
+
+    def start(name, attributes):
+        if paths:
+            key = name if 'id' not in attributes else '{name}[{id}]'.format(name=name, id=attributes['id'])
+            occurrences = children[-1]
+            if occurrences is None:
+                children[-1] = {key: 1}
+            elif key not in occurrences:
+                occurrences[key] = 1
+            else:
+                occurrences[key] += 1
+                key = '{key}[{n}]'.format(key=key, n=occurrences[key])
+            parent = paths[-1]
+            path = parent + '/' + key if parent else key
+        else:
+            path = ''
+        for attribute, value in attributes.items():
+            if attribute != 'id' or not paths:
+                settings[path + '/@' + attribute if path else '@' + attribute] = value
+        paths.append(path)
+        children.append(None)
+        texts.append('')
+
+    def end(name):
+        path = paths.pop()
+        children.pop()
+        text = texts.pop().strip()
+        if text and path:
+            settings[path] = text
+
+    def data(text):
+        texts[-1] += text
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    try:
+        for chunk in chunks:
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
+    except expat.ExpatError as err:
+        raise ValueError("Invalid configuration XML: {err}".format(err=err))
+    return settings
+
+
+class ConfigIndex(object):
+    """
+    Settings of the configurations of many devices, queried from memory.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._path_numbers = {}
+        self._paths = []
+        self._value_numbers = {}
+        self._values = []
+        self._devices = {}  # device -> (digest, path numbers, value numbers), paths sorted
+
+    # --- updating ---
+
+    def _number(self, numbers, strings, string):
+        number = numbers.get(string)
+        if number is None:
+            number = numbers[string] = len(strings)
+            strings.append(string)
+        return number
+
+    def update(self, device, data, digest=None):
+        """
+        Indexes the configuration of a device, unless it is the one already indexed.
+
+        :param data: configuration XML as bytes
+        :param digest: config_digest of data, if already known
+        :return: True if the configuration was parsed, False if it was unchanged
+        """
+        digest = digest or config_digest(data)
+        entry = self._devices.get(device)
+        if entry is not None and entry[0] == digest:
+            return False
+        settings = parse_config(data)
+        with self._lock:
+            pairs = sorted((self._number(self._path_numbers, self._paths, path),
+                            self._number(self._value_numbers, self._values, value))
+                           for path, value in settings.items())
+            self._devices[device] = (digest, array('I', (path for path, _ in pairs)),
+                                     array('I', (value for _, value in pairs)))
+        return True
+
+    def remove(self, device):
+        with self._lock:
+            self._devices.pop(device, None)
+
+    def refresh(self, ip_cams, workers=16):
+        """
+        Downloads the configurations of the devices concurrently and indexes the changed ones.
+
+        :return: dict with the number of devices, parsed and unchanged configurations, failed devices (address ->
+        error) and the duration in seconds
+        """
+        started = time.perf_counter()
+        report = {'devices': 0, 'parsed': 0, 'unchanged': 0, 'failed': {}}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='2n-configindex') as executor:
+            futures = dict((executor.submit(ip_cam.commands.config_data), ip_cam) for ip_cam in ip_cams)
+            for future in as_completed(futures):
+                address = futures[future].ip_address
+                report['devices'] += 1
+                try:
+                    parsed = self.update(address, future.result())
+                except Exception as err:
+                    log.warning("{ip}: config indexing failed: {err}".format(ip=address, err=err))
+                    report['failed'][address] = str(err) or type(err).__name__
+                    continue
+                report['parsed' if parsed else 'unchanged'] += 1
+        report['seconds'] = time.perf_counter() - started
+        return report
+
+    def refresh_from_backup(self, backup, devices=None):
+        """
+        Indexes the newest backed up configuration of the devices, restoring only those whose hash changed.
+
+        :param backup: configbackup.ConfigBackup
+        :param devices: device addresses, default: all devices in the backup
+        :return: dict with the number of devices, parsed and unchanged configurations and the duration in seconds
+        """
+        started = time.perf_counter()
+        report = {'devices': 0, 'parsed': 0, 'unchanged': 0}
+        for device in backup.devices() if devices is None else devices:
+            history = backup.history(device)
+            if not history:
+                continue
+            report['devices'] += 1
+            digest = history[-1]['sha']
+            entry = self._devices.get(device)
+            if entry is not None and entry[0] == digest:
+                report['unchanged'] += 1
+                continue
+            self.update(device, backup.restore(device), digest=digest)
+            report['parsed'] += 1
+        report['seconds'] = time.perf_counter() - started
+        return report
+
+    # --- queries ---
+
+    def _value(self, entry, path_number):
+        paths = entry[1]
+        position = bisect_left(paths, path_number)
+        if position < len(paths) and paths[position] == path_number:
+            return entry[2][position]
+        return None
+
+    def get(self, device, path, default=None):
+        """
+        :return: value of the setting in the device's configuration
+        :raise KeyError: the device is not indexed
+        """
+        entry = self._devices[device]
+        path_number = self._path_numbers.get(path)
+        value = None if path_number is None else self._value(entry, path_number)
+        return default if value is None else self._values[value]
+
+    def settings(self, device, prefix=''):
+        """
+        :return: dict path -> value of the device's settings whose path starts with prefix
+        :raise KeyError: the device is not indexed
+        """
+        _, paths, values = self._devices[device]
+        return dict((self._paths[path], self._values[value]) for path, value in zip(paths, values)
+                    if self._paths[path].startswith(prefix))
+
+    def values(self, path):
+        """
+        :return: dict device -> value of the setting, devices without it are left out
+        """
+        path_number = self._path_numbers.get(path)
+        if path_number is None:
+            return {}
+        result = {}
+        for device, entry in list(self._devices.items()):
+            value = self._value(entry, path_number)
+            if value is not None:
+                result[device] = self._values[value]
+        return result
+
+    def select(self, path, value=None):
+        """
+        :param value: value the setting must have (compared as str), a function value -> bool, or None for any value
+        :return: sorted list of the devices whose setting matches
+        """
+        if value is None:
+            match = None
+        elif callable(value):
+            match = value
+        else:
+            value = str(value)
+            match = value.__eq__
+        return sorted(device for device, found in self.values(path).items() if match is None or match(found))
+
+    def count(self, path):
+        """
+        :return: Counter value -> number of devices with that value of the setting
+        """
+        return Counter(self.values(path).values())
+
+    def paths(self, prefix=''):
+        """
+        :return: sorted list of the setting paths present in any indexed configuration
+        """
+        with self._lock:
+            used = set()
+            for _, paths, _ in list(self._devices.values()):
+                used.update(paths)
+            return sorted(self._paths[path] for path in used if self._paths[path].startswith(prefix))
+
+    def devices(self):
+        return sorted(self._devices)
+
+    def digest(self, device):
+        """
+        :return: config_digest of the device's indexed configuration, None if it is not indexed
+        """
+        entry = self._devices.get(device)
+        return None if entry is None else entry[0]
+
+    def stats(self):
+        entries = [entry[1] for entry in list(self._devices.values())]
+        return {'devices': len(entries), 'settings': sum(len(paths) for paths in entries),
+                'paths': len(self._paths), 'values': len(self._values),
+                'index_bytes': sum(8 * len(paths) for paths in entries)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the settings of the configurations of 2N devices')
+    parser.add_argument('path', nargs='?', help="setting path, e.g. 'HttpApi/AuthMethod' or 'SipAccount[2]/Enabled'")
+    parser.add_argument('value', nargs='?', help='list the devices with this value instead of counting the values')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--backup', help='ConfigBackup directory, the newest configurations in it are queried')
+    source.add_argument('--devices', help="file with one device address per line, '-' for stdin")
+    parser.add_argument('--paths', action='store_true', help='list the setting paths (starting with path) and exit')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent downloads')
+    parser.add_argument('--auth', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--ssl', action='store_true')
+    args = parser.parse_args()
+    if args.path is None and not args.paths:
+        parser.error('the path is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    index = ConfigIndex()
+    if args.backup:
+        from configbackup import ConfigBackup
+
+        backup = ConfigBackup(args.backup)
+        try:
+            index.refresh_from_backup(backup)
+        finally:
+            backup.close()
+    else:
+        from core import IPCam
+        from fleetctl import read_devices
+        from httptransport import HTTPClientTransport
+
+        transport = HTTPClientTransport(timeout=30)
+        ip_cams = [IPCam(address, ssl=args.ssl, auth_type=args.auth, user=args.user, password=args.password,
+                         transport=transport) for address in read_devices(args.devices)]
+        report = index.refresh(ip_cams, workers=args.workers)
+        transport.close()
+        for address, error in sorted(report['failed'].items()):
+            log.info("{ip}: {err}".format(ip=address, err=error))
+
+    if args.paths:
+        print('\n'.join(index.paths(args.path or '')))
+    elif args.value is not None:
+        print('\n'.join(index.select(args.path, args.value)))
+    else:
+        print(json.dumps(dict(index.count(args.path)), sort_keys=True))
+    log.info(json.dumps(index.stats(), sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
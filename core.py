@@ -5,10 +5,16 @@ log = logging.getLogger(__name__)
 
 class IPCam(object):
 
-    def __init__(self, ip, ssl=False, auth_type=0, user=None, password=None):
+    def __init__(self, ip, ssl=False, auth_type=0, user=None, password=None, transport=None, inventory=None):
         self.ip_address = ip
         self.user = user
         self.password = password
         self.auth_type = int(auth_type)  # 0: none, 1: basic, 2: digest
         self.ssl = ssl
-        self.commands = CommandService(self)
\ No newline at end of file
+        self.transport = transport  # None: plain requests
+        self.commands = CommandService(self)
+
+        self.cache = None
+        if inventory is not None:
+            from inventory import DeviceCache
+            self.cache = DeviceCache(self, inventory)
\ No newline at end of file
@@ -0,0 +1,231 @@
+"""
+Concurrent LAN discovery of 2N devices.
+
+Every address of the local IPv4 subnets (or of explicitly given networks) is probed for /api/system/info over http
+and https. The function is available on all 2N devices without authentication, so a successful probe yields the
+model, serial number and firmware version right away.
+
+Example:
+    for device in discover():
+        print(device.ip, device.variant, device.serial, device.firmware)
+    ip_cams = [device.to_ipcam(auth_type=2, user='admin', password='secret') for device in discover()]
+
+Probes run concurrently on one asyncio loop with a per-connection timeout, a cap on parallel connections and a cap
+on new connections per second, so a /22 is swept in a few seconds.
+"""
+
+import asyncio
+import ipaddress
+import json
+import logging
+import ssl
+import time
+
+from utils import get_interfaces
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class DiscoveredDevice(object):
+    def __init__(self, ip, port, ssl, info, rtt):
+        self.ip = ip
+        self.port = port
+        self.ssl = ssl
+        self.info = info
+        self.rtt = rtt
+
+    @property
+    def address(self):
+        if self.port == DEFAULT_PORTS['https' if self.ssl else 'http']:
+            return self.ip
+        return '{ip}:{port}'.format(ip=self.ip, port=self.port)
+
+    @property
+    def variant(self):
+        return self.info.get('variant')
+
+    @property
+    def serial(self):
+        return self.info.get('serialNumber')
+
+    @property
+    def firmware(self):
+        return self.info.get('swVersion')
+
+    def to_ipcam(self, auth_type=0, user=None, password=None, **kwargs):
+        from core import IPCam
+        return IPCam(self.address, ssl=self.ssl, auth_type=auth_type, user=user, password=password, **kwargs)
+
+    def as_dict(self):
+        return {'ip': self.ip, 'port': self.port, 'ssl': self.ssl, 'rtt': round(self.rtt, 4),
+                'variant': self.variant, 'serial': self.serial, 'firmware': self.firmware, 'info': self.info}
+
+    def __repr__(self):
+        return '<DiscoveredDevice {address} {variant} {serial} {firmware}>'.format(
+            address=self.address, variant=self.variant, serial=self.serial, firmware=self.firmware)
+
+
+def local_networks(max_hosts=4096):
+    """
+    Networks of the local IPv4 interfaces (loopback excluded). Networks with more than max_hosts addresses are
+    narrowed to the /22 around the interface address.
+    """
+    networks = []
+    for ifname, ip, netmask in get_interfaces():
+        interface = ipaddress.IPv4Interface('{ip}/{mask}'.format(ip=ip, mask=netmask))
+        if interface.is_loopback or interface.is_link_local:
+            continue
+        network = interface.network
+        if network.num_addresses > max_hosts:
+            narrowed = ipaddress.IPv4Interface('{ip}/22'.format(ip=ip)).network
+            log.info("Narrowing {net} on {ifname} to {narrowed}".format(net=network, ifname=ifname,
+                                                                        narrowed=narrowed))
+            network = narrowed
+        if network not in networks:
+            networks.append(network)
+    return networks
+
+
+class _RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self.next)
+        self.next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class Discovery(object):
+    """
+    :param timeout: seconds allowed for connect + reply per probe
+    :param concurrency: maximum parallel connections
+    :param rate: maximum new connections per second (None: unlimited)
+    :param schemes: schemes to probe, 'http' and/or 'https'
+    :param ports: optional {scheme: port} overriding 80/443
+    """
+
+    def __init__(self, timeout=0.5, concurrency=256, rate=2000, schemes=('http', 'https'), ports=None):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.rate = rate
+        self.schemes = schemes
+        self.ports = dict(DEFAULT_PORTS, **(ports or {}))
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def run(self, networks=None, callback=None):
+        """
+        :param networks: iterable of networks ('192.168.1.0/24', IPv4Network) or single addresses; defaults to
+        the local networks
+        :param callback: optional function called with every DiscoveredDevice as soon as it is found
+        :return: list of DiscoveredDevice, one per address (https preferred if a device answers on both)
+        """
+        hosts = []
+        for network in (local_networks() if networks is None else networks):
+            network = ipaddress.ip_network(network, strict=False)
+            hosts.extend(network.hosts() if network.num_addresses > 1 else [network.network_address])
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = _RateLimiter(self.rate)
+        found = {}
+
+        async def probe(ip, scheme):
+            async with semaphore:
+                await limiter.wait()
+                try:
+                    device = await self._probe(str(ip), scheme)
+                except Exception as err:
+                    # whatever answers on an address must not abort the whole sweep
+                    log.debug("{ip}: {scheme} probe failed: {err!r}".format(ip=ip, scheme=scheme, err=err))
+                    return
+            if device is not None:
+                previous = found.get(device.ip)
+                if previous is None or (device.ssl and not previous.ssl):
+                    found[device.ip] = device
+                if previous is None and callback is not None:
+                    callback(device)
+
+        started = time.monotonic()
+        await asyncio.gather(*[probe(ip, scheme) for ip in hosts for scheme in self.schemes])
+        log.info("Probed {n} addresses in {t:.1f}s, found {found} devices".format(
+            n=len(hosts), t=time.monotonic() - started, found=len(found)))
+        return sorted(found.values(), key=lambda d: ipaddress.ip_address(d.ip))
+
+    async def _probe(self, ip, scheme):
+        port = self.ports[scheme]
+        started = time.monotonic()
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, port, ssl=self.ssl_context if scheme == 'https' else None),
+                self.timeout)
+            # HTTP/1.0: the reply is not chunked and ends when the device closes the connection
+            writer.write('GET /api/system/info HTTP/1.0\r\nHost: {ip}\r\nAccept: application/json\r\n'
+                         'Connection: close\r\n\r\n'.format(ip=ip).encode('ascii'))
+            remaining = self.timeout - (time.monotonic() - started)
+            raw = await asyncio.wait_for(reader.read(-1), max(remaining, 0.05))
+            rtt = time.monotonic() - started
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            return None
+        finally:
+            if writer is not None:
+                writer.close()
+
+        head, _, body = raw.partition(b'\r\n\r\n')
+        status = head.split(b'\r\n', 1)[0].split(b' ')
+        if len(status) < 2 or not status[0].startswith(b'HTTP/1.') or status[1] != b'200':
+            return None
+        try:
+            if b'\r\ntransfer-encoding: chunked' in head.lower():
+                body = _dechunk(body)
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or not data.get('success') or not isinstance(data.get('result'), dict) \
+                or 'serialNumber' not in data['result']:
+            return None
+        return DiscoveredDevice(ip, port, scheme == 'https', data['result'], rtt)
+
+
+def _dechunk(body):
+    """
+    :return: body of a reply sent with Transfer-Encoding: chunked
+    :raise ValueError: malformed or incomplete chunked body
+    """
+    parts = []
+    position = 0
+    while True:
+        end = body.find(b'\r\n', position)
+        if end < 0:
+            raise ValueError('Incomplete chunked body')
+        size = int(body[position:end].split(b';', 1)[0], 16)
+        if not size:
+            return b''.join(parts)
+        start = end + 2
+        if start + size > len(body):
+            raise ValueError('Incomplete chunked body')
+        parts.append(body[start:start + size])
+        position = start + size + 2
+
+
+def discover(networks=None, callback=None, **kwargs):
+    """
+    Synchronous wrapper around Discovery.run(), see Discovery for the keyword arguments.
+    """
+    return asyncio.run(Discovery(**kwargs).run(networks, callback))
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    for device in discover(sys.argv[1:] or None):
+        print(json.dumps(device.as_dict()))
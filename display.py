@@ -0,0 +1,206 @@
+"""
+Display content pipeline.
+
+Content (text or a Pillow image) is rendered to a GIF in memory at the resolution the device reports in
+display_caps. Encoded images are cached by a hash of the content and the resolution, so pushing one announcement to
+a whole fleet costs one encode per distinct display resolution. The pipeline remembers which image it last pushed to
+every device and display and skips the upload when it would not change anything. Fleet pushes run concurrently.
+
+Rendering needs Pillow.
+
+Example:
+    pipeline = DisplayPipeline()
+    results = pipeline.push(ip_cams, ['Fire drill', 'today at 10:00'])
+    # -> {'10.0.0.5': 'uploaded', '10.0.0.6': 'unchanged', '10.0.0.7': 'HTTPError: ...'}
+"""
+
+import hashlib
+import io
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RESOLUTION = (320, 240)
+
+
+class DisplayPipeline(object):
+    """
+    :param workers: concurrent uploads of a fleet push
+    :param cache_size: number of encoded images kept
+    :param foreground, background: colours of rendered text
+    :param font: path of a TrueType font used for text (Pillow's default font otherwise)
+    :param font_size: point size of the TrueType font
+    """
+
+    def __init__(self, workers=32, cache_size=64, foreground='white', background='black', font=None, font_size=24):
+        self.workers = workers
+        self.cache_size = cache_size
+        self.foreground = foreground
+        self.background = background
+        self.font = font
+        self.font_size = font_size
+        self.encodes = 0
+        self._images = OrderedDict()  # content key -> GIF bytes
+        self._pushed = {}  # (device, display) -> digest of the GIF last uploaded
+        self._resolutions = {}  # (device, display) -> (width, height)
+        self._encoding = {}  # content key -> Event set when the encode in progress is done
+        self._lock = threading.Lock()
+
+    def resolution(self, ip_cam, display='internal'):
+        """
+        :return: (width, height) of the display from display_caps (through ip_cam.cache if the device has one)
+        :raise IOError: display_caps failed or does not list the display, nothing is remembered then
+        """
+        key = (ip_cam.ip_address, display)
+        size = self._resolutions.get(key)
+        if size is None:
+            payload = ip_cam.cache.get('display_caps') if ip_cam.cache is not None else \
+                ip_cam.commands.display_caps()
+            reply = json.loads(payload)
+            if not reply.get('success'):
+                raise IOError('Display caps failed: {reply}'.format(reply=reply))
+            for item in (reply.get('result') or {}).get('displays', []):
+                if item.get('display') == display:
+                    resolution = item.get('resolution') or {}
+                    size = (resolution.get('width', DEFAULT_RESOLUTION[0]),
+                            resolution.get('height', DEFAULT_RESOLUTION[1]))
+            if size is None:
+                raise IOError('No display {display} in display caps: {reply}'.format(display=display, reply=reply))
+            self._resolutions[key] = size
+        return size
+
+    def render(self, content, size):
+        """
+        :param content: text (str, lines separated by newlines, or a list of lines), a Pillow image or GIF bytes
+        :param size: (width, height)
+        :return: GIF bytes at the given size, from the cache if the same content was rendered before
+        """
+        if isinstance(content, (bytes, bytearray)):
+            return bytes(content)
+        key = self._content_key(content, size)
+        while True:
+            with self._lock:
+                data = self._images.get(key)
+                if data is not None:
+                    self._images.move_to_end(key)
+                    return data
+                encoding = self._encoding.get(key)
+                if encoding is None:
+                    encoding = self._encoding[key] = threading.Event()
+                    break
+            # another thread of the fleet push is encoding the same content
+            encoding.wait()
+
+        try:
+            data = self._encode(content, size)
+            with self._lock:
+                self.encodes += 1
+                self._images[key] = data
+                while len(self._images) > self.cache_size:
+                    self._images.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._encoding[key]
+            encoding.set()
+        return data
+
+    def _content_key(self, content, size):
+        digest = hashlib.blake2b(digest_size=16)
+        if isinstance(content, (str, list, tuple)):
+            lines = content.split('\n') if isinstance(content, str) else [str(line) for line in content]
+            digest.update(json.dumps(['text', lines, self.foreground, self.background, self.font,
+                                      self.font_size]).encode('utf-8'))
+        else:
+            digest.update(json.dumps(['image', content.mode, content.size]).encode('utf-8'))
+            digest.update(content.tobytes())
+        digest.update(json.dumps(list(size)).encode('utf-8'))
+        return digest.digest()
+
+    def _encode(self, content, size):
+        from PIL import Image, ImageDraw, ImageFont
+
+        if isinstance(content, (str, list, tuple)):
+            lines = content.split('\n') if isinstance(content, str) else [str(line) for line in content]
+            image = Image.new('RGB', size, self.background)
+            draw = ImageDraw.Draw(image)
+            font = ImageFont.truetype(self.font, self.font_size) if self.font else ImageFont.load_default()
+            heights = [draw.textbbox((0, 0), line or ' ', font=font) for line in lines]
+            spacing = 4
+            total = sum(box[3] - box[1] for box in heights) + spacing * (len(lines) - 1)
+            y = (size[1] - total) // 2
+            for line, box in zip(lines, heights):
+                draw.text(((size[0] - (box[2] - box[0])) // 2 - box[0], y - box[1]), line, font=font,
+                          fill=self.foreground)
+                y += box[3] - box[1] + spacing
+        else:
+            image = content.convert('RGB')
+            if image.size != tuple(size):
+                image = image.resize(size, Image.LANCZOS)
+
+        out = io.BytesIO()
+        image.convert('P', palette=Image.ADAPTIVE, colors=256).save(out, format='GIF')
+        return out.getvalue()
+
+    def upload(self, ip_cam, content, display='internal', force=False):
+        """
+        Renders the content for the device and uploads it unless it is what was last pushed to the display.
+        :return: 'uploaded' or 'unchanged'
+        """
+        data = self.render(content, self.resolution(ip_cam, display))
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        key = (ip_cam.ip_address, display)
+        if not force and self._pushed.get(key) == digest:
+            return 'unchanged'
+        reply = json.loads(ip_cam.commands.display_upload_image(display, data))
+        if not reply.get('success'):
+            raise IOError('Upload failed: {reply}'.format(reply=reply))
+        self._pushed[key] = digest
+        return 'uploaded'
+
+    def push(self, ip_cams, content, display='internal', force=False):
+        """
+        Uploads the content to every device concurrently.
+        :return: dict ip address -> 'uploaded', 'unchanged' or the error
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='2n-display') as executor:
+            futures = dict((executor.submit(self.upload, ip_cam, content, display, force), ip_cam)
+                           for ip_cam in ip_cams)
+            for future, ip_cam in futures.items():
+                try:
+                    results[ip_cam.ip_address] = future.result()
+                except Exception as err:
+                    log.warning("{ip}: display upload failed: {err}".format(ip=ip_cam.ip_address, err=err))
+                    results[ip_cam.ip_address] = '{type}: {err}'.format(type=type(err).__name__, err=err)
+        return results
+
+    def clear(self, ip_cams, display='internal'):
+        """
+        Deletes the uploaded image from the displays.
+        :return: dict ip address -> display_delete_image reply or the error
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='2n-display') as executor:
+            futures = dict((executor.submit(ip_cam.commands.display_delete_image, display), ip_cam)
+                           for ip_cam in ip_cams)
+            for future, ip_cam in futures.items():
+                self.forget(ip_cam.ip_address, display)
+                try:
+                    results[ip_cam.ip_address] = future.result()
+                except Exception as err:
+                    results[ip_cam.ip_address] = '{type}: {err}'.format(type=type(err).__name__, err=err)
+        return results
+
+    def forget(self, device, display=None):
+        """
+        Drops what is known about the device's displays, e.g. after it restarted and cleared them.
+        """
+        with self._lock:
+            for key in [key for key in self._pushed if key[0] == device and display in (None, key[1])]:
+                del self._pushed[key]
+            for key in [key for key in self._resolutions if key[0] == device and display in (None, key[1])]:
+                del self._resolutions[key]
@@ -0,0 +1,117 @@
+"""
+Event listener keeping a log_subscribe channel open on a device and handing every pulled batch of events to the
+registered sinks.
+
+A sink is any callable taking (ip_cam, events), events being a list of event dicts. Large /api/log/pull replies are
+decoded while they are received and handed over in several batches. Sinks are called in the listener thread, in
+order, so slow sinks delay the next pull.
+
+Example:
+    listener = EventListener(ip_cam)
+    listener.add_sink(lambda ip_cam, events: print(ip_cam.ip_address, events))
+    listener.start()
+"""
+
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class EventListener(object):
+    """
+    :param ip_cam: device to listen to
+    :param include: include parameter of the first subscription (see CommandService.log_subscribe), later
+    re-subscriptions only include new events
+    :param filter: list of event types
+    :param timeout: long-poll timeout of /api/log/pull in seconds
+    :param retry: seconds to wait before re-subscribing after an error
+    :param budget: budget.MemoryBudget the batches are accounted to while the sinks run
+    """
+
+    def __init__(self, ip_cam, include=None, filter=None, timeout=60, retry=20, budget=None):
+        self.ip_cam = ip_cam
+        self.include = include
+        self.filter = filter
+        self.timeout = timeout
+        self.retry = retry
+        self.budget = budget
+        self.sinks = []
+        self.sid = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='2n-events-{ip}'.format(ip=self.ip_cam.ip_address),
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self):
+        return not self._stop.is_set()
+
+    def resubscribe(self):
+        """
+        Drops the current channel, the next loop iteration opens a new one (e.g. after a device restart).
+        """
+        self.sid = None
+
+    def run(self):
+        include = self.include
+        while not self._stop.is_set():
+            try:
+                if self.sid is None:
+                    data = json.loads(self.ip_cam.commands.log_subscribe(include=include, filter=self.filter,
+                                                                         duration=self.timeout + 10))
+                    if not data.get('success'):
+                        raise Exception('Invalid subscription response: {err}'.format(err=data))
+                    self.sid = data['result']['id']
+                    include = None
+                    log.debug("{ip}: subscribed, sid={sid}".format(ip=self.ip_cam.ip_address, sid=self.sid))
+
+                # events are handed to the sinks chunk by chunk while a large reply is still being received
+                for events in self.ip_cam.commands.log_pull_events(self.sid, timeout=self.timeout, batches=True):
+                    self.dispatch(events)
+            except Exception as err:
+                log.warning("{ip}: {err}, retrying in {sec} seconds".format(ip=self.ip_cam.ip_address, err=err,
+                                                                            sec=self.retry))
+                self.sid = None
+                self._stop.wait(self.retry)
+
+        if self.sid is not None:
+            try:
+                self.ip_cam.commands.log_unsubscribe(self.sid)
+            except Exception as err:
+                log.debug("{ip}: unsubscribe failed: {err}".format(ip=self.ip_cam.ip_address, err=err))
+            self.sid = None
+
+    def dispatch(self, events):
+        size = 0
+        if self.budget is not None:
+            size = len(json.dumps(events, separators=(',', ':')))
+            self.budget.charge(size)
+        try:
+            for sink in self.sinks:
+                try:
+                    sink(self.ip_cam, events)
+                except Exception as err:
+                    log.exception("{ip}: event sink {sink} failed: {err}".format(ip=self.ip_cam.ip_address,
+                                                                                 sink=sink, err=err))
+        finally:
+            if size:
+                self.budget.discharge(size)
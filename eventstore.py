@@ -0,0 +1,372 @@
+"""
+Append-only event store for events pulled with /api/log/pull.
+
+Events are written into segment files with a compact binary record layout. Every segment has an index on device,
+event type and utcTime, so queries like "all CardEntered on device X last week" only touch matching records. Sealed
+segments and their indexes are read through memory maps.
+
+Example:
+    store = EventStore('/var/lib/2n/events')
+    listener = EventListener(ip_cam)
+    listener.add_sink(store)
+    ...
+    for event in store.query(device='192.168.0.2', event='CardEntered', since=time.time() - 7 * 86400):
+        print(event)
+
+Record layout (little endian):
+    length uint32 (whole record), crc32 uint32 (of everything after this field), utcTime int64, upTime uint32,
+    event id uint32, device code uint32, event type code uint16, params as compact JSON
+Device names and event types are interned, the code tables are kept in names.json.
+
+Index file layout: uint32 length and a JSON header with the segment summary and the (start, count) position of every
+posting list, followed by the int64 arrays: record offsets per device, per event type, and utcTime/offset pairs
+sorted by time.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+
+log = logging.getLogger(__name__)
+
+RECORD = struct.Struct('<IIqIIIH')
+_LENGTH = struct.Struct('<I')
+
+
+class _Segment(object):
+    def __init__(self, directory, number):
+        self.number = number
+        self.data_path = os.path.join(directory, '{0:08d}.seg'.format(number))
+        self.index_path = os.path.join(directory, '{0:08d}.idx'.format(number))
+        self.sealed = False
+        self.count = 0
+        self.min_utc = None
+        self.max_utc = None
+        self.size = 0
+        self.devices = {}
+        self.types = {}
+        self.times = []
+        self.time_offsets = []
+        self._mmap = None
+        self._mapped = 0
+        self._index_mmap = None
+
+    def add(self, offset, utc, device, etype):
+        self.devices.setdefault(device, []).append(offset)
+        self.types.setdefault(etype, []).append(offset)
+        self.times.append(utc)
+        self.time_offsets.append(offset)
+        self.count += 1
+        self.min_utc = utc if self.min_utc is None else min(self.min_utc, utc)
+        self.max_utc = utc if self.max_utc is None else max(self.max_utc, utc)
+
+    def data(self):
+        if self._mmap is None or self._mapped < self.size:
+            # the previous map is not closed: running queries still read it, it is unmapped with its last reference
+            with open(self.data_path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._mapped = self.size
+        return self._mmap
+
+    def seal(self):
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        values = array('q')
+        header = {'count': self.count, 'min_utc': self.min_utc, 'max_utc': self.max_utc, 'size': self.size,
+                  'devices': {}, 'types': {}}
+        for name, table in (('devices', self.devices), ('types', self.types)):
+            for code, offsets in table.items():
+                header[name][str(code)] = [len(values), len(offsets)]
+                values.extend(offsets)
+        header['times'] = [len(values), len(order)]
+        values.extend(self.times[i] for i in order)
+        values.extend(self.time_offsets[i] for i in order)
+
+        payload = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        padding = (-(4 + len(payload))) % 8
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_LENGTH.pack(len(payload) + padding))
+            f.write(payload + b' ' * padding)
+            f.write(values.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.index_path)
+        self._load_index()
+
+    def _load_index(self):
+        with open(self.index_path, 'rb') as f:
+            self._index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (length,) = _LENGTH.unpack_from(self._index_mmap, 0)
+        header = json.loads(bytes(self._index_mmap[4:4 + length]).decode('utf-8'))
+        values = memoryview(self._index_mmap)[4 + length:].cast('q')
+        self.count = header['count']
+        self.min_utc = header['min_utc']
+        self.max_utc = header['max_utc']
+        self.size = header['size']
+        self.devices = dict((int(k), values[s:s + n]) for k, (s, n) in header['devices'].items())
+        self.types = dict((int(k), values[s:s + n]) for k, (s, n) in header['types'].items())
+        start, n = header['times']
+        self.times = values[start:start + n]
+        self.time_offsets = values[start + n:start + 2 * n]
+        self.sealed = True
+
+    def open_sealed(self):
+        self._load_index()
+
+    def recover(self):
+        """
+        Rebuilds the in-memory index of an unsealed segment and cuts off a torn tail.
+        """
+        with open(self.data_path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, crc, utc, _, _, device, etype = RECORD.unpack_from(data, offset)
+            if length < RECORD.size or offset + length > len(data) or \
+                    zlib.crc32(data[offset + 8:offset + length]) != crc:
+                break
+            self.add(offset, utc, device, etype)
+            offset += length
+        if offset != len(data):
+            log.warning("Truncating torn tail of {path} at {offset}".format(path=self.data_path, offset=offset))
+            with open(self.data_path, 'r+b') as f:
+                f.truncate(offset)
+        self.size = offset
+
+    def release(self):
+        """
+        Drops the maps without closing them, queries still reading the segment keep them alive.
+        """
+        self._mmap = self._index_mmap = None
+
+    def close(self):
+        for m in (self._mmap, self._index_mmap):
+            if m is not None:
+                try:
+                    m.close()
+                except BufferError:
+                    pass  # index views still referenced by a caller
+        self._mmap = self._index_mmap = None
+
+
+class EventStore(object):
+    """
+    :param directory: store directory, created if missing
+    :param segment_size: segments are sealed and a new one is started when they reach this size in bytes
+    :param fsync_interval: maximum seconds an appended event stays unsynced (0 syncs every append call); when no
+    further appends come, a timer syncs the last ones
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.RLock()
+        self._names_path = os.path.join(directory, 'names.json')
+        self.device_names = []
+        self.type_names = []
+        if os.path.exists(self._names_path):
+            with open(self._names_path) as f:
+                names = json.load(f)
+            self.device_names = names['devices']
+            self.type_names = names['types']
+        self._device_codes = dict((name, i) for i, name in enumerate(self.device_names))
+        self._type_codes = dict((name, i) for i, name in enumerate(self.type_names))
+
+        self.segments = []
+        numbers = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.seg'))
+        for number in numbers:
+            segment = _Segment(directory, number)
+            if os.path.exists(segment.index_path):
+                segment.open_sealed()
+            else:
+                segment.recover()
+            self.segments.append(segment)
+        if not self.segments or self.segments[-1].sealed:
+            self.segments.append(_Segment(directory, numbers[-1] + 1 if numbers else 1))
+        self._active = self.segments[-1]
+        for segment in self.segments[:-1]:
+            if not segment.sealed:
+                segment.seal()
+        self._file = open(self._active.data_path, 'ab')
+        self._last_sync = time.monotonic()
+        self._dirty = False
+        self._timer = None
+
+    # --- write path ---
+
+    def __call__(self, ip_cam, events):
+        """
+        Event sink interface, see events.EventListener.
+        """
+        self.append_many(ip_cam.ip_address, events)
+
+    def append(self, device, event):
+        self.append_many(device, [event])
+
+    def append_many(self, device, events):
+        with self._lock:
+            device_code = self._intern(self._device_codes, self.device_names, device)
+            write = self._file.write
+            segment = self._active
+            for event in events:
+                type_code = self._intern(self._type_codes, self.type_names, event['event'])
+                params = json.dumps(event.get('params', {}), separators=(',', ':')).encode('utf-8')
+                utc = int(event.get('utcTime', 0))
+                body = RECORD.pack(RECORD.size + len(params), 0, utc, int(event.get('upTime', 0)),
+                                   int(event.get('id', 0)), device_code, type_code) + params
+                crc = zlib.crc32(memoryview(body)[8:])
+                record = body[:4] + _LENGTH.pack(crc) + body[8:]
+                write(record)
+                segment.add(segment.size, utc, device_code, type_code)
+                segment.size += len(record)
+            self._dirty = True
+            if segment.size >= self.segment_size:
+                self._roll()
+            elif time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.fsync_interval, self._timed_sync)
+                self._timer.name = '2n-eventstore-sync'
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _timed_sync(self):
+        with self._lock:
+            self._timer = None
+            if not self._file.closed:
+                self.sync()
+
+    def _intern(self, codes, names, name):
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(names)
+            names.append(name)
+            tmp = self._names_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'devices': self.device_names, 'types': self.type_names}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self._names_path)
+        return code
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._dirty = False
+            self._last_sync = time.monotonic()
+
+    def _roll(self):
+        self.sync()
+        self._file.close()
+        self._active.seal()
+        self._active = _Segment(self.directory, self._active.number + 1)
+        self.segments.append(self._active)
+        self._file = open(self._active.data_path, 'ab')
+
+    def drop_before(self, utc):
+        """
+        Deletes sealed segments holding only events older than utc.
+        :return: number of deleted segments
+        """
+        with self._lock:
+            dropped = [s for s in self.segments if s.sealed and s.max_utc is not None and s.max_utc < utc]
+            for segment in dropped:
+                segment.release()
+                os.unlink(segment.data_path)
+                os.unlink(segment.index_path)
+                self.segments.remove(segment)
+            return len(dropped)
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.sync()
+            self._file.close()
+            for segment in self.segments:
+                segment.close()
+
+    # --- read path ---
+
+    def query(self, device=None, event=None, since=None, until=None, limit=None):
+        """
+        Yields stored events matching all given criteria as dicts with an additional 'device' key.
+        Events are returned in the order they were stored.
+
+        :param device: device name as given to append (ip_address for listener sinks)
+        :param event: event type, e.g. 'CardEntered'
+        :param since: minimum utcTime (inclusive)
+        :param until: maximum utcTime (inclusive)
+        :param limit: maximum number of events returned
+        """
+        with self._lock:
+            if self._dirty:
+                self._file.flush()
+            device_code = self._device_codes.get(device) if device is not None else None
+            type_code = self._type_codes.get(event) if event is not None else None
+            if (device is not None and device_code is None) or (event is not None and type_code is None):
+                return
+            segments = [s for s in self.segments if s.count and
+                        (since is None or s.max_utc >= since) and (until is None or s.min_utc <= until)]
+            snapshots = [(s, s.data(), self._candidates(s, device_code, type_code, since, until)) for s in segments]
+
+        found = 0
+        for segment, data, offsets in snapshots:
+            for offset in offsets:
+                length, _, utc, uptime, event_id, dcode, tcode = RECORD.unpack_from(data, offset)
+                if device_code is not None and dcode != device_code:
+                    continue
+                if type_code is not None and tcode != type_code:
+                    continue
+                if (since is not None and utc < since) or (until is not None and utc > until):
+                    continue
+                yield {
+                    'device': self.device_names[dcode],
+                    'id': event_id,
+                    'utcTime': utc,
+                    'upTime': uptime,
+                    'event': self.type_names[tcode],
+                    'params': json.loads(bytes(data[offset + RECORD.size:offset + length]).decode('utf-8'))
+                }
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def count(self, device=None, event=None, since=None, until=None):
+        return sum(1 for _ in self.query(device, event, since, until))
+
+    @staticmethod
+    def _candidates(segment, device_code, type_code, since, until):
+        lists = []
+        if device_code is not None:
+            lists.append(segment.devices.get(device_code, ()))
+        if type_code is not None:
+            lists.append(segment.types.get(type_code, ()))
+        if lists:
+            # the shortest posting list drives the scan, the other criteria are checked on the record header
+            return list(min(lists, key=len))
+        if since is None and until is None:
+            return sorted(segment.time_offsets)
+        times = segment.times
+        if not segment.sealed:
+            order = sorted(range(len(times)), key=times.__getitem__)
+            times = [segment.times[i] for i in order]
+            offsets = [segment.time_offsets[i] for i in order]
+        else:
+            offsets = segment.time_offsets
+        lo = bisect_left(times, since) if since is not None else 0
+        hi = bisect_right(times, until) if until is not None else len(times)
+        return sorted(offsets[lo:hi])
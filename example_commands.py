@@ -1,10 +1,7 @@
 import json
 from time import sleep
-import requests
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from core import IPCam
-
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+from httptransport import HTTPClientTransport
 
 
 '''
@@ -19,7 +16,9 @@ ip = '192.168.0.2'
 ssl = True
 auth_type = 2  # 0=None, 1=Basic, 2=Digest
 
-ip_cam = IPCam(ip, ssl=ssl, auth_type=2, user=username, password=password)
+# the standard library transport keeps the script free of requests/urllib3 (and of their InsecureRequestWarning
+# for the device's self-signed certificate)
+ip_cam = IPCam(ip, ssl=ssl, auth_type=2, user=username, password=password, transport=HTTPClientTransport())
 
 # For the complete list of commands anf their description please take a look
 # to commands.py within the CommandService class.
@@ -0,0 +1,344 @@
+"""
+Local event fan-out server.
+
+One process owns the log_subscribe channels of the devices (one EventListener, i.e. one long-poll, per device) and
+republishes the events to any number of local clients, so access control, UI backend and audit logger no longer
+each subscribe on the device.
+
+Clients connect over
+ - a Unix domain socket: the client sends one length-prefixed JSON subscription, e.g.
+   {"devices": ["10.0.0.5"], "events": ["CardEntered", "CodeEntered"]} ({} for everything), and then receives one
+   length-prefixed JSON object per event (the event dict with an added "device" key). Lengths are uint32, big endian.
+   An invalid subscription is answered with one {"error": ...} object and the connection is closed.
+ - HTTP Server-Sent Events: GET /events?devices=10.0.0.5,10.0.0.6&events=CardEntered
+Every event is encoded once, however many clients receive it. A client whose unsent data exceeds max_buffer bytes
+is disconnected instead of letting the server buffer grow.
+
+Example:
+    server = FanoutServer(ip_cams, unix_path='/run/2n-events.sock', http_address=('127.0.0.1', 8081))
+    server.start_in_thread()
+
+    for event in subscribe('/run/2n-events.sock', events=['CardEntered']):     # in another process
+        print(event['device'], event['params'])
+
+Run "python fanout.py --help" to start it stand-alone.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+log = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct('>I')
+MAX_SUBSCRIPTION = 64 * 1024
+
+
+class _Client(object):
+    __slots__ = ('writer', 'devices', 'events', 'sse', 'name')
+
+    def __init__(self, writer, devices, events, sse, name):
+        self.writer = writer
+        self.devices = frozenset(devices) if devices else None
+        self.events = frozenset(events) if events else None
+        self.sse = sse
+        self.name = name
+
+    def wants(self, device, event):
+        return (self.devices is None or device in self.devices) and \
+               (self.events is None or event.get('event') in self.events)
+
+
+class FanoutServer(object):
+    """
+    :param devices: iterable of IPCam to subscribe to
+    :param unix_path: path of the Unix domain socket (None: no socket)
+    :param http_address: (host, port) of the SSE endpoint (None: no HTTP)
+    :param max_buffer: bytes a client may have unsent before it is disconnected
+    :param heartbeat: seconds between SSE keep-alive comments
+    :param include, filter, timeout, retry: see events.EventListener
+    """
+
+    def __init__(self, devices, unix_path=None, http_address=None, max_buffer=1024 * 1024, heartbeat=15,
+                 include=None, filter=None, timeout=60, retry=20):
+        from events import EventListener
+
+        self.unix_path = unix_path
+        self.http_address = http_address
+        self.max_buffer = max_buffer
+        self.heartbeat = heartbeat
+        self.listeners = []
+        for ip_cam in devices:
+            listener = EventListener(ip_cam, include=include, filter=filter, timeout=timeout, retry=retry)
+            listener.add_sink(self)
+            self.listeners.append(listener)
+        self.clients = set()
+        self.published = 0
+        self.disconnected = 0
+        self.loop = None
+        self._servers = []
+        self._connections = set()
+        self._thread = None
+        self._ready = threading.Event()
+
+    # --- intake, called in the listener threads ---
+
+    def __call__(self, ip_cam, events):
+        loop = self.loop
+        if loop is not None and self.clients:
+            loop.call_soon_threadsafe(self._publish, ip_cam.ip_address, events)
+
+    def _publish(self, device, events):
+        self.published += len(events)
+        for event in events:
+            frame = sse = None
+            for client in list(self.clients):
+                if not client.wants(device, event):
+                    continue
+                if frame is None:
+                    payload = json.dumps(dict(event, device=device), separators=(',', ':')).encode('utf-8')
+                    frame = _LENGTH.pack(len(payload)) + payload
+                if client.sse:
+                    if sse is None:
+                        sse = b'event: ' + str(event.get('event')).encode('utf-8') + b'\ndata: ' + frame[4:] + \
+                              b'\n\n'
+                    self._send(client, sse)
+                else:
+                    self._send(client, frame)
+
+    def _send(self, client, data):
+        transport = client.writer.transport
+        if transport.is_closing():
+            self.clients.discard(client)
+            return
+        if transport.get_write_buffer_size() + len(data) > self.max_buffer:
+            log.warning("Disconnecting slow client {name}".format(name=client.name))
+            self.disconnected += 1
+            self.clients.discard(client)
+            transport.abort()
+            return
+        client.writer.write(data)
+
+    # --- clients ---
+
+    def _track(self):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+
+    async def _serve_unix(self, reader, writer):
+        self._track()
+        try:
+            (length,) = _LENGTH.unpack(await reader.readexactly(4))
+            if length > MAX_SUBSCRIPTION:
+                raise ValueError('subscription too large')
+            devices, events = _subscription(
+                json.loads((await reader.readexactly(length)).decode('utf-8')) if length else {})
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            log.debug("Incomplete subscription: {err}".format(err=err))
+            writer.close()
+            return
+        except ValueError as err:
+            log.debug("Invalid subscription: {err}".format(err=err))
+            payload = json.dumps({'error': 'Invalid subscription: {err}'.format(err=err)}).encode('utf-8')
+            writer.write(_LENGTH.pack(len(payload)) + payload)
+            writer.close()
+            return
+        client = _Client(writer, devices, events, False, 'unix:{n}'.format(n=id(writer)))
+        await self._attach(client, reader)
+
+    async def _serve_http(self, reader, writer):
+        self._track()
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        line = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+        if len(line) != 3 or not line[2].startswith('HTTP/'):
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        method, target = line[:2]
+        url = urlsplit(target)
+        if method != 'GET' or url.path != '/events':
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        query = dict(parse_qsl(url.query))
+        devices = [d for d in query.get('devices', '').split(',') if d]
+        events = [e for e in query.get('events', '').split(',') if e]
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                     b'Connection: keep-alive\r\n\r\n')
+        peer = writer.get_extra_info('peername')
+        client = _Client(writer, devices, events, True, 'sse:{peer}'.format(peer=peer))
+        await self._attach(client, reader)
+
+    async def _attach(self, client, reader):
+        self.clients.add(client)
+        log.info("Client {name} connected ({n} clients)".format(name=client.name, n=len(self.clients)))
+        try:
+            while client in self.clients:
+                try:
+                    # clients do not send anything after the subscription, reading only detects disconnects
+                    if not await asyncio.wait_for(reader.read(1024), self.heartbeat):
+                        break
+                except asyncio.TimeoutError:
+                    if client.sse:
+                        self._send(client, b': keep-alive\n\n')
+                except ConnectionError:
+                    break
+        finally:
+            self.clients.discard(client)
+            client.writer.close()
+            log.info("Client {name} disconnected".format(name=client.name))
+
+    # --- lifecycle ---
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.unix_path is not None:
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            self._servers.append(await asyncio.start_unix_server(self._serve_unix, self.unix_path))
+        if self.http_address is not None:
+            self._servers.append(await asyncio.start_server(self._serve_http, self.http_address[0],
+                                                            self.http_address[1]))
+        for listener in self.listeners:
+            listener.start()
+
+    async def close(self):
+        for listener in self.listeners:
+            listener.stop(wait=False)
+        for server in self._servers:
+            server.close()
+        for client in list(self.clients):
+            client.writer.close()
+        self.clients.clear()
+        connections = list(self._connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+
+    def start_in_thread(self):
+        """
+        Runs the server in a daemon thread and returns once it is listening.
+        """
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            self._ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.close())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name='2n-fanout', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None and self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+            self.loop = None
+
+    def stats(self):
+        return {'clients': len(self.clients), 'published': self.published, 'disconnected': self.disconnected,
+                'subscribed': sum(1 for listener in self.listeners if listener.sid is not None)}
+
+
+def _subscription(spec):
+    """
+    :return: (devices, events) of a Unix socket subscription, lists of str or None
+    :raise ValueError: the subscription is not an object with optional lists of strings
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('subscription must be a JSON object')
+    result = []
+    for name in ('devices', 'events'):
+        values = spec.get(name)
+        if values is not None and (not isinstance(values, list) or
+                                   not all(isinstance(value, str) for value in values)):
+            raise ValueError('{name} must be a list of strings'.format(name=name))
+        result.append(values)
+    return tuple(result)
+
+
+def subscribe(path, devices=None, events=None, timeout=None):
+    """
+    Client of the Unix domain socket protocol.
+    Yields the event dicts (with a "device" key) sent by a FanoutServer.
+
+    :raise ValueError: the server rejected the subscription
+    """
+    spec = {}
+    if devices:
+        spec['devices'] = list(devices)
+    if events:
+        spec['events'] = list(events)
+    payload = json.dumps(spec).encode('utf-8')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(_LENGTH.pack(len(payload)) + payload)
+        stream = sock.makefile('rb')
+        while True:
+            header = stream.read(4)
+            if len(header) < 4:
+                return
+            (length,) = _LENGTH.unpack(header)
+            message = json.loads(stream.read(length).decode('utf-8'))
+            if 'error' in message and 'device' not in message:
+                raise ValueError(message['error'])
+            yield message
+
+
+def main():
+    from core import IPCam
+    from transport import PooledTransport
+
+    parser = argparse.ArgumentParser(description='Event fan-out server for 2N devices')
+    parser.add_argument('devices', nargs='+', help='device ip addresses')
+    parser.add_argument('--socket', default='/tmp/2n-events.sock', help='Unix domain socket path')
+    parser.add_argument('--http', default=None, help='host:port of the SSE endpoint')
+    parser.add_argument('--auth', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('--max-buffer', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pool = PooledTransport(hosts=len(args.devices))
+    ip_cams = [IPCam(ip, ssl=args.ssl, auth_type=args.auth, user=args.user, password=args.password, transport=pool)
+               for ip in args.devices]
+    http_address = None
+    if args.http:
+        host, _, port = args.http.rpartition(':')
+        http_address = (host or '127.0.0.1', int(port))
+    server = FanoutServer(ip_cams, unix_path=args.socket, http_address=http_address, max_buffer=args.max_buffer)
+
+    async def run():
+        await server.start()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
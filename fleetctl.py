@@ -0,0 +1,253 @@
+"""
+Command line tool running a CommandService endpoint against many devices at once.
+
+The devices come from a file (one address per line, '#' starts a comment, '-' reads stdin), from an inventory
+database or from --device options. The calls run concurrently (--concurrency) and every device's result is written
+to stdout as one JSON line as soon as it is available, so the output can be piped into jq, grep etc. while the run
+is still going. A summary goes to stderr and the exit status is 1 if any device failed.
+
+Endpoint arguments are given positionally or as name=value; values are parsed as JSON where possible (1, true, null)
+and passed as strings otherwise. The file-producing endpoints config_get, camera_snapshot and pcap write to a path
+built from --output per device.
+
+Example:
+    python -m fleetctl --devices intercoms.txt --auth 2 --user admin --password secret system_status
+    python -m fleetctl --devices intercoms.txt --concurrency 200 switch_control 1 on
+    python -m fleetctl --inventory /var/lib/2n/inventory.db --output 'backup/{date}/{device}.xml' config_get
+    python -m fleetctl --devices intercoms.txt camera_snapshot width=640 height=480 | jq -c 'select(.ok | not)'
+
+Output line: {"device": ..., "ok": true, "elapsed_ms": ..., "result": <reply>, "file": ..., "bytes": ...}
+or {"device": ..., "ok": false, "elapsed_ms": ..., "error": ...}
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from commands import CommandService
+
+log = logging.getLogger(__name__)
+
+# endpoint -> (parameter taking the target file, default extension)
+FILE_ENDPOINTS = {
+    'config_get': ('filename', 'xml'),
+    'camera_snapshot': ('filename', 'jpg'),
+    'pcap': ('pcap_file', 'pcap')
+}
+
+_NOT_ENDPOINTS = ('add_hook', 'remove_hook', 'camera_snapshot_data', 'config_data')
+
+
+def endpoints():
+    """
+    :return: dict name -> function of the CommandService endpoints usable from the command line
+    """
+    return dict((name, function) for name, function in inspect.getmembers(CommandService, inspect.isfunction)
+                if not name.startswith('_') and name not in _NOT_ENDPOINTS)
+
+
+def read_devices(path):
+    """
+    :return: list of device addresses in the file ('-' for stdin), duplicates removed
+    """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        addresses = []
+        seen = set()
+        for line in f:
+            address = line.split('#', 1)[0].strip()
+            if address and address not in seen:
+                seen.add(address)
+                addresses.append(address)
+        return addresses
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def parse_arguments(function, values):
+    """
+    Maps the command line values onto the endpoint's parameters.
+    :return: dict of keyword arguments
+    """
+    names = list(inspect.signature(function).parameters)[1:]  # without self
+    kwargs = {}
+    position = 0
+    for value in values:
+        name, separator, text = value.partition('=')
+        if not separator or name not in names:
+            if position >= len(names):
+                raise ValueError("Too many arguments for {function}".format(function=function.__name__))
+            name, text = names[position], value
+            position += 1
+        try:
+            kwargs[name] = json.loads(text)
+        except ValueError:
+            kwargs[name] = text
+    return kwargs
+
+
+def output_path(template, device, endpoint, extension):
+    """
+    Target file of a file-producing endpoint, the directories are created.
+
+    :param template: path with the placeholders {device} (address, ':' replaced by '_'), {endpoint}, {ext} and
+    {date} (YYYY-MM-DD)
+    """
+    path = os.path.abspath(template.format(device=device.replace(':', '_'), endpoint=endpoint, ext=extension,
+                                           date=time.strftime('%Y-%m-%d')))
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    return path
+
+
+def run(ip_cams, endpoint, kwargs, output='{device}.{ext}', concurrency=64, emit=None):
+    """
+    Calls the endpoint on all devices concurrently.
+
+    :param output: path template for file-producing endpoints, see output_path
+    :param emit: called with every result dict as soon as the device answered (or failed)
+    :return: (number of successful devices, number of failed devices)
+    """
+    function = endpoints()[endpoint]
+    file_parameter, extension = FILE_ENDPOINTS.get(endpoint, (None, None))
+
+    def call(ip_cam):
+        device = ip_cam.ip_address
+        arguments = dict(kwargs)
+        result = {'device': device}
+        started = time.perf_counter()
+        try:
+            if file_parameter is not None:
+                arguments[file_parameter] = result['file'] = output_path(output, device, endpoint, extension)
+            reply = function(ip_cam.commands, **arguments)
+            if inspect.isgenerator(reply):
+                reply = list(reply)
+            if isinstance(reply, str):
+                try:
+                    reply = json.loads(reply)
+                except ValueError:
+                    pass
+            result['ok'] = not isinstance(reply, dict) or reply.get('success', True) is not False
+            result['result'] = reply
+            if file_parameter is not None and result['ok']:
+                result['bytes'] = os.path.getsize(result['file'])
+        except Exception as err:
+            result['ok'] = False
+            result['error'] = str(err) or type(err).__name__
+        result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    succeeded = failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='2n-fleetctl') as executor:
+        futures = [executor.submit(call, ip_cam) for ip_cam in ip_cams]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if result['ok']:
+                    succeeded += 1
+                else:
+                    failed += 1
+                if emit is not None:
+                    emit(result)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return succeeded, failed
+
+
+class _LineWriter(object):
+    """
+    Writes NDJSON lines to a stream, flushed per line so that a consumer sees every device right away.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, result):
+        line = json.dumps(result, separators=(',', ':'), sort_keys=True) + '\n'
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+def main():
+    names = sorted(endpoints())
+    parser = argparse.ArgumentParser(prog='python -m fleetctl',
+                                     description='Run a 2N HTTP API endpoint on many devices, one JSON line per '
+                                                 'device on stdout')
+    parser.add_argument('endpoint', nargs='?', choices=names, metavar='endpoint',
+                        help='CommandService method, e.g. system_status or switch_control (see --list)')
+    parser.add_argument('arguments', nargs='*', help='endpoint arguments, positional or name=value')
+    parser.add_argument('--devices', help="file with one device address per line, '-' for stdin")
+    parser.add_argument('--inventory', help='inventory database, all devices in it are used')
+    parser.add_argument('--device', action='append', default=[], help='device address, can be repeated')
+    parser.add_argument('--auth', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('--concurrency', type=int, default=64, help='devices called at the same time')
+    parser.add_argument('--timeout', type=float, default=10, help='network timeout per request in seconds')
+    parser.add_argument('--output', default='{device}.{ext}',
+                        help='target path of config_get, camera_snapshot and pcap; placeholders {device}, '
+                             '{endpoint}, {ext}, {date}')
+    parser.add_argument('--list', action='store_true', help='list the endpoints and their parameters and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name in names:
+            print('{name} {parameters}'.format(
+                name=name, parameters=' '.join(list(inspect.signature(endpoints()[name]).parameters)[1:])))
+        return
+    if args.endpoint is None:
+        parser.error('the endpoint is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    addresses = list(args.device)
+    if args.devices:
+        addresses.extend(address for address in read_devices(args.devices) if address not in addresses)
+    if args.inventory:
+        from inventory import Inventory
+        inventory = Inventory(args.inventory)
+        addresses.extend(address for address in sorted(inventory.addresses) if address not in addresses)
+        inventory.close()
+    if not addresses:
+        parser.error('no devices, use --devices, --inventory or --device')
+    try:
+        kwargs = parse_arguments(endpoints()[args.endpoint], args.arguments)
+    except ValueError as err:
+        parser.error(str(err))
+
+    from core import IPCam
+    from httptransport import HTTPClientTransport
+
+    transport = HTTPClientTransport(hosts=len(addresses), pool_size=1, timeout=args.timeout)
+    ip_cams = [IPCam(address, ssl=args.ssl, auth_type=args.auth, user=args.user, password=args.password,
+                     transport=transport) for address in addresses]
+    started = time.perf_counter()
+    try:
+        succeeded, failed = run(ip_cams, args.endpoint, kwargs, output=args.output, concurrency=args.concurrency,
+                                emit=_LineWriter(sys.stdout))
+    except BrokenPipeError:
+        # the consumer went away (e.g. head), keep the interpreter from failing on the final flush
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except KeyboardInterrupt:
+        os._exit(130)
+    log.info("{n} devices, {ok} ok, {failed} failed in {sec:.2f} s".format(
+        n=len(ip_cams), ok=succeeded, failed=failed, sec=time.perf_counter() - started))
+    transport.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
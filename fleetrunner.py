@@ -0,0 +1,326 @@
+"""
+Multi-process fleet runner.
+
+Devices are split across worker processes so that event decoding, sinks running in the workers (rules, stores, ...)
+and TLS use all CPU cores instead of contending for one interpreter lock. Each worker has its own PooledTransport and
+one EventListener per device of its shard. Events are collected in the worker and sent to the coordinator in batches
+over a pipe, together with the worker's metrics, and handed to the coordinator's sinks there.
+
+Devices are assigned with rendezvous hashing: a device goes to the live worker with the highest hash of (device,
+worker). When a worker dies only its devices move to the remaining workers, and when the replacement is up only the
+devices hashing to it move back. Devices that move open a new subscription on their new worker.
+
+Example:
+    def setup(worker):                        # runs in every worker process, must be importable
+        return [RuleEngine(load_rules())]
+
+    runner = FleetRunner(ip_cams, workers=8, setup=setup)
+    runner.add_sink(lambda ip_cam, events: print(ip_cam.ip_address, len(events)))
+    runner.start()
+    ...
+    print(runner.stats())
+    runner.stop()
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import wait
+
+log = logging.getLogger(__name__)
+
+
+def _score(device, slot):
+    return hashlib.blake2b('{device}/{slot}'.format(device=device, slot=slot).encode('utf-8'),
+                           digest_size=8).digest()
+
+
+def assign(devices, slots):
+    """
+    Rendezvous hashing of device addresses to worker slots.
+    :return: dict slot -> list of devices
+    """
+    shards = dict((slot, []) for slot in slots)
+    for device in devices:
+        shards[max(slots, key=lambda slot: _score(device, slot))].append(device)
+    return shards
+
+
+def _spec(ip_cam):
+    return {'ip': ip_cam.ip_address, 'ssl': ip_cam.ssl, 'auth_type': ip_cam.auth_type, 'user': ip_cam.user,
+            'password': ip_cam.password}
+
+
+class _Worker(object):
+    """
+    Runs in the worker process: listeners of the shard, local sinks and the batch pipe to the coordinator.
+    """
+
+    def __init__(self, slot, conn, options):
+        from transport import PooledTransport
+
+        self.slot = slot
+        self.conn = conn
+        self.options = options
+        self.transport = PooledTransport(hosts=options['pool_hosts'])
+        self.listeners = {}
+        self.sinks = list(options['setup'](self)) if options['setup'] is not None else []
+        self.pending = []
+        self.pending_events = 0
+        self.events = 0
+        self.errors = 0
+        self._last_sent = 0.0
+        self._lock = threading.Lock()
+
+    def run(self):
+        flush_interval = self.options['flush_interval']
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, flush_interval - (time.monotonic() - last_flush))
+            if self.conn.poll(timeout):
+                message = self.conn.recv()
+                if message[0] == 'assign':
+                    self.assign(message[1])
+                elif message[0] == 'stop':
+                    break
+            if time.monotonic() - last_flush >= flush_interval or self.pending_events >= self.options['batch']:
+                self.flush()
+                last_flush = time.monotonic()
+        for listener in self.listeners.values():
+            listener.stop(wait=False)
+        self.flush()
+        self.conn.send(('stopped', self.slot))
+
+    def assign(self, specs):
+        from core import IPCam
+        from events import EventListener
+
+        wanted = dict((spec['ip'], spec) for spec in specs)
+        for address in [address for address in self.listeners if address not in wanted]:
+            self.listeners.pop(address).stop(wait=False)
+        for address, spec in wanted.items():
+            if address in self.listeners:
+                continue
+            ip_cam = IPCam(spec['ip'], ssl=spec['ssl'], auth_type=spec['auth_type'], user=spec['user'],
+                           password=spec['password'], transport=self.transport)
+            listener = EventListener(ip_cam, include=self.options['include'], filter=self.options['filter'],
+                                     timeout=self.options['timeout'], retry=self.options['retry'])
+            listener.add_sink(self.sink)
+            self.listeners[address] = listener.start()
+        log.info("Worker {slot}: {n} devices".format(slot=self.slot, n=len(self.listeners)))
+
+    def sink(self, ip_cam, events):
+        for sink in self.sinks:
+            try:
+                sink(ip_cam, events)
+            except Exception as err:
+                self.errors += 1
+                log.exception("Worker {slot}: sink {sink} failed: {err}".format(slot=self.slot, sink=sink, err=err))
+        with self._lock:
+            self.events += len(events)
+            if self.options['forward']:
+                self.pending.append((ip_cam.ip_address, events))
+                self.pending_events += len(events)
+
+    def flush(self):
+        with self._lock:
+            if not self.pending and time.monotonic() - self._last_sent < 1.0:
+                return  # nothing to deliver, metrics are refreshed once a second
+            batch, self.pending, self.pending_events = self.pending, [], 0
+            metrics = {'pid': os.getpid(), 'devices': len(self.listeners), 'events': self.events,
+                       'errors': self.errors,
+                       'subscribed': sum(1 for listener in self.listeners.values() if listener.sid is not None)}
+            self._last_sent = time.monotonic()
+        # one pickled message per flush, however many devices contributed to it
+        self.conn.send(('batch', batch, metrics))
+
+
+def _worker_main(slot, conn, options):
+    logging.basicConfig(level=options['log_level'])
+    try:
+        _Worker(slot, conn, options).run()
+    except (EOFError, KeyboardInterrupt, BrokenPipeError):
+        pass  # coordinator is gone
+
+
+class FleetRunner(object):
+    """
+    :param devices: iterable of IPCam (their transports are not used, every worker creates its own)
+    :param workers: number of worker processes, all cores by default
+    :param setup: importable callable run in every worker with the worker object, returning the sinks run in the
+    worker (see events.EventListener for the sink protocol)
+    :param forward: send the events to the coordinator sinks as well
+    :param flush_interval: maximum seconds events wait in a worker before they are sent to the coordinator
+    :param batch: send earlier when this many events are waiting
+    :param respawn: replace dead workers
+    :param respawn_delay: seconds before a worker that died soon after its start is replaced, doubled with every
+    further early death of that worker up to max_respawn_delay
+    :param max_respawn_delay: maximum respawn delay; a worker that ran at least this long is replaced right away
+    :param include, filter, timeout, retry: see events.EventListener
+    """
+
+    def __init__(self, devices, workers=None, setup=None, forward=True, flush_interval=0.05, batch=1000,
+                 respawn=True, respawn_delay=1.0, max_respawn_delay=60.0, include=None, filter=None, timeout=60,
+                 retry=20):
+        self.devices = dict((ip_cam.ip_address, ip_cam) for ip_cam in devices)
+        self.size = workers or os.cpu_count() or 1
+        self.respawn = respawn
+        self.respawn_delay = respawn_delay
+        self.max_respawn_delay = max_respawn_delay
+        self.options = {'setup': setup, 'forward': forward, 'flush_interval': flush_interval, 'batch': batch,
+                        'include': include, 'filter': filter, 'timeout': timeout, 'retry': retry,
+                        'pool_hosts': max(16, len(self.devices) // self.size + 16),
+                        'log_level': logging.getLogger().level}
+        self.sinks = []
+        self.metrics = {}
+        self.shards = {}
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = {}  # slot -> (process, conn)
+        self._spawned = {}  # slot -> monotonic start time of its worker
+        self._failures = {}  # slot -> number of early deaths in a row
+        self._respawns = {}  # slot -> monotonic time its replacement is due
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def start(self):
+        self._stop.clear()
+        for slot in range(self.size):
+            self._spawn(slot)
+        self._rebalance()
+        self._thread = threading.Thread(target=self._run, name='2n-fleet', daemon=True)
+        self._thread.start()
+        return self
+
+    def _spawn(self, slot):
+        parent, child = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(slot, child, self.options),
+                                        name='2n-fleet-{slot}'.format(slot=slot), daemon=True)
+        process.start()
+        child.close()
+        self._spawned[slot] = time.monotonic()
+        self._workers[slot] = (process, parent)
+
+    def _rebalance(self):
+        with self._lock:
+            if not self._workers:
+                self.shards = {}  # all workers are waiting for their respawn
+                return
+            shards = assign(sorted(self.devices), sorted(self._workers))
+            for slot, addresses in shards.items():
+                if addresses != self.shards.get(slot):
+                    try:
+                        self._workers[slot][1].send(('assign', [_spec(self.devices[a]) for a in addresses]))
+                    except (OSError, EOFError):
+                        continue  # died meanwhile, handled by the next _run iteration
+                self.shards[slot] = addresses
+            for slot in [slot for slot in self.shards if slot not in self._workers]:
+                del self.shards[slot]
+
+    def _run(self):
+        while not self._stop.is_set():
+            conns = dict((conn, slot) for slot, (process, conn) in self._workers.items())
+            sentinels = dict((process.sentinel, slot) for slot, (process, conn) in self._workers.items())
+            if not conns:
+                self._stop.wait(0.5)
+            for ready in wait(list(conns) + list(sentinels), timeout=0.5) if conns else ():
+                if ready in conns:
+                    try:
+                        message = ready.recv()
+                    except (EOFError, OSError):
+                        continue  # the sentinel reports the death
+                    if message[0] == 'batch':
+                        self._deliver(conns[ready], message[1], message[2])
+                elif not self._stop.is_set():
+                    self._died(sentinels[ready])
+            now = time.monotonic()
+            due = [slot for slot, at in self._respawns.items() if at <= now]
+            if due and not self._stop.is_set():
+                for slot in due:
+                    del self._respawns[slot]
+                    self.restarts += 1
+                    self._spawn(slot)
+                self._rebalance()
+
+    def _died(self, slot):
+        process, conn = self._workers.pop(slot)
+        process.join()
+        conn.close()
+        self.metrics.pop(slot, None)
+        shard = self.shards.pop(slot, ())
+        log.warning("Worker {slot} (pid {pid}) died with exit code {code}, reassigning its {n} devices".format(
+            slot=slot, pid=process.pid, code=process.exitcode, n=len(shard)))
+        if self.respawn:
+            early = time.monotonic() - self._spawned.get(slot, 0.0) < self.max_respawn_delay
+            failures = self._failures[slot] = self._failures.get(slot, 0) + 1 if early else 0
+            delay = min(self.max_respawn_delay, self.respawn_delay * 2 ** (failures - 1)) if failures else 0.0
+            if delay:
+                log.warning("Worker {slot} died {n} times in a row shortly after starting, respawning in "
+                            "{delay:.1f}s".format(slot=slot, n=failures, delay=delay))
+            self._respawns[slot] = time.monotonic() + delay
+        elif not self._workers:
+            log.error("All workers died")
+            return
+        self._rebalance()
+
+    def _deliver(self, slot, batch, metrics):
+        metrics['updated'] = time.time()
+        self.metrics[slot] = metrics
+        for address, events in batch:
+            ip_cam = self.devices.get(address)
+            for sink in self.sinks:
+                try:
+                    sink(ip_cam, events)
+                except Exception as err:
+                    log.exception("{ip}: event sink {sink} failed: {err}".format(ip=address, sink=sink, err=err))
+
+    def stats(self):
+        """
+        :return: dict with per-worker metrics (last reported) and totals
+        """
+        workers = dict(self.metrics)
+        return {'workers': workers, 'alive': sum(1 for p, _ in self._workers.values() if p.is_alive()),
+                'restarts': self.restarts, 'devices': len(self.devices),
+                'events': sum(m['events'] for m in workers.values()),
+                'subscribed': sum(m['subscribed'] for m in workers.values())}
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._respawns = {}
+        for process, conn in self._workers.values():
+            try:
+                conn.send(('stop',))
+            except (OSError, EOFError):
+                pass
+        deadline = time.monotonic() + timeout
+        for slot, (process, conn) in self._workers.items():
+            # deliver what the worker flushed on its way out
+            while time.monotonic() < deadline:
+                try:
+                    if not conn.poll(max(0.0, deadline - time.monotonic())):
+                        break
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+                if message[0] == 'stopped':
+                    break
+                if message[0] == 'batch':
+                    self._deliver(slot, message[1], message[2])
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+        self._workers = {}
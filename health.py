@@ -0,0 +1,237 @@
+"""
+Adaptive fleet health monitor.
+
+Every device is probed with system_status on its own interval: a device that answers and has not restarted gets
+probed half as often after every probe (up to max_interval), a device that fails or has just restarted is probed
+again after min_interval. The probe load therefore follows the number of unstable devices rather than the fleet size.
+The first probes are spread over the initial interval by a hash of the address, and every interval gets some jitter,
+so probes do not line up into bursts.
+
+A restart is detected when upTime is lower than expected from the previous probe (it went down, or grew less than the
+time that passed). The device's capability cache is then invalidated, its event listener resubscribes and the
+registered restart handlers run. Reachability and round-trip times are kept per device.
+
+Example:
+    monitor = HealthMonitor(ip_cams, listeners=dict((l.ip_cam.ip_address, l) for l in listeners))
+    monitor.add_restart_handler(lambda ip_cam: display_pipeline.forget(ip_cam.ip_address))
+    monitor.start()
+    ...
+    print(monitor.status('10.0.0.5'), monitor.stats())
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class DeviceHealth(object):
+    __slots__ = ('ip_cam', 'interval', 'due', 'reachable', 'failures', 'rtt', 'rtt_min', 'rtt_avg', 'up_time',
+                 'probed', 'last_ok', 'restarts', 'last_restart', 'error', 'probing')
+
+    def __init__(self, ip_cam, interval, due):
+        self.ip_cam = ip_cam
+        self.interval = interval
+        self.due = due
+        self.reachable = None
+        self.failures = 0
+        self.rtt = None
+        self.rtt_min = None
+        self.rtt_avg = None
+        self.up_time = None
+        self.probed = None
+        self.last_ok = None
+        self.restarts = 0
+        self.last_restart = None
+        self.error = None
+        self.probing = False
+
+    def as_dict(self):
+        return {'ip': self.ip_cam.ip_address, 'reachable': self.reachable, 'failures': self.failures,
+                'rtt_ms': _ms(self.rtt), 'rtt_min_ms': _ms(self.rtt_min), 'rtt_avg_ms': _ms(self.rtt_avg),
+                'up_time': self.up_time, 'last_ok': self.last_ok, 'restarts': self.restarts,
+                'last_restart': self.last_restart, 'interval': self.interval, 'error': self.error}
+
+
+class HealthMonitor(object):
+    """
+    :param devices: iterable of IPCam
+    :param listeners: optional dict ip address -> events.EventListener, resubscribed after a restart
+    :param interval: interval of the first probe round in seconds
+    :param min_interval: interval after an error or a restart
+    :param max_interval: interval of stable devices
+    :param down_after: consecutive failed probes after which a device counts as unreachable
+    :param jitter: relative random variation of every interval
+    :param workers: concurrent probes
+    """
+
+    def __init__(self, devices, listeners=None, interval=60, min_interval=10, max_interval=600, down_after=2,
+                 jitter=0.1, workers=16):
+        self.listeners = listeners or {}
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.down_after = down_after
+        self.jitter = jitter
+        self.probes = 0
+        self.restart_handlers = []
+        self.probe_handlers = []
+        self.devices = {}
+        self._heap = []
+        now = time.monotonic()
+        for ip_cam in devices:
+            phase = int(hashlib.blake2b(ip_cam.ip_address.encode('utf-8'), digest_size=4).hexdigest(), 16) / 2.0 ** 32
+            health = DeviceHealth(ip_cam, interval, now + phase * interval)
+            self.devices[ip_cam.ip_address] = health
+            self._heap.append((health.due, ip_cam.ip_address))
+        heapq.heapify(self._heap)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='2n-health')
+
+    def add_restart_handler(self, handler):
+        """
+        :param handler: called as handler(ip_cam) after a restart of the device was detected
+        """
+        self.restart_handlers.append(handler)
+
+    def add_probe_handler(self, handler):
+        """
+        :param handler: called as handler(ip_cam, sent, received, result) after every successful probe, sent and
+        received being time.time() around the request and result the system_status result dict
+        """
+        self.probe_handlers.append(handler)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='2n-health', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                now = time.monotonic()
+                if not self._heap or self._heap[0][0] > now:
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                    continue
+                due, address = heapq.heappop(self._heap)
+                health = self.devices.get(address)
+                if health is None or health.due != due or health.probing:
+                    continue  # removed or rescheduled
+                health.probing = True
+            self._executor.submit(self.probe, health)
+
+    def probe(self, health):
+        ip_cam = health.ip_cam
+        sent = time.time()
+        started = time.perf_counter()
+        try:
+            reply = json.loads(ip_cam.commands.system_status())
+            rtt = time.perf_counter() - started
+            if not reply.get('success'):
+                raise IOError('system_status failed: {reply}'.format(reply=reply))
+            result = reply['result']
+            if not isinstance(result, dict):
+                raise IOError('system_status without a result: {reply}'.format(reply=reply))
+            up_time = result.get('upTime')
+            if up_time is not None and (isinstance(up_time, bool) or not isinstance(up_time, (int, float))):
+                raise IOError('system_status with an invalid upTime: {reply}'.format(reply=reply))
+        except Exception as err:
+            self._failed(health, err)
+            return
+        received = time.time()
+        self.probes += 1
+
+        restarted = False
+        with self._cond:
+            if health.up_time is not None and up_time is not None:
+                expected = health.up_time + (received - health.probed)
+                restarted = up_time + max(5.0, rtt * 2) < expected
+            health.up_time = up_time
+            health.probed = received
+            health.last_ok = received
+            health.rtt = rtt
+            health.rtt_min = rtt if health.rtt_min is None else min(health.rtt_min, rtt)
+            health.rtt_avg = rtt if health.rtt_avg is None else health.rtt_avg * 0.8 + rtt * 0.2
+            if not health.reachable:
+                if health.reachable is False:
+                    log.info("{ip}: reachable again".format(ip=ip_cam.ip_address))
+                health.reachable = True
+            health.failures = 0
+            health.error = None
+            if restarted:
+                health.restarts += 1
+                health.last_restart = received
+                health.interval = self.min_interval
+            else:
+                health.interval = min(self.max_interval, max(self.min_interval, health.interval * 2))
+            self._schedule(health)
+
+        for handler in self.probe_handlers:
+            try:
+                handler(ip_cam, sent, received, result)
+            except Exception as err:
+                log.exception("{ip}: probe handler failed: {err}".format(ip=ip_cam.ip_address, err=err))
+        if restarted:
+            self._restarted(ip_cam, up_time)
+
+    def _failed(self, health, err):
+        with self._cond:
+            health.failures += 1
+            health.error = str(err) or type(err).__name__
+            if health.failures >= self.down_after and health.reachable is not False:
+                log.warning("{ip}: unreachable: {err}".format(ip=health.ip_cam.ip_address, err=health.error))
+                health.reachable = False
+            # probe again soon, backing off while the device stays down
+            health.interval = min(self.max_interval, self.min_interval * 2 ** max(0, health.failures - 1))
+            self._schedule(health)
+
+    def _schedule(self, health):
+        health.probing = False
+        health.due = time.monotonic() + health.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        heapq.heappush(self._heap, (health.due, health.ip_cam.ip_address))
+        self._cond.notify()
+
+    def _restarted(self, ip_cam, up_time):
+        log.warning("{ip}: restarted {sec} seconds ago".format(ip=ip_cam.ip_address, sec=up_time))
+        if ip_cam.cache is not None:
+            ip_cam.cache.invalidate()
+        listener = self.listeners.get(ip_cam.ip_address)
+        if listener is not None:
+            listener.resubscribe()
+        for handler in self.restart_handlers:
+            try:
+                handler(ip_cam)
+            except Exception as err:
+                log.exception("{ip}: restart handler failed: {err}".format(ip=ip_cam.ip_address, err=err))
+
+    def status(self, address):
+        return self.devices[address].as_dict()
+
+    def stats(self):
+        with self._cond:
+            healths = list(self.devices.values())
+        return {'devices': len(healths), 'reachable': sum(1 for h in healths if h.reachable),
+                'unreachable': sum(1 for h in healths if h.reachable is False),
+                'restarts': sum(h.restarts for h in healths), 'probes': self.probes,
+                'probes_per_min': sum(60.0 / h.interval for h in healths)}
+
+
+def _ms(value):
+    return value * 1000 if value is not None else None
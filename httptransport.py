@@ -0,0 +1,455 @@
+"""
+Standard library transport for CommandService.
+
+HTTPClientTransport provides the requests-compatible request(method, url, **kwargs) used by CommandService on top
+of http.client, so neither requests nor urllib3 are imported. On small gateways this cuts the start-up time and
+memory of short-lived jobs (e.g. a cron job toggling one switch) considerably, see the cold_start bench scenario.
+
+Connections are kept alive per device. Basic and digest authentication are supported; the digest challenge is kept,
+so only the first request to a device pays the 401 round trip. Response bodies can be streamed (stream=True) and
+file uploads are streamed from the file instead of being read into memory. As with CommandService's requests calls,
+TLS certificates are not verified unless verify=True is passed. Errors are raised as IOError subclasses: HTTPError
+from raise_for_status, the socket errors of http.client otherwise.
+
+Example:
+    transport = HTTPClientTransport()
+    ip_cam = IPCam('192.168.0.2', auth_type=2, user='admin', password='secret', transport=transport)
+    ip_cam.commands.switch_control(1, 'on')
+"""
+
+import datetime
+import http.client
+import json
+import os
+import re
+import select
+import threading
+import time
+from base64 import b64encode
+from collections import OrderedDict
+from urllib.parse import urlencode, urlsplit
+
+_CHALLENGE_FIELD = re.compile(r'(\w+)\s*=\s*("((?:[^"\\]|\\.)*)"|[^\s,]*)')
+_DIGEST_HASHES = {'MD5': 'md5', 'MD5-SESS': 'md5', 'SHA': 'sha1', 'SHA-256': 'sha256', 'SHA-512': 'sha512'}
+
+
+class HTTPError(IOError):
+
+    def __init__(self, message, response=None):
+        super(HTTPError, self).__init__(message)
+        self.response = response
+
+
+class BasicAuth(object):
+
+    def __init__(self, username, password):
+        credentials = '{0}:{1}'.format(username, password).encode('utf-8')
+        self._header = 'Basic ' + b64encode(credentials).decode('ascii')
+
+    def header(self, method, uri):
+        return self._header
+
+    def challenge(self, value):
+        """
+        :return: True if the request should be repeated after this WWW-Authenticate challenge
+        """
+        return False  # the credentials were sent already
+
+
+class DigestAuth(object):
+    """
+    Digest authentication (RFC 7616, qop=auth) reusing the last challenge of the device.
+    """
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self._challenge = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def header(self, method, uri):
+        with self._lock:
+            if self._challenge is None:
+                return None
+            self._count += 1
+            challenge, count = self._challenge, self._count
+        return self._authorization(challenge, count, method, uri)
+
+    def challenge(self, value):
+        """
+        :return: True if the request should be repeated after this WWW-Authenticate challenge
+        """
+        if not value.lower().startswith('digest '):
+            return False
+        fields = dict((m.group(1).lower(), m.group(3) if m.group(3) is not None else m.group(2))
+                      for m in _CHALLENGE_FIELD.finditer(value[7:]))
+        if 'nonce' not in fields or fields.get('algorithm', 'MD5').upper() not in _DIGEST_HASHES:
+            return False
+        with self._lock:
+            self._challenge = fields
+            self._count = 0
+        return True
+
+    def _authorization(self, challenge, count, method, uri):
+        import hashlib
+
+        algorithm = challenge.get('algorithm', 'MD5').upper()
+        name = _DIGEST_HASHES[algorithm]
+
+        def digest(*values):
+            return hashlib.new(name, ':'.join(values).encode('utf-8')).hexdigest()
+
+        realm = challenge.get('realm', '')
+        nonce = challenge['nonce']
+        cnonce = os.urandom(8).hex()
+        ha1 = digest(self.username, realm, self.password)
+        if algorithm == 'MD5-SESS':
+            ha1 = digest(ha1, nonce, cnonce)
+        ha2 = digest(method, uri)
+        fields = ['username="{0}"'.format(self.username), 'realm="{0}"'.format(realm),
+                  'nonce="{0}"'.format(nonce), 'uri="{0}"'.format(uri)]
+        qop = [q.strip() for q in challenge.get('qop', '').split(',') if q.strip()]
+        if 'auth' in qop:
+            nc = '{0:08x}'.format(count)
+            fields.append('response="{0}"'.format(digest(ha1, nonce, nc, cnonce, 'auth', ha2)))
+            fields.extend(['qop=auth', 'nc={0}'.format(nc), 'cnonce="{0}"'.format(cnonce)])
+        else:
+            fields.append('response="{0}"'.format(digest(ha1, nonce, ha2)))
+        if 'opaque' in challenge:
+            fields.append('opaque="{0}"'.format(challenge['opaque']))
+        if 'algorithm' in challenge:
+            fields.append('algorithm={0}'.format(challenge['algorithm']))
+        return 'Digest ' + ', '.join(fields)
+
+
+class HTTPClientResponse(object):
+    """
+    Response providing the parts of the requests.Response interface used by CommandService.
+    The connection goes back to the transport's pool once the body has been read completely.
+    """
+
+    def __init__(self, transport, key, connection, response, url, elapsed, history):
+        self.status_code = response.status
+        self.reason = response.reason
+        self.url = url
+        self.headers = response.headers
+        self.elapsed = datetime.timedelta(seconds=elapsed)
+        self.history = history
+        self.encoding = None
+        self._transport = transport
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._content = None
+
+    def _done(self, reusable):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if reusable and not self._response.will_close:
+            # read1 does not mark a response with Content-Length as finished, http.client needs that for reuse
+            self._response.close()
+            self._transport._release(self._key, connection)
+        else:
+            connection.close()
+
+    @property
+    def content(self):
+        if self._content is None:
+            if self._connection is None:
+                raise RuntimeError('The response body has already been consumed')
+            try:
+                self._content = self._response.read()
+            except Exception:
+                self._done(False)
+                raise
+            self._done(True)
+        return self._content
+
+    @property
+    def text(self):
+        charset = 'utf-8'
+        content_type = self.headers.get('content-type', '')
+        if 'charset=' in content_type:
+            charset = content_type.split('charset=', 1)[1].split(';')[0].strip()
+        return self.content.decode(charset, 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1024, decode_unicode=False):
+        if self._content is not None:
+            for offset in range(0, len(self._content), chunk_size):
+                yield self._content[offset:offset + chunk_size]
+            return
+        complete = False
+        try:
+            while True:
+                # read1 returns what has arrived instead of waiting for chunk_size bytes (long polls)
+                chunk = self._response.read1(chunk_size)
+                if not chunk:
+                    complete = True
+                    return
+                yield chunk
+        finally:
+            self._done(complete)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise HTTPError('{code} Error: {reason} for url: {url}'.format(
+                code=self.status_code, reason=self.reason, url=self.url), response=self)
+
+    def close(self):
+        self._done(False)
+
+
+class HTTPClientTransport(object):
+    """
+    Keep-alive transport on http.client. One instance can be shared by many devices and threads.
+
+    :param hosts: number of devices whose idle connections are kept
+    :param pool_size: idle connections kept per device
+    :param tls_sessions: tlscache.TLSSessionCache to resume TLS sessions of https connections with
+    :param timeout: timeout in seconds of requests which do not pass one, None waits forever
+    """
+
+    def __init__(self, hosts=64, pool_size=4, tls_sessions=None, timeout=None):
+        self.hosts = hosts
+        self.pool_size = pool_size
+        self.tls_sessions = tls_sessions
+        self.timeout = timeout
+        self._idle = OrderedDict()  # (scheme, netloc) -> idle connections
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def make_auth(self, auth_type, user, password):
+        """
+        Authentication object for IPCam.auth_type, used by CommandService.
+        """
+        if auth_type == 1:
+            return BasicAuth(user, password)
+        if auth_type == 2:
+            return DigestAuth(user, password)
+        return None
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, params=None, data=None, files=None, headers=None, auth=None, timeout=None,
+                stream=False, verify=False):
+        if isinstance(auth, tuple):
+            auth = BasicAuth(*auth)
+        elif auth is not None and not hasattr(auth, 'challenge'):
+            raise TypeError("Unsupported authentication {auth!r}, use make_auth()".format(auth=auth))
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc, bool(verify))
+        target = parts.path or '/'
+        query = [parts.query] if parts.query else []
+        if params:
+            query.append(_urlencode(params))
+        if query:
+            target += '?' + '&'.join(query)
+
+        content_type, length, body = _encode_body(data, files)
+        request_headers = {}
+        if content_type is not None:
+            request_headers['Content-Type'] = content_type
+        if length is not None:
+            request_headers['Content-Length'] = str(length)
+        request_headers.update(headers or {})
+        timeout = self.timeout if timeout is None else timeout
+
+        history = []
+        while True:
+            authorization = auth.header(method, target) if auth is not None else None
+            if authorization is not None:
+                request_headers['Authorization'] = authorization
+            started = time.perf_counter()
+            connection, response = self._send(key, method, target, body, request_headers, timeout)
+            result = HTTPClientResponse(self, key, connection, response, url, time.perf_counter() - started,
+                                        history)
+            if response.status == 401 and auth is not None and not history \
+                    and auth.challenge(response.getheader('WWW-Authenticate', '')):
+                result.content  # drain, the connection is reused for the authenticated request
+                history.append(result)
+                continue
+            if not stream:
+                result.content
+            return result
+
+    def _send(self, key, method, target, body, headers, timeout):
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        connection = self._acquire(key)
+        try:
+            if connection is None:
+                connection = self._connect(key, connect_timeout)
+            connection.sock.settimeout(read_timeout)
+            connection.request(method, target, body=body() if body is not None else None, headers=headers)
+            return connection, connection.getresponse()
+        except Exception:
+            if connection is not None:
+                connection.close()
+            raise
+
+    def _connect(self, key, timeout):
+        scheme, netloc, verify = key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(netloc, timeout=timeout, context=self._context(verify))
+        elif scheme == 'http':
+            connection = http.client.HTTPConnection(netloc, timeout=timeout)
+        else:
+            raise ValueError("Unsupported URL scheme {scheme}".format(scheme=scheme))
+        connection.connect()
+        return connection
+
+    def _context(self, verify):
+        context = self._contexts.get(verify)
+        if context is None:
+            import ssl
+
+            if verify:
+                context = ssl.create_default_context()
+            elif self.tls_sessions is not None:
+                context = self.tls_sessions.context
+            else:
+                # the devices use self-signed certificates
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self._contexts[verify] = context
+        return context
+
+    def _acquire(self, key):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                connection = idle.pop()
+            # an idle connection which is readable has been closed by the device
+            if connection.sock is not None and not _readable(connection.sock):
+                return connection
+            connection.close()
+
+    def _release(self, key, connection):
+        closed = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+            else:
+                closed.append(connection)
+            while len(self._idle) > self.hosts:
+                closed.extend(self._idle.popitem(last=False)[1])
+        for connection in closed:
+            connection.close()
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, OrderedDict()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _readable(sock):
+    if hasattr(select, 'poll'):
+        # select() is limited to descriptors below FD_SETSIZE, a large fleet has more connections open
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(0))
+    return bool(select.select([sock], [], [], 0)[0])
+
+
+def _pairs(data):
+    items = data.items() if isinstance(data, dict) else data
+    for name, value in items:
+        for v in (value if isinstance(value, (list, tuple)) else [value]):
+            if v is not None:  # like requests, parameters set to None are left out
+                yield name, v
+
+
+def _urlencode(data):
+    if isinstance(data, (str, bytes)):
+        return data if isinstance(data, str) else data.decode('ascii')
+    return urlencode(list(_pairs(data)))
+
+
+def _encode_body(data, files):
+    """
+    :return: (content type, length, factory returning the body) with None for what does not apply; the factory
+    can be called again for a repeated request (digest challenge)
+    """
+    if files:
+        return _multipart(data, files)
+    if data is None:
+        return None, None, None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray)):
+        return None, len(data), lambda: data
+    body = _urlencode(data).encode('ascii')
+    return 'application/x-www-form-urlencoded', len(body), lambda: body
+
+
+def _multipart(data, files):
+    boundary = os.urandom(16).hex()
+    parts = []  # bytes or (file object, start offset, length)
+    for name, value in _pairs(data or {}):
+        parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'.format(
+            boundary, name, value).encode('utf-8'))
+    for name, spec in files.items():
+        if not isinstance(spec, (tuple, list)):
+            spec = (getattr(spec, 'name', name), spec)
+        filename, content = spec[0], spec[1]
+        content_type = spec[2] if len(spec) > 2 and spec[2] else 'application/octet-stream'
+        head = '--{0}\r\nContent-Disposition: form-data; name="{1}"'.format(boundary, name)
+        if filename:
+            head += '; filename="{0}"'.format(os.path.basename(str(filename)))
+        parts.append('{0}\r\nContent-Type: {1}\r\n\r\n'.format(head, content_type).encode('utf-8'))
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            parts.append(bytes(content))
+        else:
+            start = content.tell()
+            try:
+                end = os.fstat(content.fileno()).st_size
+            except (AttributeError, OSError, ValueError):
+                end = content.seek(0, os.SEEK_END)
+            parts.append((content, start, end - start))
+        parts.append(b'\r\n')
+    parts.append('--{0}--\r\n'.format(boundary).encode('ascii'))
+    length = sum(len(part) if isinstance(part, bytes) else part[2] for part in parts)
+
+    def body():
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            content, start, remaining = part
+            content.seek(start)
+            while remaining > 0:
+                chunk = content.read(min(remaining, 64 * 1024))
+                if not chunk:
+                    raise IOError('{name} was truncated during the upload'.format(
+                        name=getattr(content, 'name', 'file')))
+                remaining -= len(chunk)
+                yield chunk
+
+    return 'multipart/form-data; boundary={0}'.format(boundary), length, body
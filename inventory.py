@@ -0,0 +1,203 @@
+"""
+Persistent device inventory and capability cache.
+
+The answers of system_info and the *_caps endpoints only change with the firmware, so they are stored in a local
+SQLite database keyed by serial number and firmware version. An IPCam created with an inventory serves these
+endpoints from memory right away and revalidates in the background with a single system_info call: as long as
+serial number and firmware version are unchanged, the cached capabilities stay valid and are never re-queried.
+
+Example:
+    inventory = Inventory('/var/lib/2n/inventory.db')
+    ip_cam = IPCam('192.168.0.2', auth_type=2, user='admin', password='secret', inventory=inventory)
+    switches = json.loads(ip_cam.cache.get('switch_caps'))
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+CACHED_ENDPOINTS = ('system_info', 'switch_caps', 'io_caps', 'camera_caps', 'display_caps', 'log_caps')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    address TEXT PRIMARY KEY,
+    serial TEXT NOT NULL,
+    firmware TEXT NOT NULL,
+    seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS caps (
+    serial TEXT NOT NULL,
+    firmware TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (serial, firmware, endpoint)
+);
+"""
+
+
+class Inventory(object):
+    """
+    On-disk inventory. The whole database is read into memory when it is opened, lookups never touch the disk.
+
+    :param path: SQLite database file (':memory:' for a throw-away inventory)
+    :param workers: threads used for background revalidation of devices
+    """
+
+    def __init__(self, path, workers=8):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='2n-inventory')
+
+        self.addresses = {}
+        for address, serial, firmware in self._db.execute('SELECT address, serial, firmware FROM devices'):
+            self.addresses[address] = (serial, firmware)
+        self.caps = {}
+        for serial, firmware, endpoint, payload in self._db.execute(
+                'SELECT serial, firmware, endpoint, payload FROM caps'):
+            self.caps.setdefault((serial, firmware), {})[endpoint] = payload
+
+    def lookup(self, address):
+        """
+        :return: (serial, firmware) last seen at the address or None
+        """
+        return self.addresses.get(address)
+
+    def load(self, address):
+        """
+        :return: dict endpoint -> cached reply text for the device last seen at the address
+        """
+        key = self.addresses.get(address)
+        return dict(self.caps.get(key, {})) if key else {}
+
+    def bind(self, address, serial, firmware):
+        with self._lock:
+            self.addresses[address] = (serial, firmware)
+            self._db.execute('INSERT OR REPLACE INTO devices (address, serial, firmware, seen) VALUES (?, ?, ?, ?)',
+                             (address, serial, firmware, time.time()))
+
+    def store(self, serial, firmware, endpoint, payload):
+        with self._lock:
+            self.caps.setdefault((serial, firmware), {})[endpoint] = payload
+            self._db.execute('INSERT OR REPLACE INTO caps (serial, firmware, endpoint, payload, fetched) '
+                             'VALUES (?, ?, ?, ?, ?)', (serial, firmware, endpoint, payload, time.time()))
+
+    def forget(self, address):
+        with self._lock:
+            self.addresses.pop(address, None)
+            self._db.execute('DELETE FROM devices WHERE address = ?', (address,))
+
+    def prune(self):
+        """
+        Removes cached capabilities of firmware versions no device is running anymore.
+        """
+        with self._lock:
+            live = set(self.addresses.values())
+            for key in [key for key in self.caps if key not in live]:
+                del self.caps[key]
+                self._db.execute('DELETE FROM caps WHERE serial = ? AND firmware = ?', key)
+
+    def submit(self, fn, *args):
+        return self._executor.submit(fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+
+class DeviceCache(object):
+    """
+    Cached view of the static endpoints of one IPCam, available as ip_cam.cache.
+    """
+
+    def __init__(self, ip_cam, inventory, revalidate=True):
+        self.ip_cam = ip_cam
+        self.inventory = inventory
+        self.address = ip_cam.ip_address
+        self.identity = inventory.lookup(self.address)
+        self.entries = inventory.load(self.address)
+        self.validated = threading.Event()
+        self._lock = threading.Lock()
+        self.revalidation = inventory.submit(self.revalidate) if revalidate else None
+
+    def get(self, endpoint):
+        """
+        :param endpoint: one of CACHED_ENDPOINTS
+        :return: the reply text, from the cache or fetched from the device (and stored) if not cached yet
+        """
+        if endpoint not in CACHED_ENDPOINTS:
+            raise ValueError("{endpoint} is not a cacheable endpoint".format(endpoint=endpoint))
+        payload = self.entries.get(endpoint)
+        if payload is not None:
+            return payload
+        if endpoint == 'system_info':
+            self.revalidate()
+            payload = self.entries.get('system_info')
+            if payload is not None:
+                return payload
+            # revalidation failed, the device's own reply (or its error) goes to the caller uncached
+            return self.ip_cam.commands.system_info()
+        if self.identity is None and self.revalidation is not None:
+            # the reply can only be stored once serial number and firmware are known
+            self.revalidation.result()
+        payload = getattr(self.ip_cam.commands, endpoint)()
+        if _succeeded(payload):
+            with self._lock:
+                self.entries[endpoint] = payload
+                if self.identity is not None:
+                    self.inventory.store(self.identity[0], self.identity[1], endpoint, payload)
+        return payload
+
+    def revalidate(self):
+        """
+        Fetches system_info and drops the cached capabilities if the device at the address has a different serial
+        number or firmware version than cached.
+        :return: True if the cache was still valid
+        """
+        try:
+            payload = self.ip_cam.commands.system_info()
+            result = json.loads(payload)['result']
+            identity = (result['serialNumber'], result['swVersion'])
+        except Exception as err:
+            log.warning("Revalidation of {address} failed: {err}".format(address=self.address, err=err))
+            return False
+
+        with self._lock:
+            valid = identity == self.identity
+            if not valid:
+                log.info("{address}: now {serial} firmware {firmware}, dropping cached capabilities".format(
+                    address=self.address, serial=identity[0], firmware=identity[1]))
+                self.identity = identity
+                self.inventory.bind(self.address, identity[0], identity[1])
+                self.entries = dict(self.inventory.caps.get(identity, {}))
+            self.entries['system_info'] = payload
+            self.inventory.store(identity[0], identity[1], 'system_info', payload)
+        self.validated.set()
+        return valid
+
+    def invalidate(self):
+        """
+        Forgets the in-memory entries and schedules a revalidation, e.g. after the device restarted.
+        """
+        with self._lock:
+            self.identity = None
+            self.entries = {}
+        self.validated.clear()
+        self.revalidation = self.inventory.submit(self.revalidate)
+
+
+def _succeeded(payload):
+    try:
+        return json.loads(payload).get('success', False)
+    except (ValueError, AttributeError):
+        return False
@@ -0,0 +1,92 @@
+"""
+Incremental decoder for /api/log/pull replies.
+
+The reply is read chunk by chunk. Every event object of the "events" array is decoded as soon as its closing brace
+has arrived, so the first event is available before the rest of a large batch is transferred and memory use does
+not depend on the batch size: only the not yet decoded tail of the stream is buffered.
+
+Example:
+    for event in iter_events(response.iter_content(chunk_size=8192)):
+        handle(event)
+"""
+
+import codecs
+import json
+import re
+
+_EVENTS = re.compile(r'"events"\s*:\s*\[')
+_SEPARATOR = re.compile(r'[\s,]*')
+_decoder = json.JSONDecoder()
+
+
+class PullError(Exception):
+    """
+    The device answered the pull with success=false (e.g. unknown subscription id).
+    """
+
+    def __init__(self, reply):
+        super(PullError, self).__init__('Pull failed: {err}'.format(err=reply))
+        self.reply = reply
+
+
+def iter_event_batches(chunks):
+    """
+    Yields lists of the events completed by each chunk of the reply body (empty chunks yield nothing).
+    :param chunks: iterable of bytes (or str) chunks of a /api/log/pull reply
+    """
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    buffer = ''
+    in_array = False
+    done = False
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += decode(chunk) if isinstance(chunk, bytes) else chunk
+        if done:
+            continue
+        if not in_array:
+            match = _EVENTS.search(buffer)
+            if match is None:
+                continue
+            buffer = buffer[match.end():]
+            in_array = True
+
+        batch = []
+        pos = 0
+        while True:
+            pos = _SEPARATOR.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                done = True
+                break
+            try:
+                event, pos = _decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break  # incomplete object, wait for the next chunk
+            batch.append(event)
+        buffer = buffer[pos:]
+        if batch:
+            yield batch
+
+    buffer += decode(b'', final=True)
+    if not in_array:
+        try:
+            reply = json.loads(buffer)
+        except ValueError:
+            raise ValueError('Invalid pull reply: {data!r}'.format(data=buffer[:200]))
+        if not reply.get('success'):
+            raise PullError(reply)
+        return
+    if not done:
+        raise ValueError('Truncated pull reply: {data!r}'.format(data=buffer[:200]))
+
+
+def iter_events(chunks):
+    """
+    Yields the event dicts of a /api/log/pull reply one by one as they are completed.
+    """
+    for batch in iter_event_batches(chunks):
+        for event in batch:
+            yield event
@@ -0,0 +1,281 @@
+"""
+In-process access rule engine.
+
+Rules map events (type, device, parameters such as card UID, code or input port, time window) to actions on a
+device: switch_control, io_control, display_upload_image or email_send. The engine is an event sink (see
+events.EventListener), so actions are taken in the process that receives the events instead of a separate service
+polling for them.
+
+Rules are compiled into hash tables keyed by event type and the value of the rule's key parameter (uid for
+CardEntered, code for CodeEntered, port for InputChanged, ...), so matching an event costs a couple of dict lookups
+regardless of the number of rules. Use a PooledTransport for the devices so actions go out on warm connections.
+
+Example:
+    engine = RuleEngine([
+        Rule('CardEntered', {'uid': '04A2B3C4D5'}, actions=[Action('switch_control', switch=1, action='trigger')]),
+        Rule('CodeEntered', {'code': '1234'}, window=('08:00', '18:00'),
+             actions=[Action('switch_control', switch=2, action='on')]),
+    ])
+    listener.add_sink(engine)
+    ...
+    print(engine.latency())
+
+latency() is measured up to the moment the action's request is handed to the device's transport, taken from a
+tracing hook the engine registers on the CommandService of every device it acts on.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from tracing import TraceHook
+
+log = logging.getLogger(__name__)
+
+# parameter used to index rules of an event type if the rule constrains it
+KEY_PARAMS = {
+    'CardEntered': 'uid',
+    'CodeEntered': 'code',
+    'InputChanged': 'port',
+    'OutputChanged': 'port',
+    'KeyPressed': 'key',
+    'KeyReleased': 'key',
+    'SwitchStateChanged': 'switch',
+    'CallStateChanged': 'state',
+    'UserAuthenticated': 'user'
+}
+
+ACTIONS = ('switch_control', 'io_control', 'display_upload_image', 'email_send')
+
+
+class Action(object):
+    """
+    CommandService call executed when a rule fires.
+
+    :param command: one of switch_control, io_control, display_upload_image, email_send
+    :param target: IPCam to act on, None acts on the device the event came from
+    :param kwargs: arguments of the command
+    """
+
+    def __init__(self, command, target=None, **kwargs):
+        if command not in ACTIONS:
+            raise ValueError("Unsupported rule action {command}".format(command=command))
+        self.command = command
+        self.target = target
+        self.kwargs = kwargs
+
+    def __call__(self, ip_cam):
+        return getattr((self.target or ip_cam).commands, self.command)(**self.kwargs)
+
+    def __repr__(self):
+        return 'Action({command}, {kwargs})'.format(command=self.command, kwargs=self.kwargs)
+
+
+class Rule(object):
+    """
+    :param event: event type, e.g. 'CardEntered'
+    :param params: dict of event parameters which must match exactly, e.g. {'uid': '04A2B3C4D5', 'valid': True}
+    :param actions: list of Action
+    :param devices: optional collection of device ip addresses the rule is limited to
+    :param window: optional ('HH:MM', 'HH:MM') local time window, may span midnight
+    :param days: optional collection of weekdays (0 = Monday) the rule is active on
+    :param stop: do not evaluate further rules once this rule fired
+    :param name: label used in logs and statistics
+    """
+
+    def __init__(self, event, params=None, actions=(), devices=None, window=None, days=None, stop=False, name=None):
+        self.event = event
+        self.params = dict(params or {})
+        self.actions = list(actions)
+        self.devices = frozenset(devices) if devices is not None else None
+        self.window = None
+        if window is not None:
+            self.window = tuple(_minutes(t) for t in window)
+        self.days = frozenset(days) if days is not None else None
+        self.stop = stop
+        self.name = name or '{event}{params}'.format(event=event, params=self.params or '')
+        key = KEY_PARAMS.get(event)
+        self.key = key if key in self.params else None
+        # conditions left to check after the hash lookup
+        self._rest = [(k, v) for k, v in self.params.items() if k != self.key]
+
+    @classmethod
+    def from_dict(cls, spec, devices=None):
+        """
+        Builds a rule from a configuration dict, e.g. loaded from JSON:
+        {"event": "CardEntered", "params": {"uid": "04A2B3C4D5"}, "window": ["08:00", "18:00"],
+         "actions": [{"command": "switch_control", "switch": 1, "action": "trigger", "target": "10.0.0.5"}]}
+
+        :param devices: dict ip address -> IPCam used to resolve action targets
+        """
+        actions = []
+        for item in spec.get('actions', []):
+            item = dict(item)
+            target = item.pop('target', None)
+            if target is not None:
+                target = (devices or {})[target]
+            actions.append(Action(item.pop('command'), target=target, **item))
+        return cls(spec['event'], spec.get('params'), actions, spec.get('devices'), spec.get('window'),
+                   spec.get('days'), spec.get('stop', False), spec.get('name'))
+
+    def accepts(self, ip_cam, event):
+        if self.devices is not None and ip_cam.ip_address not in self.devices:
+            return False
+        params = event.get('params', {})
+        for key, value in self._rest:
+            if params.get(key) != value:
+                return False
+        if self.window is not None or self.days is not None:
+            moment = datetime.fromtimestamp(event.get('utcTime') or time.time())
+            if self.days is not None and moment.weekday() not in self.days:
+                return False
+            if self.window is not None:
+                minute = moment.hour * 60 + moment.minute
+                start, end = self.window
+                inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+                if not inside:
+                    return False
+        return True
+
+
+class _LatencyHook(TraceHook):
+    """
+    Takes the latency sample of the action running in the calling thread when its request starts.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def before_request(self, span):
+        self.engine._sent()
+
+
+class RuleEngine(object):
+    """
+    Event sink evaluating rules and executing their actions.
+
+    :param rules: list of Rule
+    :param workers: threads executing actions; 0 executes them in the calling (listener) thread
+    :param samples: number of latency samples kept for latency()
+    """
+
+    def __init__(self, rules=(), workers=4, samples=10000):
+        self._lock = threading.Lock()
+        self.rules = []
+        self._index = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='2n-rules') if workers else None
+        self._latency = deque(maxlen=samples)
+        self._running = threading.local()  # arrival time of the action running in the thread
+        self._hook = _LatencyHook(self)
+        self._hooked = set()  # ids of the CommandServices the hook is registered with
+        self.fired = {}
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        with self._lock:
+            self.rules.append(rule)
+            self._compile()
+
+    def remove(self, rule):
+        with self._lock:
+            self.rules.remove(rule)
+            self._compile()
+
+    def _compile(self):
+        # event type -> (key parameter -> value -> rules, rules without key value); rule order is kept
+        index = {}
+        for position, rule in enumerate(self.rules):
+            keyed, generic = index.setdefault(rule.event, ({}, []))
+            if rule.key is None:
+                generic.append((position, rule))
+            else:
+                keyed.setdefault(rule.key, {}).setdefault(rule.params[rule.key], []).append((position, rule))
+        self._index = index
+
+    def match(self, ip_cam, event):
+        """
+        :return: rules accepting the event, in the order they were added
+        """
+        entry = self._index.get(event.get('event'))
+        if entry is None:
+            return []
+        keyed, generic = entry
+        candidates = generic
+        if keyed:
+            params = event.get('params', {})
+            candidates = list(generic)
+            for key, table in keyed.items():
+                value = params.get(key)
+                try:
+                    candidates.extend(table.get(value, ()))
+                except TypeError:  # unhashable parameter value
+                    pass
+            if len(candidates) > 1:
+                candidates.sort(key=lambda item: item[0])
+        matched = []
+        for _, rule in candidates:
+            if rule.accepts(ip_cam, event):
+                matched.append(rule)
+                if rule.stop:
+                    break
+        return matched
+
+    def __call__(self, ip_cam, events):
+        arrived = time.perf_counter()
+        for event in events:
+            for rule in self.match(ip_cam, event):
+                self.fired[rule.name] = self.fired.get(rule.name, 0) + 1
+                for action in rule.actions:
+                    if self._executor is None:
+                        self._run(action, ip_cam, rule, event, arrived)
+                    else:
+                        self._executor.submit(self._run, action, ip_cam, rule, event, arrived)
+
+    def _run(self, action, ip_cam, rule, event, arrived):
+        commands = (action.target or ip_cam).commands
+        if id(commands) not in self._hooked:
+            with self._lock:
+                if id(commands) not in self._hooked:
+                    commands.add_hook(self._hook)
+                    self._hooked.add(id(commands))
+        self._running.arrived = arrived
+        try:
+            action(ip_cam)
+        except Exception as err:
+            log.error("Rule {rule}: {action} on {ip} failed: {err}".format(rule=rule.name, action=action,
+                                                                          ip=(action.target or ip_cam).ip_address,
+                                                                          err=err))
+        finally:
+            self._running.arrived = None
+
+    def _sent(self):
+        arrived = getattr(self._running, 'arrived', None)
+        if arrived is not None:
+            # only the first request of an action is its sample
+            self._running.arrived = None
+            self._latency.append(time.perf_counter() - arrived)
+
+    def latency(self):
+        """
+        Client-side overhead from handing an event batch to the engine until the action's request is handed to the
+        device's transport.
+        :return: dict with count, p50 and p99 in milliseconds
+        """
+        samples = sorted(list(self._latency))
+        if not samples:
+            return {'count': 0, 'p50_ms': None, 'p99_ms': None}
+        return {'count': len(samples), 'p50_ms': samples[len(samples) // 2] * 1000,
+                'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+def _minutes(value):
+    hours, _, minutes = str(value).partition(':')
+    return int(hours) * 60 + int(minutes or 0)
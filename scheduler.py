@@ -0,0 +1,369 @@
+"""
+Fleet scheduler for timed switch and output actions.
+
+Pending actions are kept in a hierarchical timer wheel (4 levels of 256 slots), so inserting and cancelling are O(1)
+no matter how many actions are pending, and one thread drives all of them instead of a sleeping thread per action.
+Actions due in the same tick are grouped per device and every group is dispatched as one batch on a worker pool,
+using the device's transport (use transport.PooledTransport to keep the connections warm).
+
+Pending schedules can be persisted in SQLite. On restart they are loaded again; actions missed while the process was
+down fire if they are at most misfire_grace seconds late. Actions that were being dispatched during a crash are
+repeated only if they are idempotent (switch/output "on" and "off"), so a restart neither loses nor double-fires
+them.
+
+Example:
+    scheduler = Scheduler(ip_cams, path='/var/lib/2n/schedule.db').start()
+    scheduler.hold(ip_cam.ip_address, 10, switch=1)               # open door 1 for 10 seconds
+    for ip_cam in ip_cams:                                         # unlock switch 2 from 08:00 to 18:00 every day
+        scheduler.window(ip_cam.ip_address, '08:00', '18:00', switch=2)
+"""
+
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schedules (
+    id TEXT PRIMARY KEY,
+    due REAL NOT NULL,
+    device TEXT NOT NULL,
+    command TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    repeat TEXT
+);
+CREATE TABLE IF NOT EXISTS inflight (
+    id TEXT PRIMARY KEY,
+    device TEXT NOT NULL,
+    command TEXT NOT NULL,
+    kwargs TEXT NOT NULL
+);
+"""
+
+
+class TimerEntry(object):
+    __slots__ = ('id', 'due', 'device', 'command', 'kwargs', 'repeat', 'expires', 'level', 'slot')
+
+    def __init__(self, id, due, device, command, kwargs, repeat=None):
+        self.id = id
+        self.due = due
+        self.device = device
+        self.command = command
+        self.kwargs = kwargs
+        self.repeat = repeat
+        self.expires = None
+        self.level = None
+        self.slot = None
+
+    @property
+    def idempotent(self):
+        return self.command in ('switch_control', 'io_control') and self.kwargs.get('action') in ('on', 'off')
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel. Level l slots cover 256**l ticks each; entries cascade to lower levels as time
+    advances. Not thread-safe, the Scheduler serialises access.
+
+    :param tick: tick length in seconds
+    :param now: start time (time.time() by default)
+    """
+
+    def __init__(self, tick=0.1, now=None):
+        self.tick = tick
+        self.origin = time.time() if now is None else now
+        self.current = 0
+        self.wheels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def insert(self, entry):
+        entry.expires = max(self.current + 1, int((entry.due - self.origin) / self.tick + 0.999999))
+        self.entries[entry.id] = entry
+        self._place(entry)
+
+    def _place(self, entry):
+        delta = entry.expires - self.current
+        level = 0
+        while level < LEVELS - 1 and delta >= SLOTS ** (level + 1):
+            level += 1
+        expires = min(entry.expires, self.current + SLOTS ** LEVELS - 1)
+        slot = (expires >> (SLOT_BITS * level)) & (SLOTS - 1)
+        self.wheels[level][slot][entry.id] = entry
+        entry.level = level
+        entry.slot = slot
+
+    def cancel(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is not None:
+            self.wheels[entry.level][entry.slot].pop(entry_id, None)
+        return entry
+
+    def advance(self, now=None):
+        """
+        Moves the wheel to the given time.
+        :return: list of entries that became due, in expiry order
+        """
+        target = int(((time.time() if now is None else now) - self.origin) / self.tick)
+        due = []
+        while self.current < target:
+            self.current += 1
+            # cascade higher levels whose slot boundary was reached
+            for level in range(LEVELS - 1, 0, -1):
+                if self.current & ((1 << (SLOT_BITS * level)) - 1) == 0:
+                    slot = (self.current >> (SLOT_BITS * level)) & (SLOTS - 1)
+                    bucket = self.wheels[level][slot]
+                    if bucket:
+                        self.wheels[level][slot] = {}
+                        for entry in bucket.values():
+                            if entry.expires <= self.current:
+                                due.append(entry)
+                            else:
+                                self._place(entry)
+            bucket = self.wheels[0][self.current & (SLOTS - 1)]
+            if bucket:
+                self.wheels[0][self.current & (SLOTS - 1)] = {}
+                due.extend(entry for entry in bucket.values() if entry.expires <= self.current)
+                for entry in bucket.values():
+                    if entry.expires > self.current:
+                        self._place(entry)
+        for entry in due:
+            self.entries.pop(entry.id, None)
+        return due
+
+    def next_expiry(self):
+        if not self.entries:
+            return None
+        return self.origin + min(e.expires for e in self.entries.values()) * self.tick
+
+
+class Scheduler(object):
+    """
+    :param devices: iterable of IPCam (more can be added with register)
+    :param path: optional SQLite file for durable schedules
+    :param tick: timer resolution in seconds
+    :param workers: parallel device batches
+    :param misfire_grace: seconds an action may be late (e.g. after a restart) and still fire
+    """
+
+    def __init__(self, devices=(), path=None, tick=0.1, workers=16, misfire_grace=60):
+        self.devices = dict((ip_cam.ip_address, ip_cam) for ip_cam in devices)
+        self.misfire_grace = misfire_grace
+        self.wheel = TimerWheel(tick)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='2n-scheduler')
+        self._db = None
+        self.dispatched = 0
+        self.failed = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+            self._recover()
+
+    def register(self, ip_cam):
+        self.devices[ip_cam.ip_address] = ip_cam
+
+    # --- scheduling ---
+
+    def at(self, due, device, command, repeat=None, **kwargs):
+        """
+        Schedules a CommandService call (e.g. 'switch_control' with switch=1, action='on') at the unix time due.
+        :param repeat: None or 'daily@HH:MM' to repeat every day at that local time
+        :return: schedule id (for cancel)
+        """
+        return self.schedule_many([(due, device, command, kwargs, repeat)])[0]
+
+    def after(self, delay, device, command, **kwargs):
+        return self.at(time.time() + delay, device, command, **kwargs)
+
+    def daily(self, device, at, command, **kwargs):
+        repeat = 'daily@' + at
+        return self.at(_next_daily(at), device, command, repeat=repeat, **kwargs)
+
+    def hold(self, device, seconds, switch=None, port=None):
+        """
+        Activates a switch (or output port) now and deactivates it after the given number of seconds.
+        :return: (on id, off id)
+        """
+        command, target = ('switch_control', {'switch': switch}) if port is None else ('io_control', {'port': port})
+        now = time.time()
+        return tuple(self.schedule_many([(now, device, command, dict(target, action='on'), None),
+                                         (now + seconds, device, command, dict(target, action='off'), None)]))
+
+    def window(self, device, start, end, switch=None, port=None):
+        """
+        Activates a switch (or output port) every day at start and deactivates it at end (local 'HH:MM').
+        If the window is open right now, the switch is activated immediately as well.
+        :return: (on id, off id)
+        """
+        command, target = ('switch_control', {'switch': switch}) if port is None else ('io_control', {'port': port})
+        items = [(_next_daily(start), device, command, dict(target, action='on'), 'daily@' + start),
+                 (_next_daily(end), device, command, dict(target, action='off'), 'daily@' + end)]
+        ids = self.schedule_many(items)
+        if _next_daily(end) < _next_daily(start):
+            self.at(time.time(), device, command, **dict(target, action='on'))
+        return tuple(ids)
+
+    def schedule_many(self, items):
+        """
+        Bulk insert of (due, device, command, kwargs, repeat) tuples.
+        :return: list of schedule ids
+        """
+        entries = [TimerEntry(uuid.uuid4().hex, due, device, command, kwargs, repeat)
+                   for due, device, command, kwargs, repeat in items]
+        with self._lock:
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany('INSERT INTO schedules (id, due, device, command, kwargs, repeat) '
+                                         'VALUES (?, ?, ?, ?, ?, ?)',
+                                         [(e.id, e.due, e.device, e.command, json.dumps(e.kwargs), e.repeat)
+                                          for e in entries])
+            for entry in entries:
+                self.wheel.insert(entry)
+        return [entry.id for entry in entries]
+
+    def cancel(self, schedule_id):
+        with self._lock:
+            entry = self.wheel.cancel(schedule_id)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM schedules WHERE id = ?', (schedule_id,))
+        return entry is not None
+
+    def pending(self):
+        return len(self.wheel)
+
+    # --- running ---
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='2n-scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _run(self):
+        tick = self.wheel.tick
+        while not self._stop.is_set():
+            self.run_due()
+            next_tick = self.wheel.origin + (self.wheel.current + 1) * tick
+            self._stop.wait(max(0.0, next_tick - time.time()))
+
+    def run_due(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            due = self.wheel.advance(now)
+            if not due:
+                return 0
+            fire = []
+            for entry in due:
+                if now - entry.due > self.misfire_grace:
+                    log.warning("Skipping {command} {kwargs} on {device}, {late:.0f}s late".format(
+                        command=entry.command, kwargs=entry.kwargs, device=entry.device, late=now - entry.due))
+                else:
+                    fire.append(entry)
+            follow_ups = [TimerEntry(e.id, _next_daily(e.repeat[6:], after=max(now, e.due)), e.device, e.command,
+                                     e.kwargs, e.repeat) for e in due if e.repeat]
+            if self._db is not None:
+                # the dispatch is journaled before it starts, see _recover
+                with self._db:
+                    self._db.executemany('DELETE FROM schedules WHERE id = ?', [(e.id,) for e in due if not e.repeat])
+                    self._db.executemany('UPDATE schedules SET due = ? WHERE id = ?',
+                                         [(e.due, e.id) for e in follow_ups])
+                    self._db.executemany('INSERT OR REPLACE INTO inflight (id, device, command, kwargs) '
+                                         'VALUES (?, ?, ?, ?)',
+                                         [(e.id, e.device, e.command, json.dumps(e.kwargs)) for e in fire])
+            for entry in follow_ups:
+                self.wheel.insert(entry)
+
+        batches = {}
+        for entry in fire:
+            batches.setdefault(entry.device, []).append(entry)
+        for device, entries in batches.items():
+            self._executor.submit(self._dispatch, device, entries)
+        return len(fire)
+
+    def _dispatch(self, device, entries):
+        ip_cam = self.devices.get(device)
+        dispatched = failed = 0
+        for entry in entries:
+            if ip_cam is None:
+                log.error("Unknown device {device} for scheduled {command}".format(device=device,
+                                                                                   command=entry.command))
+                failed += 1
+                continue
+            try:
+                getattr(ip_cam.commands, entry.command)(**entry.kwargs)
+                dispatched += 1
+            except Exception as err:
+                failed += 1
+                log.error("Scheduled {command} {kwargs} on {device} failed: {err}".format(
+                    command=entry.command, kwargs=entry.kwargs, device=device, err=err))
+        # batches of several devices finish concurrently on the worker pool
+        with self._lock:
+            self.dispatched += dispatched
+            self.failed += failed
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany('DELETE FROM inflight WHERE id = ?', [(e.id,) for e in entries])
+
+    def _recover(self):
+        now = time.time()
+        replay = []
+        for entry_id, device, command, kwargs in self._db.execute('SELECT id, device, command, kwargs FROM inflight'):
+            entry = TimerEntry(entry_id, now, device, command, json.loads(kwargs))
+            if entry.idempotent:
+                replay.append(entry)
+            else:
+                log.warning("Not repeating interrupted {command} {kwargs} on {device}".format(
+                    command=command, kwargs=entry.kwargs, device=device))
+        with self._db:
+            self._db.execute('DELETE FROM inflight')
+
+        count = 0
+        for entry_id, due, device, command, kwargs, repeat in self._db.execute(
+                'SELECT id, due, device, command, kwargs, repeat FROM schedules'):
+            self.wheel.insert(TimerEntry(entry_id, due, device, command, json.loads(kwargs), repeat))
+            count += 1
+        for entry in replay:
+            entry.id = 'replay-' + entry.id
+            self.wheel.insert(entry)
+        log.info("Loaded {count} schedules, repeating {replay} interrupted actions".format(count=count,
+                                                                                         replay=len(replay)))
+
+
+def _next_daily(at, after=None):
+    """
+    :return: unix time of the next local HH:MM strictly after the given time (default: now)
+    """
+    after = time.time() if after is None else after
+    hours, _, minutes = at.partition(':')
+    moment = datetime.datetime.fromtimestamp(after)
+    candidate = moment.replace(hour=int(hours), minute=int(minutes or 0), second=0, microsecond=0)
+    if candidate.timestamp() <= after:
+        candidate += datetime.timedelta(days=1)
+    return candidate.timestamp()
@@ -0,0 +1,999 @@
+"""
+Local stand-in for the 2N HTTP API.
+
+The simulator implements the endpoints wrapped by commands.CommandService so that the library (and everything built
+on top of it) can be exercised and benchmarked without real intercoms. Many devices can be emulated in one process,
+either one listening port per device or a single port shared by devices on different loopback addresses (virtual
+hosts, dispatched by the Host header or the local address of the connection).
+
+Example:
+    sim = Simulator(mode='ports', base_port=20000)
+    devices = sim.add_devices(100, profile=DeviceProfile(latency=0.01, auth_type=2))
+    sim.start_in_thread()
+
+    ip_cam = IPCam(devices[0].address, auth_type=2, user='admin', password='2n')
+    print(ip_cam.commands.switch_status())
+
+    sim.stop()
+
+Run "python simulator.py --help" to start it stand-alone.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from base64 import b64decode
+from collections import deque
+from itertools import count
+from urllib.parse import parse_qsl, urlsplit
+
+log = logging.getLogger(__name__)
+
+HISTORY_SIZE = 500
+DIGEST_REALM = 'HTTP API'
+
+EVENT_TYPES = [
+    'DeviceState', 'AudioLoopTest', 'MotionDetected', 'NoiseDetected', 'KeyPressed', 'KeyReleased', 'CodeEntered',
+    'CardEntered', 'InputChanged', 'OutputChanged', 'SwitchStateChanged', 'CallStateChanged',
+    'RegistrationStateChanged', 'TamperSwitchActivated', 'UnauthorizedDoorOpen', 'DoorOpenTooLong', 'LoginBlocked',
+    'UserAuthenticated'
+]
+
+JPEG_RESOLUTIONS = [(160, 120), (176, 144), (320, 240), (352, 272), (352, 288), (640, 480)]
+
+ERRORS = {
+    2: 'invalid request path',
+    3: 'invalid request method',
+    9: 'authorisation required',
+    11: 'missing mandatory parameter',
+    12: 'invalid parameter value',
+    14: 'unspecified processing error',
+    15: 'no data available'
+}
+
+REASONS = {200: 'OK', 401: 'Unauthorized', 404: 'Not Found', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+class ApiError(Exception):
+    def __init__(self, code, param=None):
+        super(ApiError, self).__init__(ERRORS.get(code, 'error'))
+        self.code = code
+        self.param = param
+
+
+class DeviceProfile(object):
+    """
+    Behaviour of a simulated device. One profile can be shared by many devices.
+
+    :param latency: fixed delay in seconds added before every response
+    :param jitter: random extra delay in seconds (uniform 0..jitter)
+    :param bandwidth: response/upload throughput limit in bytes per second per connection, None for unlimited
+    :param error_rate: probability (0..1) that a request fails
+    :param error_mode: '500' answers failed requests with HTTP 500, 'reset' drops the connection
+    :param max_connections: concurrent connections accepted per device, further ones get HTTP 503
+    :param auth_type: 0 none, 1 basic, 2 digest (same values as IPCam)
+    :param user: account name for authentication
+    :param password: account password for authentication
+    :param snapshot_size: approximate size of JPEG snapshots in bytes
+    :param config_size: approximate size of the XML configuration in bytes
+    :param pcap_size: size of the pcap download in bytes
+    :param event_rate: synthetic events generated per second and device (0 disables the generator)
+    :param clock_offset: offset of the device clock against the host clock in seconds
+    :param clock_drift: drift of the device clock in ppm
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0, error_mode='500',
+                 max_connections=None, auth_type=0, user='admin', password='2n', snapshot_size=30000,
+                 config_size=60000, pcap_size=200000, event_rate=0.0, clock_offset=0.0, clock_drift=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_mode = error_mode
+        self.max_connections = max_connections
+        self.auth_type = auth_type
+        self.user = user
+        self.password = password
+        self.snapshot_size = snapshot_size
+        self.config_size = config_size
+        self.pcap_size = pcap_size
+        self.event_rate = event_rate
+        self.clock_offset = clock_offset
+        self.clock_drift = clock_drift
+
+
+def make_jpeg(width, height, size=0, tag=b''):
+    """
+    Builds a valid baseline JPEG of the given resolution (uniform grey) padded with comment segments to
+    approximately size bytes. The tag is stored in the first comment, so frames with different tags differ in
+    content.
+    """
+
+    def segment(marker, payload):
+        return struct.pack('>BBH', 0xFF, marker, len(payload) + 2) + payload
+
+    parts = [b'\xff\xd8', segment(0xFE, b'2N-SIM ' + tag)]
+    parts.append(segment(0xDB, b'\x00' + b'\x01' * 64))
+    parts.append(segment(0xC0, struct.pack('>BHHBBBB', 8, height, width, 1, 1, 0x11, 0)))
+    # single-code huffman tables: DC difference 0 and AC end-of-block are both encoded as the bit "0"
+    parts.append(segment(0xC4, b'\x00' + b'\x01' + b'\x00' * 15 + b'\x00'))
+    parts.append(segment(0xC4, b'\x10' + b'\x01' + b'\x00' * 15 + b'\x00'))
+    parts.append(segment(0xDA, b'\x01\x01\x00\x00\x3f\x00'))
+    blocks = ((width + 7) // 8) * ((height + 7) // 8)
+    bits = blocks * 2
+    scan = bytearray(bits // 8)
+    if bits % 8:
+        scan.append(0xFF >> (bits % 8))
+    parts.append(bytes(scan))
+    parts.append(b'\xff\xd9')
+
+    padding = size - sum(len(p) for p in parts)
+    fill = []
+    while padding > 4:
+        chunk = min(padding - 4, 65533)
+        fill.append(segment(0xFE, b'\x00' * chunk))
+        padding -= chunk + 4
+    return parts[0] + parts[1] + b''.join(fill) + b''.join(parts[2:])
+
+
+def make_config(serial, size):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<DeviceConfig serial="{0}">'.format(serial),
+             ' <Network><Dhcp>1</Dhcp><HostName>2N-{0}</HostName></Network>'.format(serial),
+             ' <HttpApi><AuthMethod>digest</AuthMethod><Https>1</Https></HttpApi>']
+    for account in (1, 2):
+        lines.append(' <SipAccount id="{0}"><Enabled>{1}</Enabled><Number>{2}{0}</Number>'
+                     '<Domain>sip.local</Domain></SipAccount>'.format(account, int(account == 1), serial[-4:]))
+    index = 0
+    body = sum(len(line) for line in lines)
+    while body < size:
+        line = ' <Directory id="{0}"><Name>User {0}</Name><Phone>{1}</Phone><Card>{2:08X}</Card></Directory>'.format(
+            index, 1000 + index, index * 7919)
+        lines.append(line)
+        body += len(line)
+        index += 1
+    lines.append('</DeviceConfig>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def make_ssl_context(directory=None):
+    """
+    Server SSLContext with a self-signed RSA 2048 certificate (like the devices' factory certificate), created with
+    the openssl command line tool in directory (a temporary directory by default).
+    """
+    directory = directory or tempfile.mkdtemp(prefix='2n-simulator-')
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    if not os.path.exists(cert):
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '3650',
+                               '-subj', '/CN=2N simulator', '-keyout', key, '-out', cert],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def make_pcap(size):
+    header = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+    packets = []
+    total = len(header)
+    ts = int(time.time())
+    while total < size:
+        payload = os.urandom(min(1400, max(size - total - 16, 1)))
+        packets.append(struct.pack('<IIII', ts, 0, len(payload), len(payload)) + payload)
+        total += len(packets[-1])
+    return header + b''.join(packets)
+
+
+class Subscription(object):
+    def __init__(self, sid, filter, duration):
+        self.id = sid
+        self.filter = filter
+        self.duration = duration
+        self.queue = deque()
+        self.expires = time.monotonic() + duration
+        self.waiter = None
+
+
+class SimulatedDevice(object):
+    """
+    State of one emulated intercom: switches, I/O ports, event history and subscription channels.
+    Use emit() to inject events, it is safe to call from any thread.
+    """
+
+    def __init__(self, name, serial, profile, address=None):
+        self.name = name
+        self.serial = serial
+        self.profile = profile
+        self.address = address
+        self.variant = '2N Helios IP Vario'
+        self.sw_version = '2.10.0.19.2'
+        self.boot_time = time.time()
+        self.loop = None
+
+        self.switches = dict((i, {'active': False, 'timer': None}) for i in range(1, 5))
+        self.ports = {'input1': False, 'input2': False, 'relay1': False, 'relay2': False}
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.subscriptions = {}
+        self.event_ids = count(1)
+        self.sids = count(random.randint(10 ** 8, 10 ** 9))
+        self.sessions = count(1)
+        self.calls = {}
+        self.frames = count(1)
+        self.connections = 0
+        self.config = make_config(serial, profile.config_size)
+        self.pending_firmware = None
+        self.display_image = None
+        self.pcap_data = None
+        self.requests = 0
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+
+    def device_time(self, now=None):
+        now = time.time() if now is None else now
+        return now + self.profile.clock_offset + (now - self.boot_time) * self.profile.clock_drift / 1e6
+
+    def emit(self, event, params=None):
+        if self.loop is not None and not _in_loop(self.loop):
+            self.loop.call_soon_threadsafe(self.emit, event, params)
+            return
+        now = time.time()
+        record = {
+            'id': next(self.event_ids),
+            'utcTime': int(self.device_time(now)),
+            'upTime': int(now - self.boot_time),
+            'event': event,
+            'params': params or {}
+        }
+        self.history.append((time.monotonic(), record))
+        for sub in self.subscriptions.values():
+            if sub.filter is None or event in sub.filter:
+                sub.queue.append(record)
+                if sub.waiter is not None and not sub.waiter.done():
+                    sub.waiter.set_result(None)
+
+    def restart(self):
+        self.boot_time = time.time()
+        self.subscriptions.clear()
+        self.calls.clear()
+        for state in self.switches.values():
+            state['active'] = False
+        self.emit('DeviceState', {'state': 'startup'})
+
+    def set_switch(self, switch, active):
+        state = self.switches[switch]
+        if state['timer'] is not None:
+            state['timer'].cancel()
+            state['timer'] = None
+        if state['active'] != active:
+            state['active'] = active
+            self.emit('SwitchStateChanged', {'switch': switch, 'state': active})
+
+
+def _in_loop(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class Request(object):
+    __slots__ = ('method', 'path', 'params', 'files', 'headers', 'body')
+
+    def __init__(self, method, path, params, files, headers, body):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.files = files
+        self.headers = headers
+        self.body = body
+
+    def get(self, name, default=None):
+        values = self.params.get(name)
+        return values[-1] if values else default
+
+    def require(self, name):
+        value = self.get(name)
+        if value is None or value == '':
+            raise ApiError(11, name)
+        return value
+
+
+class Response(object):
+    __slots__ = ('status', 'body', 'content_type', 'headers', 'close')
+
+    def __init__(self, status=200, body=b'', content_type='application/json', headers=None, close=False):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or []
+        self.close = close
+
+
+def _json(result=None):
+    data = {'success': True}
+    if result is not None:
+        data['result'] = result
+    return Response(body=json.dumps(data).encode('utf-8'))
+
+
+def _parse_multipart(body, content_type):
+    boundary = None
+    for item in content_type.split(';'):
+        item = item.strip()
+        if item.startswith('boundary='):
+            boundary = item[9:].strip('"')
+    files = {}
+    params = {}
+    if not boundary:
+        return params, files
+    for part in body.split(b'--' + boundary.encode('latin-1')):
+        if b'\r\n\r\n' not in part:
+            continue
+        head, _, data = part.partition(b'\r\n\r\n')
+        if data.endswith(b'\r\n'):
+            data = data[:-2]
+        name = filename = None
+        for line in head.decode('latin-1').split('\r\n'):
+            if line.lower().startswith('content-disposition'):
+                for attr in line.split(';')[1:]:
+                    key, _, value = attr.strip().partition('=')
+                    if key == 'name':
+                        name = value.strip('"')
+                    elif key == 'filename':
+                        filename = value.strip('"')
+        if name is None:
+            continue
+        if filename is not None:
+            files[name] = data
+        else:
+            params.setdefault(name, []).append(data.decode('utf-8', 'replace'))
+    return params, files
+
+
+class Simulator(object):
+    """
+    Serves any number of SimulatedDevice instances.
+
+    :param mode: 'ports' (every device gets its own port) or 'hosts' (all devices share one port and are told apart
+    by the Host header / local address, use loopback addresses 127.x.y.z which Linux routes to lo)
+    :param host: bind address in ports mode; in hosts mode the shared socket is bound to bind (default 0.0.0.0)
+    :param base_port: first port to use
+    :param ssl_context: server SSLContext to serve https with (see make_ssl_context), None for plain http
+    """
+
+    def __init__(self, mode='ports', host='127.0.0.1', base_port=20000, bind=None, ssl_context=None):
+        if mode not in ('ports', 'hosts'):
+            raise ValueError("Unknown simulator mode {mode}".format(mode=mode))
+        self.mode = mode
+        self.host = host
+        self.base_port = base_port
+        self.bind = bind or ('0.0.0.0' if mode == 'hosts' else host)
+        self.ssl_context = ssl_context
+        self.devices = []
+        self.by_host = {}
+        self.loop = None
+        self._servers = []
+        self._tasks = []
+        self._connections = set()
+        self._thread = None
+        self._ready = threading.Event()
+        self._nonces = {}
+
+    def add_device(self, name=None, serial=None, profile=None):
+        index = len(self.devices)
+        serial = serial or '54-{0:04d}-{1:04d}'.format(index // 10000, index % 10000)
+        if self.mode == 'ports':
+            address = '{host}:{port}'.format(host=self.host, port=self.base_port + index)
+        else:
+            address = '127.{0}.{1}.{2}:{3}'.format(1 + index // 62500, (index // 250) % 250, index % 250 + 1,
+                                                    self.base_port)
+        device = SimulatedDevice(name or address, serial, profile or DeviceProfile(), address)
+        self.devices.append(device)
+        self.by_host[address.rsplit(':', 1)[0]] = device
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._start_device(device), self.loop).result()
+        return device
+
+    def add_devices(self, number, profile=None):
+        return [self.add_device(profile=profile) for _ in range(number)]
+
+    # --- lifecycle ---
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.mode == 'hosts':
+            server = await asyncio.start_server(self._serve, self.bind, self.base_port, backlog=4096,
+                                                ssl=self.ssl_context)
+            self._servers.append(server)
+        for device in self.devices:
+            await self._start_device(device)
+
+    async def _start_device(self, device):
+        device.loop = self.loop
+        if self.mode == 'ports':
+            port = int(device.address.rsplit(':', 1)[1])
+
+            async def serve(reader, writer, device=device):
+                await self._serve(reader, writer, device)
+
+            self._servers.append(await asyncio.start_server(serve, self.bind, port, backlog=1024,
+                                                                     ssl=self.ssl_context))
+        if device.profile.event_rate > 0:
+            self._tasks.append(self.loop.create_task(self._generate_events(device)))
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+        tasks = self._tasks + list(self._connections)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        self._tasks = []
+
+    def start_in_thread(self):
+        """
+        Runs the simulator in a daemon thread and returns once all devices are listening.
+        """
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            self._ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.close())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name='2n-simulator', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None and self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+            self.loop = None
+
+    def __enter__(self):
+        return self.start_in_thread()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    async def _generate_events(self, device):
+        kinds = ['MotionDetected', 'KeyPressed', 'CardEntered', 'InputChanged', 'CodeEntered']
+        while True:
+            await asyncio.sleep(random.expovariate(device.profile.event_rate))
+            kind = random.choice(kinds)
+            if kind == 'CardEntered':
+                params = {'direction': 'in', 'uid': '{0:08X}'.format(random.randint(0, 0xFFFF)), 'valid': True}
+            elif kind == 'CodeEntered':
+                params = {'code': '{0:04d}'.format(random.randint(0, 9999)), 'valid': False}
+            elif kind == 'KeyPressed':
+                params = {'key': str(random.randint(0, 9))}
+            elif kind == 'InputChanged':
+                params = {'port': 'input1', 'state': random.random() < 0.5}
+            else:
+                params = {'state': 'in'}
+            device.emit(kind, params)
+
+    # --- http ---
+
+    async def _serve(self, reader, writer, device=None):
+        if device is None:
+            sockname = writer.get_extra_info('sockname')
+            device = self.by_host.get(sockname[0]) if sockname else None
+        counted = device
+        task = asyncio.current_task()
+        self._connections.add(task)
+        if device is not None:
+            device.connections += 1
+            ssl_object = writer.get_extra_info('ssl_object')
+            if ssl_object is not None:
+                device.tls_handshakes += 1
+                device.tls_resumed += ssl_object.session_reused
+        try:
+            if device is not None and device.profile.max_connections is not None \
+                    and device.connections > device.profile.max_connections:
+                await self._write(writer, Response(503, b'', 'text/plain', close=True), None)
+                return
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, version = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        key, _, value = line.partition(':')
+                        headers[key.strip().lower()] = value.strip()
+
+                target_device = device
+                if self.mode == 'hosts':
+                    host = headers.get('host', '').rsplit(':', 1)[0]
+                    target_device = self.by_host.get(host, device)
+                if target_device is None:
+                    await self._write(writer, Response(404, b'', 'text/plain', close=True), None)
+                    return
+
+                body = await self._read_body(reader, headers, target_device.profile)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                response = await self._handle(target_device, method, target, headers, body)
+                if response is None:
+                    return  # simulated connection reset
+                response.close = response.close or not keep_alive
+                await self._write(writer, response, target_device.profile)
+                if response.close:
+                    return
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            if counted is not None:
+                counted.connections -= 1
+            writer.close()
+
+    async def _read_body(self, reader, headers, profile):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            return b''.join(chunks)
+
+        length = int(headers.get('content-length', 0) or 0)
+        if not length:
+            return b''
+        if not profile.bandwidth:
+            return await reader.readexactly(length)
+        chunks = []
+        remaining = length
+        while remaining:
+            chunk = await reader.readexactly(min(remaining, 16384))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            await asyncio.sleep(len(chunk) / float(profile.bandwidth))
+        return b''.join(chunks)
+
+    async def _write(self, writer, response, profile):
+        status_line = 'HTTP/1.1 {0} {1}\r\n'.format(response.status, REASONS.get(response.status, 'Error'))
+        headers = ['Content-Type: ' + response.content_type, 'Content-Length: ' + str(len(response.body)),
+                   'Server: 2N simulator']
+        headers.extend(response.headers)
+        if response.close:
+            headers.append('Connection: close')
+        writer.write((status_line + '\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+        if profile is None or not profile.bandwidth or len(response.body) <= 16384:
+            writer.write(response.body)
+            await writer.drain()
+            return
+        view = memoryview(response.body)
+        for offset in range(0, len(view), 16384):
+            chunk = view[offset:offset + 16384]
+            writer.write(chunk)
+            await writer.drain()
+            await asyncio.sleep(len(chunk) / float(profile.bandwidth))
+
+    async def _handle(self, device, method, target, headers, body):
+        profile = device.profile
+        device.requests += 1
+        delay = profile.latency + (random.uniform(0, profile.jitter) if profile.jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        if profile.error_rate and random.random() < profile.error_rate:
+            if profile.error_mode == 'reset':
+                return None
+            return Response(500, b'', 'text/plain')
+
+        url = urlsplit(target)
+        params = {}
+        for key, value in parse_qsl(url.query, keep_blank_values=True):
+            params.setdefault(key, []).append(value)
+        files = {}
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            for key, value in parse_qsl(body.decode('utf-8', 'replace'), keep_blank_values=True):
+                params.setdefault(key, []).append(value)
+        elif content_type.startswith('multipart/form-data'):
+            form, files = _parse_multipart(body, content_type)
+            for key, values in form.items():
+                params.setdefault(key, []).extend(values)
+
+        # /api/system/info is available regardless of the access rights
+        challenge = self._authenticate(profile, method, url, headers) if url.path != '/api/system/info' else None
+        if challenge is not None:
+            return challenge
+
+        handler = getattr(self, 'api_' + url.path.strip('/').replace('/', '_')[4:], None) \
+            if url.path.startswith('/api/') else None
+        if handler is None:
+            return self._error(2)
+        request = Request(method, url.path, params, files, headers, body)
+        try:
+            result = handler(device, request)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        except ApiError as err:
+            return self._error(err.code, err.param)
+        except (KeyError, ValueError) as err:
+            log.debug("Simulator rejected {path}: {err}".format(path=url.path, err=err))
+            return self._error(12)
+
+    @staticmethod
+    def _error(code, param=None):
+        error = {'code': code, 'description': ERRORS.get(code, 'error')}
+        if param:
+            error['param'] = param
+        return Response(body=json.dumps({'success': False, 'error': error}).encode('utf-8'))
+
+    def _authenticate(self, profile, method, url, headers):
+        if not profile.auth_type:
+            return None
+        authorization = headers.get('authorization', '')
+        if profile.auth_type == 1:
+            if authorization.startswith('Basic '):
+                user, _, password = b64decode(authorization[6:]).decode('utf-8').partition(':')
+                if user == profile.user and password == profile.password:
+                    return None
+            return Response(401, b'', 'text/plain', ['WWW-Authenticate: Basic realm="{0}"'.format(DIGEST_REALM)])
+
+        if authorization.startswith('Digest '):
+            fields = {}
+            for item in _split_header(authorization[7:]):
+                key, _, value = item.strip().partition('=')
+                fields[key] = value.strip('"')
+            nonce = fields.get('nonce')
+            if nonce in self._nonces and fields.get('username') == profile.user:
+                ha1 = _md5('{0}:{1}:{2}'.format(profile.user, DIGEST_REALM, profile.password))
+                ha2 = _md5('{0}:{1}'.format(method, fields.get('uri', '')))
+                if fields.get('qop'):
+                    expected = _md5(':'.join([ha1, nonce, fields.get('nc', ''), fields.get('cnonce', ''),
+                                              fields['qop'], ha2]))
+                else:
+                    expected = _md5(':'.join([ha1, nonce, ha2]))
+                if expected == fields.get('response'):
+                    return None
+        nonce = os.urandom(16).hex()
+        self._nonces[nonce] = True
+        if len(self._nonces) > 100000:
+            for key in list(self._nonces)[:50000]:
+                del self._nonces[key]
+        return Response(401, b'', 'text/plain', [
+            'WWW-Authenticate: Digest realm="{0}", qop="auth", nonce="{1}", algorithm=MD5'.format(DIGEST_REALM,
+                                                                                                nonce)])
+
+    # --- api handlers, named after the path below /api/ ---
+
+    def api_system_info(self, device, request):
+        return _json({'variant': device.variant, 'serialNumber': device.serial, 'hwVersion': '535v1',
+                      'swVersion': device.sw_version, 'buildType': '', 'deviceName': device.name})
+
+    def api_system_status(self, device, request):
+        now = time.time()
+        return _json({'systemTime': int(device.device_time(now)), 'upTime': int(now - device.boot_time)})
+
+    def api_system_restart(self, device, request):
+        device.loop.call_soon(device.restart)
+        return _json()
+
+    def api_firmware(self, device, request):
+        blob = request.files.get('blob-fw')
+        if not blob:
+            raise ApiError(11, 'blob-fw')
+        version = blob[:32].split(b'\0', 1)[0].decode('ascii', 'replace').strip() or device.sw_version
+        device.pending_firmware = version
+        return _json({'version': version, 'downgrade': version < device.sw_version})
+
+    def api_firmware_apply(self, device, request):
+        if device.pending_firmware is None:
+            raise ApiError(15)
+        device.sw_version = device.pending_firmware
+        device.pending_firmware = None
+        device.loop.call_soon(device.restart)
+        return _json()
+
+    def api_config(self, device, request):
+        if request.method == 'PUT':
+            blob = request.files.get('blob-cfg')
+            if not blob:
+                raise ApiError(11, 'blob-cfg')
+            device.config = blob
+            return _json()
+        return Response(body=device.config, content_type='application/xml')
+
+    def api_config_factoryreset(self, device, request):
+        device.config = make_config(device.serial, device.profile.config_size)
+        return _json()
+
+    def api_switch_caps(self, device, request):
+        switches = [{'switch': i, 'enabled': True, 'mode': 'monostable', 'switchOnDuration': 5, 'type': 'normal'}
+                    for i in self._select(device.switches, request.get('switch'))]
+        return _json({'switches': switches})
+
+    def api_switch_status(self, device, request):
+        switches = [{'switch': i, 'active': device.switches[i]['active']}
+                    for i in self._select(device.switches, request.get('switch'))]
+        return _json({'switches': switches})
+
+    def api_switch_ctrl(self, device, request):
+        switch = int(request.require('switch'))
+        action = request.require('action')
+        if switch not in device.switches:
+            raise ApiError(12, 'switch')
+        if action == 'on':
+            device.set_switch(switch, True)
+            device.switches[switch]['timer'] = device.loop.call_later(5, device.set_switch, switch, False)
+        elif action == 'off':
+            device.set_switch(switch, False)
+        elif action == 'trigger':
+            device.set_switch(switch, not device.switches[switch]['active'])
+        else:
+            raise ApiError(12, 'action')
+        return self._custom(request) or _json()
+
+    def api_io_caps(self, device, request):
+        ports = [{'port': p, 'type': 'input' if p.startswith('input') else 'output'}
+                 for p in self._select(device.ports, request.get('port'))]
+        return _json({'ports': ports})
+
+    def api_io_status(self, device, request):
+        ports = [{'port': p, 'state': int(device.ports[p])} for p in self._select(device.ports, request.get('port'))]
+        return _json({'ports': ports})
+
+    def api_io_ctrl(self, device, request):
+        port = request.require('port')
+        action = request.require('action')
+        if port not in device.ports or port.startswith('input'):
+            raise ApiError(12, 'port')
+        if action not in ('on', 'off'):
+            raise ApiError(12, 'action')
+        state = action == 'on'
+        if device.ports[port] != state:
+            device.ports[port] = state
+            device.emit('OutputChanged', {'port': port, 'state': state})
+        return self._custom(request) or _json()
+
+    def api_phone_status(self, device, request):
+        accounts = [{'account': a, 'sipNumber': '{0}{1}'.format(device.serial[-4:], a), 'registered': a == 1,
+                     'registerTime': int(device.boot_time)} for a in self._select({1: 0, 2: 0}, request.get('account'))]
+        return _json({'accounts': accounts})
+
+    def api_call_status(self, device, request):
+        sessions = [dict(session=s, **state) for s, state in sorted(device.calls.items())
+                    if request.get('session') is None or int(request.get('session')) == s]
+        return _json({'sessions': sessions})
+
+    def api_call_dial(self, device, request):
+        number = request.require('number')
+        session = next(device.sessions)
+        device.calls[session] = {'direction': 'outgoing', 'state': 'ringing', 'peer': number}
+        device.emit('CallStateChanged', {'direction': 'outgoing', 'state': 'ringing', 'peer': number,
+                                         'session': session})
+        return _json({'session': session})
+
+    def api_call_answer(self, device, request):
+        session = int(request.require('session'))
+        if session not in device.calls:
+            raise ApiError(12, 'session')
+        device.calls[session]['state'] = 'connected'
+        device.emit('CallStateChanged', dict(device.calls[session], session=session))
+        return _json()
+
+    def api_call_hangup(self, device, request):
+        session = int(request.require('session'))
+        call = device.calls.pop(session, None)
+        if call is None:
+            raise ApiError(12, 'session')
+        device.emit('CallStateChanged', dict(call, state='terminated', session=session))
+        return _json()
+
+    def api_camera_caps(self, device, request):
+        return _json({'jpegResolution': [{'width': w, 'height': h} for w, h in JPEG_RESOLUTIONS],
+                      'sources': [{'source': 'internal'}, {'source': 'external'}]})
+
+    def api_camera_snapshot(self, device, request):
+        width = int(request.require('width'))
+        height = int(request.require('height'))
+        if (width, height) not in JPEG_RESOLUTIONS:
+            raise ApiError(12, 'width')
+        if request.get('source') not in (None, 'internal', 'external'):
+            raise ApiError(12, 'source')
+        size = device.profile.snapshot_size * width * height // (640 * 480)
+        tag = '{0} {1}'.format(device.serial, next(device.frames)).encode('ascii')
+        return Response(body=make_jpeg(width, height, size, tag), content_type='image/jpeg')
+
+    def api_display_caps(self, device, request):
+        return _json({'displays': [{'display': 'internal', 'resolution': {'width': 320, 'height': 240}}]})
+
+    def api_display_image(self, device, request):
+        if request.require('display') != 'internal':
+            raise ApiError(12, 'display')
+        if request.method == 'DELETE':
+            device.display_image = None
+            return _json()
+        blob = request.files.get('blob-image')
+        if not blob:
+            raise ApiError(11, 'blob-image')
+        if not blob.startswith(b'GIF8'):
+            raise ApiError(12, 'blob-image')
+        device.display_image = blob
+        return _json()
+
+    def api_log_caps(self, device, request):
+        return _json({'events': EVENT_TYPES})
+
+    def api_log_subscribe(self, device, request):
+        self._expire(device)
+        duration = min(int(request.get('duration', 90)), 3600)
+        filters = request.params.get('filter')
+        event_filter = None
+        if filters:
+            event_filter = set(f.strip() for value in filters for f in value.split(',') if f.strip())
+        sub = Subscription(next(device.sids), event_filter, duration)
+        include = request.get('include', 'new')
+        if include != 'new':
+            since = None
+            if include != 'all':
+                since = time.monotonic() + int(include)
+            for stamp, record in device.history:
+                if (since is None or stamp >= since) and (event_filter is None or record['event'] in event_filter):
+                    sub.queue.append(record)
+        device.subscriptions[sub.id] = sub
+        return _json({'id': sub.id})
+
+    def api_log_unsubscribe(self, device, request):
+        sub = device.subscriptions.pop(int(request.require('id')), None)
+        if sub is None:
+            raise ApiError(12, 'id')
+        if sub.waiter is not None and not sub.waiter.done():
+            sub.waiter.set_result(None)
+        return _json()
+
+    async def api_log_pull(self, device, request):
+        self._expire(device)
+        sub = device.subscriptions.get(int(request.require('id')))
+        if sub is None:
+            raise ApiError(12, 'id')
+        timeout = int(request.get('timeout', 0))
+        sub.expires = time.monotonic() + sub.duration + timeout
+        if not sub.queue and timeout > 0:
+            sub.waiter = device.loop.create_future()
+            try:
+                await asyncio.wait_for(sub.waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                sub.waiter = None
+        events = list(sub.queue)
+        sub.queue.clear()
+        return _json({'events': events})
+
+    def api_audio_test(self, device, request):
+        device.emit('AudioLoopTest', {'result': 'passed'})
+        return _json()
+
+    def api_email_send(self, device, request):
+        request.require('to')
+        request.require('subject')
+        return _json()
+
+    def api_pcap(self, device, request):
+        if device.pcap_data is None:
+            device.pcap_data = make_pcap(device.profile.pcap_size)
+        return Response(body=device.pcap_data, content_type='application/octet-stream')
+
+    def api_pcap_restart(self, device, request):
+        device.pcap_data = None
+        return _json()
+
+    def api_pcap_stop(self, device, request):
+        return _json()
+
+    @staticmethod
+    def _select(items, key):
+        if key is None or key == '' or key == '0':
+            return sorted(items)
+        for item in items:
+            if str(item) == key:
+                return [item]
+        raise ApiError(12)
+
+    @staticmethod
+    def _custom(request):
+        text = request.get('response')
+        if text:
+            return Response(body=text.encode('utf-8'), content_type='text/plain')
+        return None
+
+    @staticmethod
+    def _expire(device):
+        now = time.monotonic()
+        for sid in [sid for sid, sub in device.subscriptions.items() if sub.expires < now and sub.waiter is None]:
+            del device.subscriptions[sid]
+
+
+def _md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def _split_header(value):
+    items = []
+    current = []
+    quoted = False
+    for char in value:
+        if char == '"':
+            quoted = not quoted
+        if char == ',' and not quoted:
+            items.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    items.append(''.join(current))
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local 2N HTTP API simulator')
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--mode', choices=['ports', 'hosts'], default='ports')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=20000)
+    parser.add_argument('--auth', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='2n')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=None)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-mode', choices=['500', 'reset'], default='500')
+    parser.add_argument('--max-connections', type=int, default=None)
+    parser.add_argument('--event-rate', type=float, default=0.0)
+    parser.add_argument('--tls', action='store_true', help='serve https with a self-signed certificate')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    profile = DeviceProfile(latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+                            error_rate=args.error_rate, error_mode=args.error_mode,
+                            max_connections=args.max_connections, auth_type=args.auth, user=args.user,
+                            password=args.password, event_rate=args.event_rate)
+    sim = Simulator(mode=args.mode, host=args.host, base_port=args.port,
+                    ssl_context=make_ssl_context() if args.tls else None)
+    sim.add_devices(args.devices, profile)
+    log.info("Simulating {n} devices, first at {first}".format(n=args.devices, first=sim.devices[0].address))
+
+    async def run():
+        await sim.start()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""
+Content-addressed snapshot archive.
+
+Frames are stored once per content hash in packed segment files, however often they were captured. A catalog of
+fixed-size entries (time, device, source, location and hash of the frame) is read through a memory map and indexed
+per device and source, so "the frames of device X, internal camera, between 08:00 and 09:00" is a bisect.
+
+A frame identical to the last archived frame of its device and source is skipped. With near_threshold set, frames
+are also skipped when their downscaled greyscale version differs from the last archived one by less than that mean
+absolute difference (0..1); this needs Pillow and NumPy. Storage then grows with changes of the scene instead of with
+the capture rate.
+
+Example:
+    archive = SnapshotArchive('/var/lib/2n/snapshots', near_threshold=0.02)
+    archive.capture(ip_cam, 640, 480)
+    ...
+    for item in archive.query(device=ip_cam.ip_address, since=time.time() - 3600):
+        jpeg = archive.read(item)
+    archive.retain(max_age=30 * 86400, max_bytes=20 * 1024 ** 3)
+
+Pack layout: blobs of header (length uint32, crc32 uint32, 16 byte blake2b digest) followed by the JPEG data.
+Catalog layout (catalog.dat): entries of utc float64, device code uint32, source code uint16, reserved uint16, pack
+number uint32, blob offset uint32, data length uint32, digest 16 bytes. Device and source names are interned in
+names.json.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+
+log = logging.getLogger(__name__)
+
+BLOB = struct.Struct('<II16s')
+ENTRY = struct.Struct('<dIHHIII16s')
+SIGNATURE_SIZE = (32, 24)
+
+
+class SnapshotArchive(object):
+    """
+    :param directory: archive directory, created if missing
+    :param pack_size: packs are closed and a new one is started when they reach this size in bytes
+    :param near_threshold: skip frames closer than this to the last archived frame of the device (None: exact only)
+    :param fsync_interval: maximum seconds between fsyncs
+    """
+
+    def __init__(self, directory, pack_size=256 * 1024 * 1024, near_threshold=None, fsync_interval=1.0):
+        self.directory = directory
+        self.pack_size = pack_size
+        self.near_threshold = near_threshold
+        self.fsync_interval = fsync_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.RLock()
+        self._names_path = os.path.join(directory, 'names.json')
+        self._catalog_path = os.path.join(directory, 'catalog.dat')
+        self.device_names = []
+        self.source_names = []
+        if os.path.exists(self._names_path):
+            with open(self._names_path) as f:
+                names = json.load(f)
+            self.device_names = names['devices']
+            self.source_names = names['sources']
+        self._device_codes = dict((name, i) for i, name in enumerate(self.device_names))
+        self._source_codes = dict((name, i) for i, name in enumerate(self.source_names))
+
+        self.stored = self.linked = self.skipped = 0
+        self._readers = {}
+        self._signatures = {}
+        self._load()
+        self._last_sync = time.monotonic()
+        self._dirty = False
+
+    def _load(self):
+        self._blobs = {}  # digest -> [pack, offset, length, references]
+        self._keys = {}  # (device code, source code) -> (utc array, catalog position array)
+        self._last = {}  # (device code, source code) -> digest of the last archived frame
+        self.count = 0
+        if os.path.exists(self._catalog_path):
+            size = os.path.getsize(self._catalog_path)
+            if size % ENTRY.size:
+                log.warning("Truncating torn tail of {path}".format(path=self._catalog_path))
+                with open(self._catalog_path, 'r+b') as f:
+                    f.truncate(size - size % ENTRY.size)
+        self._catalog = open(self._catalog_path, 'ab')
+        self._catalog_map = None
+        self._mapped = 0
+        data = self._entries()
+        for position in range(len(data) // ENTRY.size):
+            self._index(position, ENTRY.unpack_from(data, position * ENTRY.size))
+
+        packs = sorted(int(name[:-5]) for name in os.listdir(self.directory) if name.endswith('.pack'))
+        self._pack_number = packs[-1] if packs else 1
+        self._pack = open(self._pack_path(self._pack_number), 'ab')
+        self._pack_offset = self._pack.tell()
+
+    def _index(self, position, entry):
+        utc, device, source, _, pack, offset, length, digest = entry
+        blob = self._blobs.get(digest)
+        if blob is None:
+            self._blobs[digest] = [pack, offset, length, 1]
+        else:
+            blob[3] += 1
+        times, positions = self._keys.setdefault((device, source), (array('d'), array('Q')))
+        if not times or utc >= times[-1]:
+            times.append(utc)
+            positions.append(position)
+            self._last[device, source] = digest
+        else:
+            at = bisect_right(times, utc)
+            times.insert(at, utc)
+            positions.insert(at, position)
+        self.count += 1
+
+    def _pack_path(self, number):
+        return os.path.join(self.directory, '{0:08d}.pack'.format(number))
+
+    def _entries(self):
+        self._catalog.flush()
+        size = os.path.getsize(self._catalog_path)
+        if self._catalog_map is None or self._mapped != size:
+            # the previous map is not closed: running queries still read it, it is unmapped with its last reference
+            self._catalog_map = None
+            self._mapped = size
+            if size:
+                with open(self._catalog_path, 'rb') as f:
+                    self._catalog_map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        return self._catalog_map if self._catalog_map is not None else b''
+
+    def _intern(self, codes, names, name):
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(names)
+            names.append(name)
+            tmp = self._names_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'devices': self.device_names, 'sources': self.source_names}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self._names_path)
+        return code
+
+    # --- write path ---
+
+    def capture(self, ip_cam, width, height, source=None):
+        """
+        Takes a snapshot with CommandService.camera_snapshot_data and archives it.
+        :return: see add
+        """
+        return self.add(ip_cam.ip_address, ip_cam.commands.camera_snapshot_data(width, height, source=source),
+                        source=source)
+
+    def add(self, device, data, source=None, utc=None):
+        """
+        :param device: device name (ip_address for capture)
+        :param data: JPEG bytes
+        :param utc: capture time, now by default
+        :return: 'stored' (new content), 'linked' (content already archived, only a catalog entry was added) or
+        'skipped' (same as, or with near_threshold close to, the last archived frame of the device and source)
+        """
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        utc = time.time() if utc is None else utc
+        signature = None
+        with self._lock:
+            device_code = self._intern(self._device_codes, self.device_names, device)
+            source_code = self._intern(self._source_codes, self.source_names, source or '')
+            key = (device_code, source_code)
+            last = self._last.get(key)
+            if last == digest:
+                self.skipped += 1
+                return 'skipped'
+            if self.near_threshold is not None and last is not None:
+                signature = _signature(data)
+                previous = self._signatures.get(key)
+                if previous is None:
+                    previous = self._signatures[key] = _signature(self._read_blob(last))
+                if signature is not None and previous is not None and \
+                        _difference(signature, previous) < self.near_threshold:
+                    self.skipped += 1
+                    return 'skipped'
+
+            blob = self._blobs.get(digest)
+            status = 'linked'
+            if blob is None:
+                if self._pack_offset >= self.pack_size:
+                    self._roll()
+                offset = self._pack_offset
+                self._pack.write(BLOB.pack(len(data), zlib.crc32(data), digest))
+                self._pack.write(data)
+                self._pack_offset += BLOB.size + len(data)
+                blob = [self._pack_number, offset, len(data), 0]
+                status = 'stored'
+            self._pack.flush()  # the blob must be on disk before a catalog entry points to it
+            self._catalog.write(ENTRY.pack(utc, device_code, source_code, 0, blob[0], blob[1], blob[2], digest))
+            if status == 'stored':
+                self._blobs[digest] = blob
+                blob[3] -= 1  # _index counts the reference
+                self.stored += 1
+            else:
+                self.linked += 1
+            self._index(self.count, (utc, device_code, source_code, 0, blob[0], blob[1], blob[2], digest))
+            if self._last.get(key) == digest:
+                if signature is None:
+                    self._signatures.pop(key, None)  # computed from the stored frame when needed
+                else:
+                    self._signatures[key] = signature
+            self._dirty = True
+            if time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+            return status
+
+    def _roll(self):
+        self.sync()
+        self._pack.close()
+        self._pack_number += 1
+        self._pack = open(self._pack_path(self._pack_number), 'ab')
+        self._pack_offset = 0
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                for f in (self._pack, self._catalog):
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._dirty = False
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._pack.close()
+            self._catalog.close()
+            if self._catalog_map is not None:
+                self._catalog_map.close()
+                self._catalog_map = None
+            for reader in self._readers.values():
+                reader.close()
+            self._readers = {}
+
+    # --- read path ---
+
+    def query(self, device=None, source=None, since=None, until=None, limit=None):
+        """
+        Yields catalog entries as dicts (device, source, utc, digest, size, pack, offset), per device and source
+        ordered by time.
+
+        :param source: video source name, '' for snapshots taken without source
+        """
+        with self._lock:
+            data = self._entries()
+            keys = [key for key in self._keys
+                    if (device is None or self.device_names[key[0]] == device) and
+                    (source is None or self.source_names[key[1]] == source)]
+            selected = []
+            for key in keys:
+                times, positions = self._keys[key]
+                lo = bisect_left(times, since) if since is not None else 0
+                hi = bisect_right(times, until) if until is not None else len(times)
+                selected.append(positions[lo:hi])
+
+        found = 0
+        for positions in selected:
+            for position in positions:
+                utc, dcode, scode, _, pack, offset, length, digest = ENTRY.unpack_from(data, position * ENTRY.size)
+                yield {'device': self.device_names[dcode], 'source': self.source_names[scode], 'utc': utc,
+                       'digest': digest.hex(), 'size': length, 'pack': pack, 'offset': offset}
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def read(self, item):
+        """
+        :param item: entry returned by query
+        :return: JPEG bytes
+        """
+        with self._lock:
+            blob = self._blobs.get(bytes.fromhex(item['digest']))
+            if blob is None:
+                raise KeyError('Snapshot {digest} is no longer archived'.format(digest=item['digest']))
+            return self._read_blob(bytes.fromhex(item['digest']))
+
+    def _read_blob(self, digest):
+        pack, offset, length, _ = self._blobs[digest]
+        if pack == self._pack_number:
+            self._pack.flush()
+        reader = self._readers.get(pack)
+        if reader is None:
+            reader = self._readers[pack] = open(self._pack_path(pack), 'rb')
+        header = os.pread(reader.fileno(), BLOB.size, offset)
+        data = os.pread(reader.fileno(), length, offset + BLOB.size)
+        size, crc, stored_digest = BLOB.unpack(header)
+        if size != length or stored_digest != digest or zlib.crc32(data) != crc:
+            raise IOError('Corrupted snapshot in {path} at {offset}'.format(path=self._pack_path(pack), offset=offset))
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {'entries': self.count, 'blobs': len(self._blobs),
+                    'bytes': sum(blob[2] + BLOB.size for blob in self._blobs.values()),
+                    'stored': self.stored, 'linked': self.linked, 'skipped': self.skipped}
+
+    # --- retention ---
+
+    def retain(self, max_age=None, max_bytes=None, compact_ratio=0.5):
+        """
+        Drops catalog entries older than max_age seconds, then the oldest entries until the archived frames take
+        at most max_bytes. Packs without referenced frames are deleted, packs with less than compact_ratio of
+        their size still referenced are compacted into the current pack.
+        :return: dict with the number of dropped entries and deleted packs
+        """
+        with self._lock:
+            self.sync()
+            data = self._entries()
+            entries = sorted((ENTRY.unpack_from(data, p * ENTRY.size) for p in range(len(data) // ENTRY.size)),
+                             key=lambda entry: entry[0])
+            start = 0
+            if max_age is not None:
+                cutoff = time.time() - max_age
+                while start < len(entries) and entries[start][0] < cutoff:
+                    start += 1
+            references = {}
+            for entry in entries[start:]:
+                references[entry[7]] = references.get(entry[7], 0) + 1
+            sizes = dict((digest, self._blobs[digest][2] + BLOB.size) for digest in references)
+            total = sum(sizes.values())
+            if max_bytes is not None:
+                while start < len(entries) and total > max_bytes:
+                    digest = entries[start][7]
+                    references[digest] -= 1
+                    if not references[digest]:
+                        del references[digest]
+                        total -= sizes[digest]
+                    start += 1
+            dropped = start
+            kept = entries[start:]
+
+            live = {}
+            pack_sizes = {}
+            for digest in references:
+                pack = self._blobs[digest][0]
+                live[pack] = live.get(pack, 0) + sizes[digest]
+            for number in sorted(int(name[:-5]) for name in os.listdir(self.directory) if name.endswith('.pack')):
+                pack_sizes[number] = os.path.getsize(self._pack_path(number))
+            obsolete = [number for number, size in pack_sizes.items() if number != self._pack_number and
+                        live.get(number, 0) < size * compact_ratio]
+
+            moved = {}
+            for digest in references:
+                if self._blobs[digest][0] in obsolete:
+                    frame = self._read_blob(digest)
+                    if self._pack_offset >= self.pack_size:
+                        self._roll()
+                    moved[digest] = (self._pack_number, self._pack_offset)
+                    self._pack.write(BLOB.pack(len(frame), zlib.crc32(frame), digest))
+                    self._pack.write(frame)
+                    self._pack_offset += BLOB.size + len(frame)
+            self._pack.flush()
+            os.fsync(self._pack.fileno())
+
+            tmp = self._catalog_path + '.tmp'
+            with open(tmp, 'wb') as f:
+                for utc, device, source, flags, pack, offset, length, digest in kept:
+                    pack, offset = moved.get(digest, (pack, offset))
+                    f.write(ENTRY.pack(utc, device, source, flags, pack, offset, length, digest))
+                f.flush()
+                os.fsync(f.fileno())
+            self._catalog.close()
+            self._catalog_map = None
+            os.rename(tmp, self._catalog_path)
+            for number in obsolete:
+                reader = self._readers.pop(number, None)
+                if reader is not None:
+                    reader.close()
+                os.unlink(self._pack_path(number))
+
+            self._pack.close()
+            self._signatures = {}
+            self._load()
+            return {'dropped': dropped, 'packs_deleted': len(obsolete), 'frames_moved': len(moved)}
+
+
+def _signature(data):
+    """
+    :return: downscaled greyscale version of a JPEG as a float32 array in 0..1, None if it cannot be decoded
+    """
+    import io
+
+    import numpy as np
+    from PIL import Image
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.draft('L', (SIGNATURE_SIZE[0] * 2, SIGNATURE_SIZE[1] * 2))  # let the JPEG decoder downscale
+        image = image.convert('L').resize(SIGNATURE_SIZE, Image.BILINEAR)
+    except Exception as err:
+        log.debug("Cannot decode snapshot: {err}".format(err=err))
+        return None
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def _difference(a, b):
+    import numpy as np
+
+    return float(np.abs(a - b).mean())
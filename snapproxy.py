@@ -0,0 +1,317 @@
+"""
+Snapshot proxy serving the latest camera frame of many devices to many viewers.
+
+Every viewer asking for the same device, source and resolution gets the same frame: the device is asked for a new
+snapshot at most `rate` times per second, and concurrent requests arriving while a fetch is running wait for that
+fetch instead of starting their own. A frame is kept as one bytes object which is written to every viewer's socket as
+is, without per-viewer copies. Frames carry an ETag, so viewers polling with If-None-Match get a bodyless 304 until
+the picture changes. Cached frames are evicted least recently used first once max_bytes is exceeded or more than
+max_feeds device/source/resolution combinations are cached. Only the resolutions and sources the device lists in
+/api/camera/caps are accepted.
+
+URLs: /snapshot/<device ip>[/<source>][?width=640&height=480]
+
+Example:
+    proxy = SnapshotProxy(ip_cams, ('0.0.0.0', 8080), rate=2)
+    proxy.serve_forever()
+
+Run "python snapproxy.py --help" to start it stand-alone.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+log = logging.getLogger(__name__)
+
+
+class Frame(object):
+    __slots__ = ('data', 'etag', 'fetched')
+
+    def __init__(self, data, fetched):
+        self.data = data
+        self.etag = '"{digest}"'.format(digest=hashlib.blake2b(data, digest_size=12).hexdigest())
+        self.fetched = fetched
+
+
+class _Feed(object):
+    """
+    Latest frame of one device/source/resolution (or the camera caps of a device) plus the state of the fetch in
+    progress.
+    """
+
+    __slots__ = ('frame', 'attempted', 'error', 'fetching', 'done')
+
+    def __init__(self):
+        self.frame = None
+        self.attempted = 0.0
+        self.error = None
+        self.fetching = False
+        self.done = threading.Condition()
+
+
+class FrameCache(object):
+    """
+    :param devices: iterable of IPCam
+    :param rate: maximum snapshots per second fetched from a device for one source and resolution
+    :param max_bytes: memory bound of the cached frames
+    :param max_feeds: maximum number of device/source/resolution combinations kept
+    :param timeout: seconds a viewer waits for a fetch started by another viewer
+    """
+
+    def __init__(self, devices, rate=1.0, max_bytes=64 * 1024 * 1024, max_feeds=1024, timeout=10):
+        self.devices = dict((ip_cam.ip_address, ip_cam) for ip_cam in devices)
+        self.interval = 1.0 / rate
+        self.max_bytes = max_bytes
+        self.max_feeds = max_feeds
+        self.timeout = timeout
+        self.size = 0
+        self.fetches = 0
+        self.hits = 0
+        self._feeds = OrderedDict()
+        self._caps = {}  # device -> _Feed of (set of (width, height), set of sources)
+        self._lock = threading.Lock()
+
+    def get(self, device, source=None, width=640, height=480):
+        """
+        :return: latest Frame, fetched from the device if the cached one is older than 1/rate seconds
+        :raise KeyError: unknown device
+        :raise ValueError: resolution or source not supported by the device
+        :raise IOError: no frame could be fetched
+        """
+        ip_cam = self.devices[device]
+        resolutions, sources = self.caps(device)
+        if (width, height) not in resolutions:
+            raise ValueError('Unsupported resolution {width}x{height}'.format(width=width, height=height))
+        if source is not None and source not in sources:
+            raise ValueError('Unknown video source {source}'.format(source=source))
+        key = (device, source, width, height)
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None:
+                feed = self._feeds[key] = _Feed()
+                while len(self._feeds) > self.max_feeds:
+                    self._evict()
+            self._feeds.move_to_end(key)
+
+        with feed.done:
+            now = time.monotonic()
+            if feed.fetching or now - feed.attempted < self.interval:
+                if feed.fetching:
+                    feed.done.wait_for(lambda: not feed.fetching, self.timeout)
+                if feed.frame is None:
+                    raise IOError(feed.error or 'No frame available')
+                self.hits += 1
+                return feed.frame
+            feed.fetching = True
+            feed.attempted = now
+
+        frame = None
+        try:
+            data = ip_cam.commands.camera_snapshot_data(width, height, source=source)
+            frame = Frame(data, time.time())
+            self.fetches += 1
+        except Exception as err:
+            log.warning("{ip}: snapshot failed: {err}".format(ip=device, err=err))
+            error = str(err) or type(err).__name__
+        with feed.done:
+            old = feed.frame
+            if frame is not None:
+                if old is not None and old.etag == frame.etag:
+                    frame = old  # unchanged picture, keep the ETag and the object viewers already hold
+                feed.frame = frame
+                feed.error = None
+            else:
+                feed.error = error
+            feed.fetching = False
+            feed.done.notify_all()
+            result = feed.frame
+        if frame is not None and frame is not old:
+            self._account(key, feed, len(frame.data) - (len(old.data) if old is not None else 0))
+        if result is None:
+            raise IOError(error)
+        return result
+
+    def caps(self, device):
+        """
+        :return: (set of (width, height), set of source names) from the device's /api/camera/caps, fetched once;
+        after a failure the device is asked again at most every 1/rate seconds
+        :raise IOError: the capabilities could not be read
+        """
+        ip_cam = self.devices[device]
+        with self._lock:
+            feed = self._caps.get(device)
+            if feed is None:
+                feed = self._caps[device] = _Feed()
+
+        with feed.done:
+            if feed.frame is not None:
+                return feed.frame
+            now = time.monotonic()
+            if feed.fetching or now - feed.attempted < self.interval:
+                if feed.fetching:
+                    feed.done.wait_for(lambda: not feed.fetching, self.timeout)
+                if feed.frame is None:
+                    raise IOError(feed.error or 'Camera capabilities of {ip} not available'.format(ip=device))
+                return feed.frame
+            feed.fetching = True
+            feed.attempted = now
+
+        caps = None
+        try:
+            reply = ip_cam.cache.get('camera_caps') if getattr(ip_cam, 'cache', None) is not None \
+                else ip_cam.commands.camera_caps()
+            result = json.loads(reply)['result']
+            caps = (set((item['width'], item['height']) for item in result['jpegResolution']),
+                    set(item['source'] for item in result.get('sources', ())))
+        except Exception as err:
+            log.warning("{ip}: camera caps failed: {err}".format(ip=device, err=err))
+            error = 'Camera capabilities of {ip} not available: {err}'.format(ip=device, err=err)
+        with feed.done:
+            if caps is not None:
+                feed.frame = caps
+                feed.error = None
+            else:
+                feed.error = error
+            feed.fetching = False
+            feed.done.notify_all()
+        if caps is None:
+            raise IOError(error)
+        return caps
+
+    def _evict(self):
+        _, evicted = self._feeds.popitem(last=False)
+        if evicted.frame is not None:
+            self.size -= len(evicted.frame.data)
+
+    def _account(self, key, feed, delta):
+        with self._lock:
+            if self._feeds.get(key) is not feed:
+                return  # evicted while fetching
+            self.size += delta
+            while self.size > self.max_bytes and len(self._feeds) > 1:
+                self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {'feeds': len(self._feeds), 'bytes': self.size, 'fetches': self.fetches, 'hits': self.hits}
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if not parts or parts[0] != 'snapshot' or len(parts) not in (2, 3):
+            return self._error(404, 'Unknown path')
+        query = dict(parse_qsl(url.query))
+        cache = self.server.cache
+        try:
+            width = int(query.get('width', self.server.width))
+            height = int(query.get('height', self.server.height))
+        except ValueError:
+            return self._error(400, 'Invalid resolution')
+
+        try:
+            frame = cache.get(parts[1], parts[2] if len(parts) == 3 else None, width, height)
+        except KeyError:
+            return self._error(404, 'Unknown device')
+        except ValueError as err:
+            return self._error(400, str(err))
+        except IOError as err:
+            return self._error(502, str(err))
+
+        if frame.etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', frame.etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(frame.data)))
+        self.send_header('ETag', frame.etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Last-Modified', self.date_time_string(frame.fetched))
+        self.end_headers()
+        self.wfile.write(frame.data)
+
+    def _error(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+
+class SnapshotProxy(ThreadingHTTPServer):
+    """
+    :param devices: iterable of IPCam
+    :param address: (host, port) to listen on
+    :param rate, max_bytes, max_feeds: see FrameCache
+    :param width, height: resolution served if the viewer does not ask for one
+    """
+
+    daemon_threads = True
+
+    def __init__(self, devices, address=('0.0.0.0', 8080), rate=1.0, max_bytes=64 * 1024 * 1024, max_feeds=1024,
+                 width=640, height=480):
+        super(SnapshotProxy, self).__init__(address, SnapshotHandler)
+        self.cache = FrameCache(devices, rate=rate, max_bytes=max_bytes, max_feeds=max_feeds)
+        self.width = width
+        self.height = height
+
+    def start_in_thread(self):
+        thread = threading.Thread(target=self.serve_forever, name='2n-snapproxy', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    from core import IPCam
+    from transport import PooledTransport
+
+    parser = argparse.ArgumentParser(description='Snapshot proxy for 2N devices')
+    parser.add_argument('devices', nargs='+', help='device ip addresses')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--auth', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('--rate', type=float, default=1.0, help='snapshots per second per device and source')
+    parser.add_argument('--max-mb', type=int, default=64)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pool = PooledTransport(hosts=len(args.devices))
+    ip_cams = [IPCam(ip, ssl=args.ssl, auth_type=args.auth, user=args.user, password=args.password, transport=pool)
+               for ip in args.devices]
+    proxy = SnapshotProxy(ip_cams, (args.host, args.port), rate=args.rate, max_bytes=args.max_mb * 1024 * 1024)
+    log.info("Serving snapshots of {n} devices on {host}:{port}".format(n=len(ip_cams), host=args.host,
+                                                                      port=args.port))
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    proxy.server_close()
+
+
+if __name__ == '__main__':
+    main()
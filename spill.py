@@ -0,0 +1,187 @@
+"""
+Disk-backed FIFO queue for event batches that cannot be kept in memory or delivered right now.
+
+Records (JSON-serialisable values, typically lists of events) are appended to segment files. A cursor file remembers
+the position of the oldest record not yet committed, so after a restart the queue continues where the consumer
+stopped. Records are replayed in the order they were appended. Delivery is at least once: a record committed just
+before a crash may be returned again.
+
+Example:
+    queue = SpillQueue('/var/lib/2n/spill/webhook')
+    queue.append(events)
+    ...
+    record = queue.peek()
+    if record is not None and deliver(record):
+        queue.commit()
+
+Segment layout: records of length uint32 and crc32 uint32 followed by the compact JSON.
+"""
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<II')
+
+
+class SpillQueue(object):
+    """
+    :param directory: queue directory, created if missing
+    :param segment_size: segments are rolled at this size in bytes and deleted once fully consumed
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._cursor_path = os.path.join(directory, 'cursor.json')
+        numbers = sorted(int(name[:-6]) for name in os.listdir(directory) if name.endswith('.spill'))
+        self._read = (numbers[0] if numbers else 1, 0)
+        if os.path.exists(self._cursor_path):
+            with open(self._cursor_path) as f:
+                cursor = json.load(f)
+            if not numbers or cursor['segment'] >= numbers[0]:
+                self._read = (cursor['segment'], cursor['offset'])
+        self._write_number = numbers[-1] if numbers else self._read[0]
+        self._writer = open(self._path(self._write_number), 'ab')
+        self.size = sum(os.path.getsize(self._path(n)) for n in numbers if n >= self._read[0]) - self._read[1]
+        self.appended = 0
+        self._reader = None
+        self._reader_number = None
+        self._peeked = []  # (record, position after it) returned by peek, not committed yet
+
+    def _path(self, number):
+        return os.path.join(self.directory, '{0:08d}.spill'.format(number))
+
+    def __len__(self):
+        """
+        Bytes not consumed yet (0 means empty).
+        """
+        return max(0, self.size)
+
+    def append(self, record):
+        payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            if self._writer.tell() >= self.segment_size:
+                self._writer.close()
+                self._write_number += 1
+                self._writer = open(self._path(self._write_number), 'ab')
+            self._writer.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self._writer.flush()
+            self.size += HEADER.size + len(payload)
+            self.appended += 1
+
+    def sync(self):
+        with self._lock:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+
+    def peek(self):
+        """
+        :return: the oldest record not committed yet, None if the queue is empty
+        """
+        records = self.peek_many(1)
+        return records[0] if records else None
+
+    def peek_many(self, limit, weight=len):
+        """
+        :return: list of the oldest records not committed yet, as many as fit into limit (at least one), measured
+        with the weight function (number of events of a batch by default)
+        """
+        with self._lock:
+            total = sum(weight(record) for record, _ in self._peeked)
+            while not self._peeked or total < limit:
+                record = self._read_next()
+                if record is None:
+                    break
+                total += weight(record)
+            return [record for record, _ in self._peeked]
+
+    def _read_next(self):
+        while True:
+            number, offset = self._peeked[-1][1] if self._peeked else self._read
+            if self._reader is None or self._reader_number != number:
+                if self._reader is not None:
+                    self._reader.close()
+                    self._reader = None
+                if not os.path.exists(self._path(number)):
+                    return None
+                self._reader = open(self._path(number), 'rb')
+                self._reader_number = number
+            self._reader.seek(offset)
+            header = self._reader.read(HEADER.size)
+            if len(header) == HEADER.size:
+                length, crc = HEADER.unpack(header)
+                payload = self._reader.read(length)
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    record = json.loads(payload.decode('utf-8'))
+                    self._peeked.append((record, (number, offset + HEADER.size + length)))
+                    return record
+                if len(payload) == length:
+                    log.error("Corrupted record in {path} at {offset}, skipping the rest of the segment".format(
+                        path=self._path(number), offset=offset))
+                elif number == self._write_number:
+                    return None  # record still being written
+            elif number == self._write_number:
+                return None
+            # end of a finished segment
+            if number == self._write_number:
+                self._roll_writer()
+            if self._peeked:
+                return None  # the segment is deleted once the peeked records are committed
+            self._reader.close()
+            self._reader = None
+            self._read = (number + 1, 0)
+            self.size = self._pending_size()
+            os.unlink(self._path(number))
+            self._save_cursor()
+
+    def _roll_writer(self):
+        self._writer.close()
+        self._write_number += 1
+        self._writer = open(self._path(self._write_number), 'ab')
+
+    def _pending_size(self):
+        total = 0
+        for number in range(self._read[0], self._write_number + 1):
+            path = self._path(number)
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total - self._read[1]
+
+    def commit(self):
+        """
+        Removes the records returned by peek or peek_many.
+        """
+        with self._lock:
+            for _, position in self._peeked:
+                if position[0] != self._read[0]:
+                    self._read = (position[0], 0)
+                    self.size = self._pending_size()
+                self.size -= position[1] - self._read[1]
+                self._read = position
+            if self._peeked:
+                self._peeked = []
+                self._save_cursor()
+
+    def _save_cursor(self):
+        tmp = self._cursor_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'segment': self._read[0], 'offset': self._read[1]}, f)
+        os.replace(tmp, self._cursor_path)
+
+    def close(self):
+        with self._lock:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._writer.close()
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
@@ -0,0 +1,55 @@
+from analytics import EventFrame
+
+
+def rows():
+    return [
+        {'device': 'a', 'event': 'SwitchStateChanged', 'utcTime': 0, 'params': {'switch': 1, 'state': True}},
+        {'device': 'a', 'event': 'SwitchStateChanged', 'utcTime': 10, 'params': {'switch': 1, 'state': False}},
+        {'device': 'b', 'event': 'InputChanged', 'utcTime': 3700, 'params': {'port': 'in1', 'state': 1}},
+        {'device': 'b', 'event': 'KeyPressed', 'utcTime': 3800, 'params': {'key': '1'}},
+    ]
+
+
+def test_count_by_keeps_booleans_and_integers_apart():
+    frame = EventFrame.from_events(rows())
+    assert frame.count_by('state') == {'true': 1, '1': 1, 'false': 1}
+    assert frame.count_by('port') == {'"in1"': 1}
+    assert frame.count_by('device') == {'a': 2, 'b': 2}
+    assert len(frame.select(state=True)) == 1
+    assert len(frame.select(state=1)) == 1
+
+
+def test_bucket_counts():
+    frame = EventFrame.from_events(rows())
+    assert frame.bucket_counts(3600) == {0: 2, 3600: 2}
+    assert frame.bucket_counts(3600, by='device') == {0: {'a': 2}, 3600: {'b': 2}}
+    assert frame.bucket_counts(3600, by='state') == {0: {'true': 1, 'false': 1}, 3600: {'1': 1}}
+
+
+def test_bucket_counts_by_column_no_event_has():
+    frame = EventFrame.from_events(rows())
+    assert frame.bucket_counts(3600, by='uid') == {}
+    assert EventFrame.from_events([]).bucket_counts(by='uid') == {}
+
+
+def calls(*events):
+    return [{'device': device, 'event': 'CallStateChanged', 'utcTime': utc, 'params': {'state': state}}
+            for device, utc, state in events]
+
+
+def test_pair_latency_skips_missed_calls():
+    frame = EventFrame.from_events(calls(('a', 0, 'ringing'), ('a', 3600, 'ringing'), ('a', 3605, 'connected')))
+    latency = frame.pair_latency('CallStateChanged', {'state': 'ringing'}, {'state': 'connected'})
+    assert latency['count'] == 1
+    assert latency['mean'] == 5
+
+
+def test_pair_latency_pairs_an_end_once_and_per_device():
+    frame = EventFrame.from_events(calls(('a', 0, 'ringing'), ('b', 1, 'ringing'), ('a', 2, 'connected'),
+                                         ('a', 3, 'connected'), ('b', 9, 'connected'), ('b', 20, 'ringing')))
+    latency = frame.pair_latency('CallStateChanged', {'state': 'ringing'}, {'state': 'connected'})
+    assert sorted(latency['delays'].tolist()) == [2, 8]
+    assert frame.pair_latency('CallStateChanged', {'state': 'ringing'}, {'state': 'connected'},
+                              max_delay=5)['count'] == 1
+    assert EventFrame.from_events([]).pair_latency('CallStateChanged', {'state': 'ringing'},
+                                                   {'state': 'connected'})['count'] == 0
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from budget import BufferedSink, MemoryBudget
+from events import EventListener
+
+
+class Cam(object):
+    ip_address = '10.0.0.5'
+
+
+def events(start, count):
+    return [{'id': n, 'event': 'CardEntered', 'params': {'uid': 'x' * 50}} for n in range(start, start + count)]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_lagging_consumer_spills_and_replays_in_order(tmp_path):
+    gate = threading.Event()
+    received = []
+
+    def slow(ip_cam, batch):
+        gate.wait()
+        received.extend(event['id'] for event in batch)
+
+    budget = MemoryBudget(4096)
+    sink = BufferedSink(slow, budget, str(tmp_path / 'spill'), name='slow')
+    for n in range(0, 200, 10):
+        sink(Cam(), events(n, 10))
+    lag = sink.lag()
+    assert lag['spilled_events'] > 0 and lag['queued_bytes'] <= budget.limit
+    assert budget.used <= budget.limit
+    gate.set()
+    assert wait_for(lambda: len(received) == 200)
+    assert received == list(range(200))
+    assert wait_for(lambda: budget.used == 0)
+    sink.close()
+
+
+def test_listener_batches_count_against_the_budget(tmp_path):
+    budget = MemoryBudget(1000)
+    seen = []
+    listener = EventListener(Cam(), budget=budget)
+    sink = BufferedSink(lambda ip_cam, batch: None, budget, str(tmp_path / 'spill'))
+    listener.add_sink(lambda ip_cam, batch: seen.append(budget.in_flight))
+    listener.add_sink(sink)
+    listener.dispatch(events(0, 10))  # larger than the whole budget: held by the listener, spilled by the sink
+    assert seen[0] > 1000
+    assert sink.spilled == 10
+    assert budget.in_flight == 0
+    sink.close()
@@ -0,0 +1,70 @@
+import datetime
+import os
+import subprocess
+import sys
+
+import pytest
+
+from cassette import CassetteError, CassetteMiss, RecordingTransport, ReplayTransport, read_cassette
+
+
+class Response(object):
+    def __init__(self, status, content):
+        self.status_code = status
+        self.reason = 'OK' if status == 200 else 'Unauthorized'
+        self.headers = {'Content-Type': 'application/json'}
+        self.content = content
+        self.elapsed = datetime.timedelta(seconds=0.01)
+
+
+class Transport(object):
+    def request(self, method, url, **kwargs):
+        if url.endswith('/api/system/status'):
+            return Response(200, b'{"success": true, "result": {"upTime": 5}}')
+        return Response(401, b'')
+
+
+def record(path):
+    with RecordingTransport(path, transport=Transport()) as recorder:
+        recorder.request('GET', 'http://10.0.0.5/api/system/status')
+        recorder.request('GET', 'http://10.0.0.5/api/system/info')
+
+
+def test_replay(tmp_path):
+    path = str(tmp_path / 'lobby.cassette')
+    record(path)
+    replay = ReplayTransport(path)
+    assert replay.request('GET', 'http://10.0.0.5/api/system/status').json()['result'] == {'upTime': 5}
+    with pytest.raises(IOError):
+        replay.request('GET', 'http://10.0.0.5/api/system/info').raise_for_status()
+    with pytest.raises(CassetteMiss):
+        replay.request('GET', 'http://10.0.0.5/api/system/status')
+    replay.close()
+
+
+def test_replay_does_not_import_requests(tmp_path):
+    path = str(tmp_path / 'lobby.cassette')
+    record(path)
+    code = ('import sys; from cassette import ReplayTransport; from core import IPCam\n'
+            'ip_cam = IPCam("10.0.0.5", auth_type=2, user="admin", transport=ReplayTransport(sys.argv[1]))\n'
+            'assert "upTime" in ip_cam.commands.system_status()\n'
+            'try:\n    ip_cam.commands.system_info()\nexcept IOError:\n    pass\n'
+            'assert "requests" not in sys.modules, "requests imported"\n')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, '-c', code, path], cwd=root)
+
+
+def test_truncated_cassettes_raise_cassette_error(tmp_path):
+    path = str(tmp_path / 'lobby.cassette')
+    record(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    for size in range(len(data) - 1, 0, -7):
+        cut = str(tmp_path / 'cut.cassette')
+        with open(cut, 'wb') as f:
+            f.write(data[:size])
+        try:
+            _, records = read_cassette(cut)
+        except CassetteError:
+            continue
+        assert len(records) == 1  # cut right after the first record, a valid cassette
@@ -0,0 +1,70 @@
+import math
+import random
+
+import pytest
+
+from clocksync import ClockSync
+
+
+class Cam(object):
+    ip_address = '10.0.0.5'
+
+
+def observe(clock, local, offset, rtt=0.02):
+    """
+    Sample of a device whose clock is offset seconds ahead, read halfway through the request.
+    """
+    system_time = math.floor(local + rtt / 2 + offset)
+    clock.observe(Cam(), local, local + rtt, {'systemTime': system_time, 'upTime': 100})
+
+
+def test_offset_lies_within_the_bounds_and_narrows():
+    clock = ClockSync()
+    generator = random.Random(3)
+    local = 1700000000.0
+    observe(clock, local, 12.3)
+    first = clock.estimate(Cam.ip_address)
+    assert first.offset - first.error <= 12.3 <= first.offset + first.error + 0.02
+    assert first.error <= 0.52
+
+    for _ in range(40):
+        local += 10 + generator.random()
+        observe(clock, local, 12.3, rtt=generator.uniform(0.01, 0.05))
+    estimate = clock.estimate(Cam.ip_address)
+    assert estimate.offset == pytest.approx(12.3, abs=0.05)
+    assert estimate.error < 0.1
+    assert estimate.drift == 0.0  # the samples span less than min_span
+    assert clock.to_local(Cam.ip_address, local + 12.3) == pytest.approx(local, abs=0.05)
+    assert clock.to_device(Cam.ip_address, local) == pytest.approx(local + 12.3, abs=0.05)
+    assert clock.to_local('10.0.0.6', 5.0) == 5.0
+
+
+def test_drift_is_estimated_over_min_span():
+    clock = ClockSync(min_span=600)
+    generator = random.Random(5)
+    start = local = 1700000000.0
+    for _ in range(64):
+        local += 600 + generator.random()
+        observe(clock, local, 2.0 + 100e-6 * (local - start))
+    estimate = clock.estimate(Cam.ip_address)
+    assert estimate.drift * 1e6 == pytest.approx(100, abs=20)
+    # one second quantisation leaves the drift a few ppm uncertain, that much offset over the span is expected
+    assert estimate.to_device(local) == pytest.approx(local + 2.0 + 100e-6 * (local - start), abs=0.2)
+
+
+def test_step_restarts_the_estimate():
+    clock = ClockSync(step=1.0)
+    local = 1700000000.0
+    for n in range(10):
+        observe(clock, local + n * 10.3, 12.3)
+    assert clock.estimate(Cam.ip_address).samples == 10
+    observe(clock, local + 200, 42.3)
+    estimate = clock.estimate(Cam.ip_address)
+    assert estimate.samples == 1
+    assert abs(estimate.offset - 42.3) <= 0.52
+
+
+def test_samples_without_system_time_are_ignored():
+    clock = ClockSync()
+    clock.observe(Cam(), 10.0, 10.1, {'upTime': 5})
+    assert clock.estimate(Cam.ip_address) is None
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from core import IPCam
+from httptransport import HTTPError
+from tracing import TraceHook
+
+
+class Response(object):
+    def __init__(self, status=200, body=b'', content_type='application/json'):
+        self.status_code = status
+        self.headers = {'Content-Type': content_type}
+        self.content = body
+        self.text = body.decode()
+        self.history = []
+        self.closed = False
+
+    def iter_content(self, chunk_size=1024):
+        for offset in range(0, len(self.content), chunk_size):
+            yield self.content[offset:offset + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPError('{code} Error'.format(code=self.status_code), response=self)
+
+    def close(self):
+        self.closed = True
+
+
+class Transport(object):
+    def __init__(self, response):
+        self.response = response
+
+    def request(self, method, url, **kwargs):
+        return self.response
+
+
+class Recorder(TraceHook):
+    def __init__(self):
+        self.calls = []
+
+    def after_body(self, span):
+        self.calls.append(('after_body', span.path, span.bytes, span.error))
+
+    def on_error(self, span, error):
+        self.calls.append(('on_error', span.path, span.bytes, span.error))
+
+
+def traced(response):
+    ip_cam = IPCam('10.0.0.5', transport=Transport(response))
+    hook = Recorder()
+    ip_cam.commands.add_hook(hook)
+    return ip_cam.commands, hook
+
+
+def test_failed_traced_request_closes_the_response():
+    response = Response(status=503)
+    commands, hook = traced(response)
+    with pytest.raises(HTTPError):
+        commands.system_info()
+    assert response.closed
+    assert hook.calls == [('on_error', '/api/system/info', 0, '503 Error')]
+
+
+def test_json_reply_instead_of_a_stream_finishes_the_span(tmp_path):
+    reply = json.dumps({'success': False, 'error': {'code': 8}}).encode()
+    commands, hook = traced(Response(body=reply))
+    with pytest.raises(IOError):
+        commands.config_data()
+    with pytest.raises(IOError):
+        commands.camera_snapshot_data(640, 480)
+    assert commands.camera_snapshot(640, 480, filename=str(tmp_path / 'snapshot.jpg')) == reply.decode()
+    assert [call[:3] for call in hook.calls] == [('on_error', '/api/config', len(reply)),
+                                                 ('on_error', '/api/camera/snapshot', len(reply)),
+                                                 ('after_body', '/api/camera/snapshot', len(reply))]
+    assert hook.calls[0][3].startswith('Config download failed')
+
+
+def test_streamed_body_is_traced():
+    commands, hook = traced(Response(body=b'<DeviceConfig/>', content_type='application/xml'))
+    assert commands.config_data() == b'<DeviceConfig/>'
+    assert hook.calls == [('after_body', '/api/config', 15, None)]
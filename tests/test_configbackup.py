@@ -0,0 +1,87 @@
+import pytest
+
+from configbackup import ConfigBackup, split
+from simulator import make_config
+
+
+def edit(config, old, new):
+    assert old in config
+    return config.replace(old, new, 1)
+
+
+def test_split_is_lossless_and_content_defined():
+    config = make_config('54-0000-0001', 60000)
+    chunks = split(config)
+    assert b''.join(chunks) == config and len(chunks) > 10
+    edited = split(edit(config, b'<Phone>1500<', b'<Phone>91500<'))
+    assert len(set(chunks) & set(edited)) >= len(chunks) - 2
+
+
+def test_versions_restore_by_time_and_share_chunks(tmp_path):
+    backup = ConfigBackup(str(tmp_path))
+    configs = dict((n, make_config('54-0000-{0:04d}'.format(n), 30000)) for n in range(5))
+    for n, config in configs.items():
+        assert backup.add('10.0.0.{0}'.format(n), config, when=100) == 'stored'
+    shared = backup.stored_bytes
+    assert backup.add('10.0.0.0', configs[0], when=200) == 'unchanged'
+    second = edit(configs[0], b'<Https>1<', b'<Https>0<')
+    assert backup.add('10.0.0.0', second, when=300) == 'stored'
+    backup.sync()
+    assert backup.stored_bytes - shared < 2000
+    assert backup.restore('10.0.0.0', at=250) == configs[0]
+    assert backup.restore('10.0.0.0') == second
+    assert [item['changed'] for item in backup.history('10.0.0.0')] == [True, False, True]
+    with pytest.raises(KeyError):
+        backup.restore('10.0.0.0', at=50)
+    with pytest.raises(KeyError):
+        backup.restore('10.0.0.99')
+    backup.close()
+
+    backup = ConfigBackup(str(tmp_path))
+    assert backup.restore('10.0.0.0', at=250) == configs[0]
+    assert backup.restore('10.0.0.4') == configs[4]
+    assert backup.add('10.0.0.0', second, when=400) == 'unchanged'
+    backup.close()
+
+
+def test_backfilled_older_version_does_not_become_the_newest(tmp_path):
+    backup = ConfigBackup(str(tmp_path))
+    old = make_config('54-0000-0001', 20000)
+    new = edit(old, b'<Dhcp>1<', b'<Dhcp>0<')
+    assert backup.add('10.0.0.1', new, when=200) == 'stored'
+    assert backup.add('10.0.0.1', old, when=100) == 'stored'
+    assert backup.add('10.0.0.1', new, when=300) == 'unchanged'
+    newer = edit(new, b'<Https>1<', b'<Https>0<')
+    assert backup.add('10.0.0.1', newer, when=400) == 'stored'
+    assert backup.restore('10.0.0.1') == newer
+    assert backup.restore('10.0.0.1', at=150) == old
+    assert backup.restore('10.0.0.1', at=350) == new
+    backup.close()
+
+
+def test_delta_chains_are_capped(tmp_path):
+    backup = ConfigBackup(str(tmp_path), max_chain=3)
+    config = make_config('54-0000-0001', 20000)
+    versions = []
+    for n in range(10):
+        config = edit(config, b'<Phone>10', b'<Phone>9')
+        versions.append(config)
+        backup.add('10.0.0.1', config, when=n)
+    assert max(version['depth'] for version in backup.versions) <= 3
+    assert [backup.restore('10.0.0.1', at=n) for n in range(10)] == versions
+    backup.close()
+
+
+def test_torn_tails_are_truncated(tmp_path):
+    backup = ConfigBackup(str(tmp_path))
+    config = make_config('54-0000-0001', 20000)
+    backup.add('10.0.0.1', config, when=1)
+    backup.close()
+    with open(str(tmp_path / 'versions.jsonl'), 'ab') as f:
+        f.write(b'{"device": "10.0.0.1", "ti')
+    with open(str(next(tmp_path.glob('*.pack'))), 'ab') as f:
+        f.write(b'\x00' * 10)
+    backup = ConfigBackup(str(tmp_path))
+    assert backup.restore('10.0.0.1') == config
+    assert backup.add('10.0.0.1', config, when=2) == 'unchanged'
+    backup.close()
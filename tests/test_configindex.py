@@ -0,0 +1,72 @@
+import pytest
+
+from configbackup import ConfigBackup
+from configindex import ConfigIndex, config_digest, parse_config
+from simulator import make_config
+
+CONFIG = b"""<?xml version="1.0" encoding="UTF-8"?>
+<DeviceConfig serial="54-0001">
+ <HttpApi><AuthMethod>digest</AuthMethod></HttpApi>
+ <SipAccount id="1"><Enabled>1</Enabled></SipAccount>
+ <SipAccount id="2"><Enabled>0</Enabled><Proxy port="5060">sip.local</Proxy></SipAccount>
+ <Line>a</Line><Line>b &amp; c</Line>
+</DeviceConfig>"""
+
+
+def test_paths():
+    assert parse_config(CONFIG) == {
+        '@serial': '54-0001',
+        'HttpApi/AuthMethod': 'digest',
+        'SipAccount[1]/Enabled': '1',
+        'SipAccount[2]/Enabled': '0',
+        'SipAccount[2]/Proxy': 'sip.local',
+        'SipAccount[2]/Proxy/@port': '5060',
+        'Line': 'a',
+        'Line[2]': 'b & c',
+    }
+
+
+def test_chunked_parse_matches_whole():
+    config = make_config('54-0000-0001', 20000)
+    assert parse_config([config[i:i + 7] for i in range(0, len(config), 7)]) == parse_config(config)
+    with pytest.raises(ValueError):
+        parse_config(config[:-10])
+
+
+def test_queries_and_rebuild_only_on_change():
+    index = ConfigIndex()
+    configs = dict(('10.0.0.{0}'.format(n), make_config('54-0000-{0:04d}'.format(n), 5000)) for n in range(10))
+    configs['10.0.0.3'] = configs['10.0.0.3'].replace(b'<SipAccount id="2"><Enabled>0',
+                                                      b'<SipAccount id="2"><Enabled>1')
+    for device, config in configs.items():
+        assert index.update(device, config)
+    assert index.select('SipAccount[2]/Enabled', 1) == ['10.0.0.3']
+    assert index.count('HttpApi/AuthMethod') == {'digest': 10}
+    assert index.get('10.0.0.1', 'Network/HostName') == '2N-54-0000-0001'
+    assert index.get('10.0.0.1', 'No/Such', 'x') == 'x'
+    assert index.select('SipAccount[1]/Number', lambda value: value.endswith('51')) == ['10.0.0.5']
+    assert index.settings('10.0.0.1', 'HttpApi') == {'HttpApi/AuthMethod': 'digest', 'HttpApi/Https': '1'}
+    assert 'SipAccount[2]/Domain' in index.paths('SipAccount[2]')
+    with pytest.raises(KeyError):
+        index.get('10.0.0.99', 'HttpApi/AuthMethod')
+
+    assert not index.update('10.0.0.1', configs['10.0.0.1'])
+    assert index.update('10.0.0.1', configs['10.0.0.1'].replace(b'<Https>1', b'<Https>0'))
+    assert index.count('HttpApi/Https') == {'1': 9, '0': 1}
+    assert index.digest('10.0.0.2') == config_digest(configs['10.0.0.2'])
+    index.remove('10.0.0.2')
+    assert len(index.values('HttpApi/Https')) == 9
+
+
+def test_refresh_from_backup_restores_only_changed(tmp_path):
+    backup = ConfigBackup(str(tmp_path))
+    configs = dict(('10.0.0.{0}'.format(n), make_config('54-0000-{0:04d}'.format(n), 5000)) for n in range(5))
+    for device, config in configs.items():
+        backup.add(device, config, when=1)
+    index = ConfigIndex()
+    assert index.refresh_from_backup(backup)['parsed'] == 5
+    backup.add('10.0.0.4', configs['10.0.0.4'].replace(b'<Dhcp>1', b'<Dhcp>0'), when=2)
+    report = index.refresh_from_backup(backup)
+    assert (report['parsed'], report['unchanged']) == (1, 4)
+    assert index.select('Network/Dhcp', '0') == ['10.0.0.4']
+    backup.close()
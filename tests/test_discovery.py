@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+import pytest
+
+from discovery import DiscoveredDevice, Discovery, _dechunk
+
+INFO = json.dumps({'success': True, 'result': {'variant': '2N IP Verso', 'serialNumber': '54-0001',
+                                               'swVersion': '2.30'}}).encode()
+
+
+def test_dechunk():
+    assert _dechunk(b'5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\n\r\n') == b'hello world'
+    with pytest.raises(ValueError):
+        _dechunk(b'a\r\nshort')
+
+
+def probe(reply):
+    async def run():
+        requests = []
+
+        async def serve(reader, writer):
+            requests.append(await reader.readuntil(b'\r\n\r\n'))
+            writer.write(reply)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            device = await Discovery(timeout=2, ports={'http': port})._probe('127.0.0.1', 'http')
+        finally:
+            server.close()
+            await server.wait_closed()
+        return device, requests
+
+    return asyncio.run(run())
+
+
+def test_probe_plain_and_chunked_replies():
+    device, requests = probe(b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n\r\n' + INFO)
+    assert device.serial == '54-0001'
+    assert requests[0].startswith(b'GET /api/system/info HTTP/1.0\r\n')
+
+    chunked = b''.join(b'%x\r\n%s\r\n' % (len(INFO[i:i + 20]), INFO[i:i + 20]) for i in range(0, len(INFO), 20))
+    device, _ = probe(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + chunked + b'0\r\n\r\n')
+    assert device.firmware == '2.30'
+
+    device, _ = probe(b'HTTP/1.1 200 OK\r\n\r\n{"success": false}')
+    assert device is None
+
+
+def test_probe_ignores_replies_without_a_result_object():
+    for result in (b'null', b'42', b'"54-0001"', b'["serialNumber"]'):
+        device, _ = probe(b'HTTP/1.0 200 OK\r\n\r\n{"success": true, "result": ' + result + b'}')
+        assert device is None
+
+
+class Sweep(Discovery):
+    async def _probe(self, ip, scheme):
+        if ip == '10.0.0.2':
+            raise RuntimeError('odd web server')
+        if ip == '10.0.0.3':
+            return DiscoveredDevice(ip, 80, False, {'serialNumber': '54-0001'}, 0.01)
+
+
+def test_a_failing_probe_does_not_abort_the_sweep():
+    found = []
+    devices = asyncio.run(Sweep(timeout=1, rate=None, schemes=('http',)).run(['10.0.0.0/29'], callback=found.append))
+    assert [device.ip for device in devices] == ['10.0.0.3']
+    assert found == devices
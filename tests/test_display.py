@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from display import DEFAULT_RESOLUTION, DisplayPipeline
+
+GIF = b'GIF89a-announcement'
+
+
+def caps(*displays, **reply):
+    reply.setdefault('success', True)
+    if reply['success']:
+        reply['result'] = {'displays': list(displays)}
+    return json.dumps(reply)
+
+
+class Commands(object):
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.uploads = []
+
+    def display_caps(self):
+        return self.replies.pop(0)
+
+    def display_upload_image(self, display, data):
+        self.uploads.append((display, data))
+        return json.dumps({'success': True})
+
+
+class Cam(object):
+    cache = None
+
+    def __init__(self, commands, address='10.0.0.5'):
+        self.ip_address = address
+        self.commands = commands
+
+
+def test_resolution_from_display_caps():
+    pipeline = DisplayPipeline()
+    cam = Cam(Commands(caps({'display': 'internal', 'resolution': {'width': 480, 'height': 272}}),
+                       caps({'display': 'internal'})))
+    assert pipeline.resolution(cam) == (480, 272)
+    assert pipeline.resolution(cam) == (480, 272)
+    pipeline.forget(cam.ip_address)
+    assert pipeline.resolution(cam) == DEFAULT_RESOLUTION
+
+
+def test_failed_display_caps_are_not_remembered():
+    pipeline = DisplayPipeline()
+    cam = Cam(Commands(caps(success=False, error={'code': 12, 'description': 'insufficient privileges'}),
+                       caps({'display': 'external', 'resolution': {'width': 480, 'height': 272}}),
+                       caps({'display': 'internal', 'resolution': {'width': 480, 'height': 272}})))
+    with pytest.raises(IOError):
+        pipeline.resolution(cam)
+    with pytest.raises(IOError):
+        pipeline.resolution(cam)
+    assert pipeline.resolution(cam) == (480, 272)
+
+
+def test_unchanged_content_is_not_uploaded_again():
+    pipeline = DisplayPipeline()
+    commands = Commands(caps(success=False), caps({'display': 'internal', 'resolution': {'width': 480,
+                                                                                          'height': 272}}))
+    cam = Cam(commands)
+    assert pipeline.push([cam], GIF)['10.0.0.5'].startswith('OSError: Display caps failed')
+    assert pipeline.push([cam], GIF) == {'10.0.0.5': 'uploaded'}
+    assert pipeline.push([cam], GIF) == {'10.0.0.5': 'unchanged'}
+    assert commands.uploads == [('internal', GIF)]
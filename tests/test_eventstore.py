@@ -0,0 +1,69 @@
+from eventstore import EventStore
+
+
+def event(n, name='CardEntered', utc=None):
+    return {'id': n, 'utcTime': 1000 + n if utc is None else utc, 'upTime': n, 'event': name, 'params': {'n': n}}
+
+
+def test_query_by_device_type_and_time(tmp_path):
+    store = EventStore(str(tmp_path))
+    store.append_many('a', [event(n, 'CardEntered' if n % 2 else 'KeyPressed') for n in range(10)])
+    store.append_many('b', [event(n) for n in range(10, 15)])
+    assert [e['id'] for e in store.query(device='a', event='CardEntered')] == [1, 3, 5, 7, 9]
+    assert [e['id'] for e in store.query(since=1008, until=1011)] == [8, 9, 10, 11]
+    assert store.count(device='b') == 5
+    assert list(store.query(device='unknown')) == []
+    store.close()
+
+
+def test_query_survives_appends_remapping_the_segment(tmp_path):
+    store = EventStore(str(tmp_path))
+    store.append_many('a', [event(n) for n in range(3)])
+    first = store.query()
+    assert next(first)['id'] == 0
+    store.append('a', event(3))
+    assert [e['id'] for e in store.query()] == [0, 1, 2, 3]
+    assert [e['id'] for e in first] == [1, 2]
+    store.close()
+
+
+def test_reopen_seals_and_recovers_torn_tail(tmp_path):
+    store = EventStore(str(tmp_path), segment_size=200)
+    for n in range(20):
+        store.append('a', event(n))
+    store.close()
+    active = sorted(tmp_path.glob('*.seg'))[-1]
+    with open(str(active), 'ab') as f:
+        f.write(b'\x40\x00\x00\x00torn')
+    store = EventStore(str(tmp_path), segment_size=200)
+    assert [e['id'] for e in store.query()] == list(range(20))
+    assert [e['params'] for e in store.query(since=1019)] == [{'n': 19}]
+    store.close()
+
+
+def test_drop_before_keeps_running_queries_readable(tmp_path):
+    store = EventStore(str(tmp_path), segment_size=200)
+    for n in range(20):
+        store.append('a', event(n))
+    running = store.query()
+    next(running)
+    assert store.drop_before(1010) > 0
+    assert len(list(running)) == 19
+    assert min(e['id'] for e in store.query()) > 0
+    store.close()
+
+
+def test_last_append_is_synced_without_further_appends(tmp_path, monkeypatch):
+    import os
+    import time
+
+    store = EventStore(str(tmp_path), fsync_interval=0.05)
+    store.append('a', event(0))
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    store.append('a', event(1))
+    deadline = time.monotonic() + 2
+    while not synced and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert synced and not store._dirty
+    store.close()
@@ -0,0 +1,71 @@
+import json
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from fanout import FanoutServer, subscribe
+
+
+class Cam(object):
+    ip_address = '10.0.0.5'
+
+
+def send_raw(path, payload):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(path)
+        sock.sendall(struct.pack('>I', len(payload)) + payload)
+        data = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return data
+            data += chunk
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = FanoutServer([], unix_path=str(tmp_path / 'events.sock'), http_address=('127.0.0.1', 28960))
+    server.start_in_thread()
+    yield server
+    server.stop()
+
+
+def test_events_reach_matching_subscribers(server):
+    received = []
+
+    def client():
+        for event in subscribe(server.unix_path, events=['CardEntered'], timeout=5):
+            received.append(event)
+            return
+
+    thread = threading.Thread(target=client)
+    thread.start()
+    while not server.clients:
+        time.sleep(0.01)
+    server(Cam(), [{'id': 1, 'event': 'KeyPressed'}, {'id': 2, 'event': 'CardEntered', 'params': {'uid': 'x'}}])
+    thread.join(5)
+    assert received == [{'id': 2, 'event': 'CardEntered', 'params': {'uid': 'x'}, 'device': '10.0.0.5'}]
+
+
+@pytest.mark.parametrize('payload', [b'[1, 2]', b'"all"', b'{"devices": "10.0.0.5"}', b'{"events": [1]}',
+                                     b'{not json'])
+def test_invalid_subscriptions_get_an_error_reply(server, payload):
+    reply = send_raw(server.unix_path, payload)
+    (length,) = struct.unpack('>I', reply[:4])
+    assert 'Invalid subscription' in json.loads(reply[4:4 + length].decode('utf-8'))['error']
+    assert not server.clients
+
+
+def test_subscribe_raises_the_error_reply(server):
+    with pytest.raises(ValueError):
+        next(subscribe(server.unix_path, devices=[5], timeout=5))
+
+
+def test_malformed_http_request_line(server):
+    with socket.create_connection(('127.0.0.1', 28960), timeout=5) as sock:
+        sock.sendall(b'garbage\r\n\r\n')
+        assert sock.recv(1024).startswith(b'HTTP/1.1 400 ')
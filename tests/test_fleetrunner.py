@@ -0,0 +1,39 @@
+import logging
+import time
+
+from fleetrunner import FleetRunner, assign
+
+
+class Cam(object):
+    def __init__(self, address):
+        self.ip_address = address
+        self.ssl = False
+        self.auth_type = 0
+        self.user = None
+        self.password = None
+
+
+def failing_setup(worker):
+    raise RuntimeError('setup failed')
+
+
+def test_assign_moves_only_the_devices_of_a_removed_worker():
+    devices = ['10.0.0.{0}'.format(n) for n in range(200)]
+    before = assign(devices, [0, 1, 2, 3])
+    after = assign(devices, [0, 1, 3])
+    assert sorted(sum(after.values(), [])) == sorted(devices)
+    for slot in (0, 1, 3):
+        assert set(before[slot]) <= set(after[slot])
+
+
+def test_workers_failing_at_setup_are_respawned_with_backoff(caplog):
+    runner = FleetRunner([Cam('10.0.0.1')], workers=1, setup=failing_setup, respawn_delay=0.5,
+                         max_respawn_delay=30)
+    with caplog.at_level(logging.WARNING, logger='fleetrunner'):
+        runner.start()
+        time.sleep(3)
+        runner.stop()
+    # 0.5 + 1 + 2 s of backoff fit at most 3 restarts into 3 s, without backoff it would be dozens
+    assert 1 <= runner.restarts <= 3
+    died = [record.getMessage() for record in caplog.records if 'died with exit code' in record.getMessage()]
+    assert died and all('exit code 1,' in message for message in died)
@@ -0,0 +1,99 @@
+import json
+
+from health import HealthMonitor
+
+
+class Commands(object):
+    def __init__(self):
+        self.replies = []
+
+    def system_status(self):
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return json.dumps(reply)
+
+
+class Cache(object):
+    invalidated = 0
+
+    def invalidate(self):
+        self.invalidated += 1
+
+
+class Listener(object):
+    resubscribed = 0
+
+    def resubscribe(self):
+        self.resubscribed += 1
+
+
+class Cam(object):
+    def __init__(self, address='10.0.0.5'):
+        self.ip_address = address
+        self.commands = Commands()
+        self.cache = Cache()
+
+
+def status(up_time, system_time=1700000000):
+    return {'success': True, 'result': {'systemTime': system_time, 'upTime': up_time}}
+
+
+def monitor(cam, **kwargs):
+    kwargs.setdefault('jitter', 0)
+    return HealthMonitor([cam], **kwargs)
+
+
+def test_restart_is_detected_from_up_time():
+    cam = Cam()
+    listener = Listener()
+    health_monitor = monitor(cam, listeners={cam.ip_address: listener})
+    restarted = []
+    health_monitor.add_restart_handler(restarted.append)
+    health = health_monitor.devices[cam.ip_address]
+
+    cam.commands.replies = [status(1000), status(1100), status(20)]
+    health_monitor.probe(health)
+    health.probed -= 100  # the next probe comes 100 seconds later
+    health_monitor.probe(health)
+    assert health.restarts == 0
+    health.probed -= 100
+    health_monitor.probe(health)
+    assert health.restarts == 1
+    assert health.interval == health_monitor.min_interval
+    assert restarted == [cam]
+    assert cam.cache.invalidated == 1 and listener.resubscribed == 1
+    health_monitor.stop()
+
+
+def test_interval_backs_off_while_stable_and_after_failures():
+    cam = Cam()
+    health_monitor = monitor(cam, interval=60, min_interval=10, max_interval=600, down_after=2)
+    health = health_monitor.devices[cam.ip_address]
+    cam.commands.replies = [status(n) for n in range(5)] + [IOError('timed out')] * 6 + [status(100)]
+
+    intervals = []
+    for _ in range(12):
+        health_monitor.probe(health)
+        intervals.append(health.interval)
+        health.probed -= 1
+    assert intervals == [120, 240, 480, 600, 600, 10, 20, 40, 80, 160, 320, 600]
+    assert health.reachable is True and health.failures == 0
+    assert health.restarts == 0
+    health_monitor.stop()
+
+
+def test_odd_replies_count_as_failed_probes():
+    cam = Cam()
+    health_monitor = monitor(cam, down_after=2)
+    health = health_monitor.devices[cam.ip_address]
+    cam.commands.replies = [{'success': True, 'result': None}, {'success': True, 'result': {'upTime': 'soon'}}]
+    for _ in range(2):
+        health.probing = True
+        health_monitor.probe(health)
+        assert not health.probing
+        assert health_monitor._heap[0][1] == cam.ip_address
+    assert health.reachable is False
+    assert health.failures == 2
+    assert 'upTime' in health.error
+    health_monitor.stop()
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from inventory import DeviceCache, Inventory
+
+
+class Commands(object):
+    def __init__(self, serial='54-0001', firmware='2.30', down=False):
+        self.serial = serial
+        self.firmware = firmware
+        self.down = down
+        self.calls = []
+
+    def system_info(self):
+        self.calls.append('system_info')
+        if self.down:
+            raise IOError('device unreachable')
+        return json.dumps({'success': True, 'result': {'serialNumber': self.serial, 'swVersion': self.firmware}})
+
+    def switch_caps(self):
+        self.calls.append('switch_caps')
+        return json.dumps({'success': True, 'result': {'switches': [{'switch': 1}]}})
+
+
+class Cam(object):
+    def __init__(self, commands, address='10.0.0.5'):
+        self.ip_address = address
+        self.commands = commands
+
+
+def test_caps_are_served_from_the_inventory_until_the_firmware_changes(tmp_path):
+    path = str(tmp_path / 'inventory.db')
+    inventory = Inventory(path)
+    commands = Commands()
+    cache = DeviceCache(Cam(commands), inventory)
+    cache.revalidation.result()
+    assert json.loads(cache.get('switch_caps'))['success']
+    inventory.close()
+
+    inventory = Inventory(path)
+    commands = Commands()
+    cache = DeviceCache(Cam(commands), inventory)
+    cache.get('switch_caps')
+    assert cache.revalidation.result() is True
+    assert commands.calls == ['system_info']
+
+    commands.firmware = '2.31'
+    assert cache.revalidate() is False
+    cache.get('switch_caps')
+    assert commands.calls.count('switch_caps') == 1
+    inventory.close()
+
+
+def test_system_info_raises_the_device_error_when_nothing_is_cached():
+    inventory = Inventory(':memory:')
+    cache = DeviceCache(Cam(Commands(down=True)), inventory, revalidate=False)
+    with pytest.raises(IOError, match='unreachable'):
+        cache.get('system_info')
+    with pytest.raises(ValueError):
+        cache.get('switch_control')
+    inventory.close()
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from jsonstream import PullError, iter_event_batches, iter_events
+
+EVENTS = [{'id': n, 'utcTime': 1000 + n, 'event': 'CardEntered',
+           'params': {'uid': 'ü{0}]}}'.format(n), 'nested': {'list': [1, {'a': '['}]}}} for n in range(20)]
+REPLY = json.dumps({'success': True, 'result': {'events': EVENTS}}, ensure_ascii=False, indent=1).encode('utf-8')
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, len(REPLY)])
+def test_events_decoded_across_any_chunk_boundary(size):
+    assert list(iter_events(chunked(REPLY, size))) == EVENTS
+
+
+def test_events_arrive_before_the_reply_is_complete():
+    chunks = iter(chunked(REPLY, 100))
+    consumed = []
+
+    def source():
+        for chunk in chunks:
+            consumed.append(chunk)
+            yield chunk
+
+    first = next(iter_event_batches(source()))
+    assert first[0] == EVENTS[0]
+    assert len(consumed) < len(chunked(REPLY, 100))
+
+
+def test_empty_reply_and_errors():
+    assert list(iter_events([b'{"success": true, "result": {"events": []}}'])) == []
+    with pytest.raises(PullError):
+        list(iter_events([b'{"success": false, "error": {"code": 12}}']))
+    with pytest.raises(ValueError):
+        list(iter_events(chunked(REPLY[:len(REPLY) // 2], 50)))
+    with pytest.raises(ValueError):
+        list(iter_events([b'<html>']))
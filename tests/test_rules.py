@@ -0,0 +1,78 @@
+import time
+
+from core import IPCam
+from rules import Action, Rule, RuleEngine
+
+
+class Response(object):
+    status_code = 200
+    history = []
+    content = b'{"success": true}'
+    text = content.decode()
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Transport(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((url, kwargs.get('data')))
+        time.sleep(self.delay)  # the device handling the request, not part of the latency
+        return Response()
+
+
+def card(uid, utc=None):
+    return {'event': 'CardEntered', 'utcTime': utc, 'params': {'uid': uid, 'valid': True}}
+
+
+def test_rules_match_by_key_conditions_and_order():
+    ip_cam = IPCam('10.0.0.5', transport=Transport())
+    first = Rule('CardEntered', {'uid': 'A1', 'valid': True}, name='first')
+    generic = Rule('CardEntered', name='generic')
+    other = Rule('CardEntered', {'uid': 'B2'}, name='other')
+    elsewhere = Rule('CardEntered', {'uid': 'A1'}, devices=['10.0.0.6'], name='elsewhere')
+    engine = RuleEngine([generic, first, other, elsewhere], workers=0)
+    assert engine.match(ip_cam, card('A1')) == [generic, first]
+    assert engine.match(ip_cam, {'event': 'CardEntered', 'params': {'uid': 'A1', 'valid': False}}) == [generic]
+    assert engine.match(ip_cam, {'event': 'CardEntered', 'params': {'uid': ['unhashable']}}) == [generic]
+    assert engine.match(ip_cam, {'event': 'KeyPressed', 'params': {'key': '1'}}) == []
+
+    engine.add(Rule('CardEntered', {'uid': 'A1'}, stop=True, name='stop'))
+    engine.remove(generic)
+    engine.add(generic)
+    assert [rule.name for rule in engine.match(ip_cam, card('A1'))] == ['first', 'stop']
+
+
+def test_window_and_days():
+    ip_cam = IPCam('10.0.0.5', transport=Transport())
+    monday_noon = time.mktime((2024, 1, 1, 12, 0, 0, 0, 0, -1))
+    night = Rule('CardEntered', window=('22:00', '06:00'))
+    office = Rule('CardEntered', window=('08:00', '18:00'), days=range(5))
+    assert not night.accepts(ip_cam, card('A1', monday_noon))
+    assert night.accepts(ip_cam, card('A1', monday_noon + 13 * 3600))
+    assert office.accepts(ip_cam, card('A1', monday_noon))
+    assert not office.accepts(ip_cam, card('A1', monday_noon + 5 * 86400))
+
+
+def test_latency_ends_when_the_request_is_handed_to_the_transport():
+    transport = Transport(delay=0.05)
+    ip_cam = IPCam('10.0.0.5', transport=transport)
+    engine = RuleEngine([Rule('CardEntered', {'uid': 'A1'}, actions=[Action('switch_control', switch=1,
+                                                                             action='trigger')])],
+                        workers=0, samples=3)
+    for _ in range(5):
+        engine(ip_cam, [card('A1'), card('B2')])
+    assert transport.requests == [('http://10.0.0.5/api/switch/ctrl', {'switch': 1, 'action': 'trigger'})] * 5
+    assert engine.fired == {'CardEntered{\'uid\': \'A1\'}': 5}
+    latency = engine.latency()
+    assert latency['count'] == 3
+    assert latency['p99_ms'] < 50
+    assert ip_cam.commands.hooks == [engine._hook]
+    engine.close()
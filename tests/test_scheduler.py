@@ -0,0 +1,141 @@
+import random
+import sqlite3
+import time
+
+from scheduler import LEVELS, SLOTS, Scheduler, TimerEntry, TimerWheel
+
+
+class Commands(object):
+    def __init__(self):
+        self.calls = []
+
+    def switch_control(self, **kwargs):
+        self.calls.append(('switch_control', kwargs))
+
+
+class Cam(object):
+    def __init__(self, address='10.0.0.5'):
+        self.ip_address = address
+        self.commands = Commands()
+
+
+class Crashing(object):
+    """
+    Executor of a process that dies before the submitted batches ran.
+    """
+
+    def submit(self, fn, *args):
+        pass
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def entry(entry_id, due):
+    return TimerEntry(entry_id, due, '10.0.0.5', 'switch_control', {'switch': 1, 'action': 'on'})
+
+
+def test_wheel_fires_in_order_across_levels():
+    wheel = TimerWheel(tick=1, now=0)
+    generator = random.Random(7)
+    dues = [3, 255, 256, 257, 511, 65535, 65536, 65537, 70000] + [generator.randrange(1, 200000) for _ in range(2000)]
+    for n, due in enumerate(dues):
+        wheel.insert(entry(n, due))
+    assert wheel.entries[5].level == 1
+    assert wheel.entries[6].level == 2
+    far = entry('far', SLOTS ** (LEVELS - 1) + 10)
+    wheel.insert(far)
+    assert far.level == LEVELS - 1
+    wheel.cancel('far')
+
+    fired = []
+    now = 0
+    while now < 200000:
+        now += generator.randrange(1, 5000)
+        for due in wheel.advance(now):
+            assert now - 5000 < due.expires <= now  # not early, not late
+            fired.append(due)
+    assert [e.expires for e in fired] == sorted(dues)
+    assert sorted(e.id for e in fired) == list(range(len(dues)))
+    assert len(wheel) == 0
+    assert wheel.next_expiry() is None
+
+
+def test_past_due_entries_fire_on_the_next_tick():
+    wheel = TimerWheel(tick=0.5, now=100)
+    wheel.advance(110)
+    wheel.insert(entry('late', 50))
+    wheel.insert(entry('soon', 110.2))
+    assert wheel.next_expiry() == 110.5
+    assert [e.id for e in wheel.advance(110.5)] in (['late', 'soon'], ['soon', 'late'])
+
+
+def test_cancel():
+    wheel = TimerWheel(tick=1, now=0)
+    for n, due in enumerate((10, 1000, 100000)):
+        wheel.insert(entry(n, due))
+    assert wheel.cancel(1).id == 1
+    assert wheel.cancel(1) is None
+    assert wheel.cancel('unknown') is None
+    assert [e.id for e in wheel.advance(200000)] == [0, 2]
+
+
+def test_cancelled_schedules_are_not_loaded_again(tmp_path):
+    path = str(tmp_path / 'schedule.db')
+    scheduler = Scheduler(path=path)
+    keep = scheduler.after(3600, '10.0.0.5', 'switch_control', switch=1, action='on')
+    drop = scheduler.after(3600, '10.0.0.5', 'switch_control', switch=1, action='off')
+    assert scheduler.cancel(drop)
+    assert not scheduler.cancel(drop)
+    scheduler.stop()
+
+    scheduler = Scheduler(path=path)
+    assert list(scheduler.wheel.entries) == [keep]
+    scheduler.stop()
+
+
+def test_restart_neither_loses_nor_double_fires(tmp_path):
+    path = str(tmp_path / 'schedule.db')
+    cam = Cam()
+    scheduler = Scheduler([cam], path=path)
+    now = time.time()
+    scheduler.at(now + 1, cam.ip_address, 'switch_control', switch=1, action='on')
+    scheduler.at(now + 1, cam.ip_address, 'switch_control', switch=2, action='trigger')
+    pending = scheduler.at(now + 3600, cam.ip_address, 'switch_control', switch=1, action='off')
+    executor, scheduler._executor = scheduler._executor, Crashing()
+    assert scheduler.run_due(now + 2) == 2
+    executor.shutdown()
+    scheduler._db.close()  # crash while both actions were being dispatched
+    assert cam.commands.calls == []
+
+    scheduler = Scheduler([cam], path=path)
+    assert scheduler.pending() == 2  # the pending action and the interrupted idempotent one
+    assert scheduler.run_due(time.time() + 1) == 1
+    scheduler.stop()
+    assert cam.commands.calls == [('switch_control', {'switch': 1, 'action': 'on'})]
+    assert scheduler.dispatched == 1
+    assert sqlite3.connect(path).execute('SELECT COUNT(*) FROM inflight').fetchone() == (0,)
+
+    scheduler = Scheduler([cam], path=path)
+    assert list(scheduler.wheel.entries) == [pending]
+    assert scheduler.run_due(time.time() + 1) == 0
+    scheduler.stop()
+    assert len(cam.commands.calls) == 1
+
+
+def test_misfire_grace_after_restart(tmp_path):
+    path = str(tmp_path / 'schedule.db')
+    cam = Cam()
+    now = time.time()
+    scheduler = Scheduler([cam], path=path, misfire_grace=60)
+    scheduler.at(now + 10, cam.ip_address, 'switch_control', switch=1, action='on')
+    scheduler.at(now + 100, cam.ip_address, 'switch_control', switch=2, action='on')
+    scheduler.stop()
+
+    scheduler = Scheduler([cam], path=path, misfire_grace=60)
+    assert scheduler.run_due(now + 150) == 1  # 140 and 50 seconds late
+    scheduler.stop()
+    assert cam.commands.calls == [('switch_control', {'switch': 2, 'action': 'on'})]
+    scheduler = Scheduler(path=path)
+    assert scheduler.pending() == 0
+    scheduler.stop()
@@ -0,0 +1,21 @@
+import gc
+import logging
+
+from core import IPCam
+from httptransport import HTTPClientTransport
+from simulator import DeviceProfile, Simulator
+
+
+def test_stop_with_open_keep_alive_connections(caplog):
+    simulator = Simulator(base_port=28900)
+    devices = simulator.add_devices(5, DeviceProfile(event_rate=5))
+    simulator.start_in_thread()
+    transport = HTTPClientTransport(hosts=5, pool_size=1, timeout=5)
+    for device in devices:
+        assert IPCam(device.address, transport=transport).commands.system_status()
+    with caplog.at_level(logging.ERROR, logger='asyncio'):
+        simulator.stop()
+        gc.collect()
+    assert not caplog.records
+    assert sum(device.connections for device in devices) == 0
+    transport.close()
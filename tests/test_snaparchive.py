@@ -0,0 +1,47 @@
+from snaparchive import SnapshotArchive
+
+
+def frame(n):
+    return b'\xff\xd8' + bytes([n % 256]) * 100 + b'\xff\xd9'
+
+
+def test_dedup_skip_and_time_query(tmp_path):
+    archive = SnapshotArchive(str(tmp_path))
+    assert archive.add('a', frame(1), utc=10) == 'stored'
+    assert archive.add('a', frame(1), utc=11) == 'skipped'
+    assert archive.add('a', frame(2), utc=12) == 'stored'
+    assert archive.add('b', frame(1), utc=13) == 'linked'
+    items = list(archive.query(device='a', since=11))
+    assert [item['utc'] for item in items] == [12]
+    assert archive.read(items[0]) == frame(2)
+    assert archive.stats()['blobs'] == 2
+    archive.close()
+
+    archive = SnapshotArchive(str(tmp_path))
+    assert [archive.read(item) for item in archive.query(device='b')] == [frame(1)]
+    archive.close()
+
+
+def test_query_survives_add_and_query(tmp_path):
+    archive = SnapshotArchive(str(tmp_path))
+    for n in range(3):
+        archive.add('a', frame(n), utc=n)
+    first = archive.query()
+    assert next(first)['utc'] == 0
+    archive.add('a', frame(3), utc=3)
+    assert len(list(archive.query())) == 4
+    assert [item['utc'] for item in first] == [1, 2]
+    archive.close()
+
+
+def test_retain_keeps_running_queries_readable(tmp_path):
+    archive = SnapshotArchive(str(tmp_path), pack_size=300)
+    for n in range(10):
+        archive.add('a', frame(n), utc=n)
+    running = archive.query()
+    next(running)
+    result = archive.retain(max_bytes=3 * (len(frame(0)) + 24))
+    assert result['dropped'] == 7
+    assert len(list(running)) == 9
+    assert [archive.read(item) for item in archive.query()] == [frame(n) for n in range(7, 10)]
+    archive.close()
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+
+import pytest
+
+from snapproxy import FrameCache
+
+CAPS = json.dumps({'success': True, 'result': {
+    'jpegResolution': [{'width': 160, 'height': 120}, {'width': 320, 'height': 240}, {'width': 640, 'height': 480}],
+    'sources': [{'source': 'internal'}, {'source': 'external'}]}})
+
+
+class Commands(object):
+    def __init__(self):
+        self.snapshots = 0
+
+    def camera_caps(self):
+        return CAPS
+
+    def camera_snapshot_data(self, width, height, source=None):
+        self.snapshots += 1
+        return b'\xff\xd8' + '{0}x{1}/{2}'.format(width, height, source).encode() * 10 + b'\xff\xd9'
+
+
+class Cam(object):
+    cache = None
+
+    def __init__(self, address):
+        self.ip_address = address
+        self.commands = Commands()
+
+
+def test_frames_are_shared_within_the_rate():
+    cam = Cam('10.0.0.5')
+    cache = FrameCache([cam], rate=0.001)
+    first = cache.get('10.0.0.5', 'internal', 320, 240)
+    assert cache.get('10.0.0.5', 'internal', 320, 240) is first
+    assert cam.commands.snapshots == 1
+    with pytest.raises(KeyError):
+        cache.get('10.0.0.6')
+
+
+def test_unsupported_resolution_and_source_create_no_feed():
+    cache = FrameCache([Cam('10.0.0.5')])
+    for width in range(1000, 1100):
+        with pytest.raises(ValueError):
+            cache.get('10.0.0.5', None, width, 480)
+    with pytest.raises(ValueError):
+        cache.get('10.0.0.5', 'nonexistent', 640, 480)
+    assert cache.stats()['feeds'] == 0
+
+
+def test_feeds_are_capped():
+    cams = [Cam('10.0.0.{0}'.format(n)) for n in range(10)]
+    cache = FrameCache(cams, max_feeds=4)
+    for cam in cams:
+        cache.get(cam.ip_address, 'internal', 160, 120)
+    stats = cache.stats()
+    assert stats['feeds'] == 4
+    assert stats['bytes'] == 4 * len(cams[0].commands.camera_snapshot_data(160, 120, 'internal'))
+
+
+class OfflineCommands(Commands):
+    def __init__(self, delay=0.0):
+        super(OfflineCommands, self).__init__()
+        self.delay = delay
+        self.caps_calls = 0
+
+    def camera_caps(self):
+        self.caps_calls += 1
+        time.sleep(self.delay)
+        raise IOError('timed out')
+
+
+def test_failed_caps_are_fetched_once_per_interval():
+    cam = Cam('10.0.0.5')
+    cam.commands = OfflineCommands(delay=0.2)
+    cache = FrameCache([cam], rate=0.001)
+    errors = []
+
+    def view():
+        try:
+            cache.get('10.0.0.5')
+        except IOError as err:
+            errors.append(err)
+
+    viewers = [threading.Thread(target=view) for _ in range(5)]
+    for viewer in viewers:
+        viewer.start()
+    for viewer in viewers:
+        viewer.join()
+    view()
+    assert len(errors) == 6
+    assert cam.commands.caps_calls == 1
+
+    cache.interval = 0
+    view()
+    assert cam.commands.caps_calls == 2
@@ -0,0 +1,38 @@
+from spill import SpillQueue
+
+
+def test_fifo_across_segments_and_restarts(tmp_path):
+    queue = SpillQueue(str(tmp_path), segment_size=200)
+    for n in range(50):
+        queue.append([n, 'x' * 20])
+    assert [record[0] for record in queue.peek_many(5, weight=lambda record: 1)] == [0, 1, 2, 3, 4]
+    queue.commit()
+    assert queue.peek()[0] == 5  # peeked, not committed
+    queue.close()
+
+    queue = SpillQueue(str(tmp_path), segment_size=200)
+    seen = []
+    while True:
+        record = queue.peek()
+        if record is None:
+            break
+        seen.append(record[0])
+        queue.commit()
+    assert seen == list(range(5, 50))
+    assert len(queue) == 0
+    assert len(list(tmp_path.glob('*.spill'))) == 1
+    queue.close()
+
+
+def test_torn_record_is_not_returned_until_complete(tmp_path):
+    queue = SpillQueue(str(tmp_path))
+    queue.append(['a'])
+    queue.close()
+    spill = next(tmp_path.glob('*.spill'))
+    with open(str(spill), 'ab') as f:
+        f.write(b'\x10\x00\x00\x00')
+    queue = SpillQueue(str(tmp_path))
+    assert queue.peek() == ['a']
+    queue.commit()
+    assert queue.peek() is None
+    queue.close()
@@ -0,0 +1,114 @@
+"""
+TLS session resumption for https connections to the devices.
+
+With ssl=True every new connection costs a full TLS handshake, which is expensive for the weak device CPUs, above all
+when a whole fleet reconnects at once after an outage. A TLSSessionCache keeps the last TLS session of every device
+and offers it on the next connection, so the device can resume it with an abbreviated handshake (no certificate
+exchange, no key agreement). The cache lives in memory: the ssl module cannot serialise sessions, so it is not kept
+across process restarts.
+
+The cache only depends on the standard library. It is used through a transport, see transport.PooledTransport and
+httptransport.HTTPClientTransport (tls_sessions=...).
+"""
+
+import ssl
+import threading
+import time
+from collections import OrderedDict
+
+
+class TLSSessionCache(object):
+    """
+    TLS sessions by device address (ip:port of the connection). One instance can be shared by many transports, they
+    then use the same SSLContext, which resumed sessions require.
+
+    :param max_entries: sessions kept, the least recently used ones are dropped beyond that
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.handshakes = 0
+        self.resumed = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        # the devices use self-signed certificates, CommandService does not verify them either (verify=False)
+        context = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.sslsocket_class = _ResumingSocket
+        context.sessions = self
+        self.context = context
+
+    def get(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                return None
+            if session.time + session.timeout < time.time():
+                del self._sessions[key]
+                return None
+            self._sessions.move_to_end(key)
+            return session
+
+    def put(self, key, session):
+        if session is None or not (session.has_ticket or session.id):
+            return
+        with self._lock:
+            self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def _connected(self, key, ssl_sock):
+        with self._lock:
+            self.handshakes += 1
+            self.resumed += ssl_sock.session_reused
+        # TLS 1.2 sessions are complete now, TLS 1.3 tickets arrive with the first response (stored on close)
+        self.put(key, ssl_sock.session)
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'handshakes': self.handshakes, 'resumed': self.resumed}
+
+
+class _ResumingContext(ssl.SSLContext):
+    """
+    Offers the cached session of the peer on every new connection.
+    """
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        try:
+            key = '{0}:{1}'.format(*sock.getpeername()[:2])
+        except OSError:
+            key = server_hostname
+        if session is None and key is not None:
+            session = self.sessions.get(key)
+        try:
+            ssl_sock = super(_ResumingContext, self).wrap_socket(
+                sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect,
+                suppress_ragged_eofs=suppress_ragged_eofs, server_hostname=server_hostname, session=session)
+        except ssl.SSLError:
+            if session is not None:
+                self.sessions.discard(key)
+            raise
+        ssl_sock.session_key = key
+        if key is not None and do_handshake_on_connect:
+            self.sessions._connected(key, ssl_sock)
+        return ssl_sock
+
+
+class _ResumingSocket(ssl.SSLSocket):
+    session_key = None
+
+    def _real_close(self):
+        if self.session_key is not None and self._sslobj is not None:
+            try:
+                self.context.sessions.put(self.session_key, self.session)
+            except (ssl.SSLError, ValueError):
+                pass
+        super(_ResumingSocket, self)._real_close()
@@ -0,0 +1,135 @@
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Span(object):
+    """
+    Timing context of a single API call, handed to every registered hook.
+
+    The phases dict is filled in while the call progresses:
+        challenge: round trip of the 401 digest challenge (only with digest authentication)
+        headers: time from sending the request until the response headers arrived
+        body: time spent reading the response body
+
+    All durations are in seconds.
+    """
+
+    __slots__ = ('device', 'method', 'path', 'started', 'phases', 'status', 'bytes', 'error', 'tags',
+                 '_t0', '_mark')
+
+    def __init__(self, device, method, path):
+        self.device = device
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.phases = {}
+        self.status = None
+        self.bytes = 0
+        self.error = None
+        self.tags = {}
+        self._t0 = self._mark = time.perf_counter()
+
+    def phase(self, name):
+        """
+        Closes the current phase under the given name and starts the next one.
+        :return: duration of the closed phase in seconds
+        """
+        now = time.perf_counter()
+        duration = now - self._mark
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+        self._mark = now
+        return duration
+
+    @property
+    def duration(self):
+        return self._mark - self._t0
+
+    def as_dict(self):
+        data = {
+            'device': self.device,
+            'method': self.method,
+            'path': self.path,
+            'started': self.started,
+            'duration': round(self.duration, 6),
+            'phases': dict((k, round(v, 6)) for k, v in self.phases.items()),
+            'status': self.status,
+            'bytes': self.bytes
+        }
+        if self.error is not None:
+            data['error'] = self.error
+        if self.tags:
+            data['tags'] = self.tags
+        return data
+
+
+class TraceHook(object):
+    """
+    Base class for hooks registered with CommandService.add_hook(). Override the callbacks you need,
+    the default implementations do nothing.
+
+    Hooks are called synchronously in the thread issuing the API call, keep them cheap.
+    """
+
+    def before_request(self, span):
+        pass
+
+    def after_headers(self, span):
+        pass
+
+    def after_body(self, span):
+        pass
+
+    def on_error(self, span, error):
+        pass
+
+
+class JsonLinesTraceWriter(TraceHook):
+    """
+    Writes one JSON object per finished (or failed) API call to a file or file-like object.
+
+    Example:
+        ip_cam.commands.add_hook(JsonLinesTraceWriter('/var/log/2n-trace.jsonl'))
+
+    :param target: file path (opened in append mode) or a writable text stream
+    :param min_duration: only calls taking at least this many seconds are written
+    """
+
+    def __init__(self, target, min_duration=0.0):
+        if isinstance(target, str):
+            self.stream = open(target, 'a', buffering=1)
+            self._owned = True
+        else:
+            self.stream = target
+            self._owned = False
+        self.min_duration = min_duration
+        self._lock = threading.Lock()
+
+    def after_body(self, span):
+        self._write(span)
+
+    def on_error(self, span, error):
+        self._write(span)
+
+    def _write(self, span):
+        if span.duration < self.min_duration:
+            return
+        line = json.dumps(span.as_dict(), separators=(',', ':'))
+        with self._lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def close(self):
+        if self._owned:
+            self.stream.close()
+
+
+def dispatch(hooks, name, span, *args):
+    for hook in hooks:
+        try:
+            getattr(hook, name)(span, *args)
+        except Exception as err:
+            log.warning("Trace hook {hook}.{name} failed: {err}".format(hook=type(hook).__name__, name=name, err=err))
@@ -0,0 +1,55 @@
+"""
+Transports for CommandService (see IPCam(transport=...)).
+
+By default every CommandService call goes through the requests module, i.e. a new TCP (and TLS) connection per
+call. PooledTransport keeps connections alive and reuses them, which removes the connection setup from the latency
+of every call after the first one.
+
+With ssl=True every new connection still costs a full TLS handshake. A tlscache.TLSSessionCache lets the devices
+resume the previous TLS session instead, which is much cheaper for their weak CPUs.
+
+httptransport.HTTPClientTransport is a lighter alternative built on the standard library only.
+
+Example:
+    pool = PooledTransport(hosts=500)
+    ip_cams = [IPCam(ip, auth_type=2, user='admin', password='secret', transport=pool) for ip in addresses]
+
+    tls_pool = PooledTransport(hosts=500, tls_sessions=TLSSessionCache())
+    ip_cams = [IPCam(ip, ssl=True, auth_type=2, user='admin', password='secret', transport=tls_pool)
+               for ip in addresses]
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class _SessionAdapter(HTTPAdapter):
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(_SessionAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        super(_SessionAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class PooledTransport(requests.Session):
+    """
+    requests.Session with keep-alive connection pools. One instance can be shared by many devices.
+
+    :param hosts: number of devices whose connection pools are kept
+    :param pool_size: connections kept per device
+    :param retries: retries of failed connection attempts (never of requests that reached the device)
+    :param tls_sessions: TLSSessionCache to resume TLS sessions of https connections with
+    """
+
+    def __init__(self, hosts=64, pool_size=4, retries=0, tls_sessions=None):
+        super(PooledTransport, self).__init__()
+        adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size, max_retries=retries)
+        self.mount('http://', adapter)
+        if tls_sessions is not None:
+            adapter = _SessionAdapter(tls_sessions.context, pool_connections=hosts, pool_maxsize=pool_size,
+                                      max_retries=retries)
+        self.mount('https://', adapter)
+        self.tls_sessions = tls_sessions
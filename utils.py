@@ -3,6 +3,10 @@ import socket
 import struct
 import fcntl
 
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+
+
 def get_lan_ip():
     try:
         ip = socket.gethostbyname(socket.gethostname())
@@ -19,15 +23,32 @@ def get_lan_ip():
     return ip
 
 def get_interface_ip(ifname):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', ifname[:15].encode('utf-8')))[20:24])
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        return _ioctl_ipv4(s, SIOCGIFADDR, ifname)
+
+def get_interfaces():
+    """
+    Lists the IPv4 addresses of all local network interfaces without DNS lookups.
+    :return: list of (interface name, ip, netmask) tuples, interfaces without an IPv4 address are skipped
+    """
+    interfaces = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, ifname in socket.if_nameindex():
+            try:
+                interfaces.append((ifname, _ioctl_ipv4(s, SIOCGIFADDR, ifname), _ioctl_ipv4(s, SIOCGIFNETMASK, ifname)))
+            except IOError:
+                pass
+    return interfaces
+
+def _ioctl_ipv4(s, request, ifname):
+    return socket.inet_ntoa(fcntl.ioctl(s.fileno(), request, struct.pack('256s', ifname[:15].encode('utf-8')))[20:24])
 
 def get_lan_ip_fallback():
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        s.connect(('<broadcast>', 0))
-        return s.getsockname()[0]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            s.connect(('<broadcast>', 0))
+            return s.getsockname()[0]
     except Exception as err:
         print(err)
         return None
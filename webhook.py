@@ -0,0 +1,213 @@
+"""
+Batched outbound delivery of events to an HTTP endpoint.
+
+WebhookSink is an event sink (see events.EventListener) which only queues the events, so a slow or unavailable
+receiver never stalls the log_pull loop. A delivery thread groups the queued events into batches (up to batch_size
+events, or whatever has arrived once the oldest event waited linger seconds) and POSTs them as
+{"events": [{"device": ..., <event>}, ...]} over a keep-alive connection pool with at most `concurrency` requests in
+flight. Failed batches are retried with exponential backoff.
+
+When more than max_pending events are waiting in memory, or a batch still fails after its retries, events go to a
+disk-backed spill queue (spill.SpillQueue) instead, and are delivered from there in order once the receiver accepts
+batches again. With a spill directory nothing is dropped; without one the oldest events beyond max_pending are.
+Batches are delivered concurrently, so their order at the receiver is only guaranteed with concurrency=1.
+
+Example:
+    hook = WebhookSink('http://audit.local/api/intercom-events', spill='/var/lib/2n/spill/audit')
+    listener.add_sink(hook)
+    ...
+    print(hook.stats())
+    hook.close()
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class WebhookSink(object):
+    """
+    :param url: receiving endpoint, one WebhookSink per destination
+    :param batch_size: maximum events per POST
+    :param linger: seconds the oldest queued event may wait for a batch to fill up
+    :param concurrency: maximum POSTs in flight
+    :param retries: retries of a failed batch before it is spilled
+    :param backoff: first retry delay in seconds, doubled for every further retry (with jitter)
+    :param max_pending: events kept in memory before spilling
+    :param spill: spill queue directory (None: drop the oldest events beyond max_pending)
+    :param headers: additional request headers, e.g. an Authorization token
+    :param timeout: request timeout in seconds
+    :param session: requests.Session to use, a PooledTransport by default
+    """
+
+    def __init__(self, url, batch_size=500, linger=0.2, concurrency=4, retries=3, backoff=0.5, max_pending=50000,
+                 spill=None, headers=None, timeout=10, session=None):
+        from spill import SpillQueue
+        from transport import PooledTransport
+
+        self.url = url
+        self.batch_size = batch_size
+        self.linger = linger
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_pending = max_pending
+        self.headers = dict({'Content-Type': 'application/json'}, **(headers or {}))
+        self.timeout = timeout
+        self.session = session or PooledTransport(hosts=1, pool_size=concurrency)
+        self.spill = SpillQueue(spill) if spill is not None else None
+        self.delivered = 0
+        self.failed_requests = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._queue = deque()  # (enqueue time, event with device)
+        self._spilling = self.spill is not None and len(self.spill) > 0
+        self._in_flight = 0
+        self._replaying = False
+        self._blocked_until = 0.0
+        self._failures = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='2n-webhook')
+        self._thread = threading.Thread(target=self._run, name='2n-webhook', daemon=True)
+        self._thread.start()
+
+    # --- intake ---
+
+    def __call__(self, ip_cam, events):
+        """
+        Event sink interface, never blocks on the receiver.
+        """
+        device = ip_cam.ip_address
+        items = [dict(event, device=device) for event in events]
+        with self._cond:
+            if self._spilling:
+                # older events are on disk, queueing in memory would overtake them
+                self.spill.append(items)
+                self.spilled += len(items)
+                return
+            now = time.monotonic()
+            self._queue.extend((now, item) for item in items)
+            overflow = len(self._queue) - self.max_pending
+            if overflow > 0:
+                if self.spill is not None:
+                    self._spill_queue()
+                else:
+                    for _ in range(overflow):
+                        self._queue.popleft()
+                    self.dropped += overflow
+                    log.warning("{url}: receiver lagging, dropped {n} events".format(url=self.url, n=overflow))
+            self._cond.notify()
+
+    def _spill_queue(self):
+        while self._queue:
+            batch = [self._queue.popleft()[1] for _ in range(min(self.batch_size, len(self._queue)))]
+            self.spill.append(batch)
+            self.spilled += len(batch)
+        self._spilling = True
+        log.warning("{url}: receiver lagging, spilling events to disk".format(url=self.url))
+
+    # --- delivery ---
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._queue:
+                        return
+                    now = time.monotonic()
+                    wait = None
+                    if self._in_flight < self.concurrency and now >= self._blocked_until:
+                        if self._queue:
+                            age = now - self._queue[0][0]
+                            if len(self._queue) >= self.batch_size or age >= self.linger or self._closed:
+                                batch = [self._queue.popleft()[1]
+                                         for _ in range(min(self.batch_size, len(self._queue)))]
+                                self._in_flight += 1
+                                self._executor.submit(self._deliver, batch, False)
+                                continue
+                            wait = self.linger - age
+                        elif self._spilling and not self._replaying:
+                            records = self.spill.peek_many(self.batch_size)
+                            if not records:
+                                self._spilling = False  # drained, back to the memory queue
+                                continue
+                            batch = [item for record in records for item in record]
+                            self._replaying = True
+                            self._in_flight += 1
+                            self._executor.submit(self._deliver, batch, True)
+                            continue
+                    elif now < self._blocked_until:
+                        wait = self._blocked_until - now
+                    self._cond.wait(wait if wait is None else max(wait, 0.001))
+
+    def _deliver(self, batch, replay):
+        payload = json.dumps({'events': batch}, separators=(',', ':'))
+        delay = self.backoff
+        attempts = 1 if replay else self.retries + 1
+        ok = False
+        for attempt in range(attempts):
+            try:
+                response = self.session.post(self.url, data=payload, headers=self.headers, timeout=self.timeout)
+                response.raise_for_status()
+                ok = True
+                break
+            except Exception as err:
+                self.failed_requests += 1
+                log.warning("{url}: delivery of {n} events failed: {err}".format(url=self.url, n=len(batch), err=err))
+                if attempt + 1 < attempts:
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+                    delay *= 2
+
+        with self._cond:
+            self._in_flight -= 1
+            if ok:
+                self.delivered += len(batch)
+                self._blocked_until = 0.0
+                self._failures = 0
+                if replay:
+                    self.spill.commit()
+            else:
+                # the receiver is down, pause delivery before the next attempt, longer the longer it stays down
+                self._failures += 1
+                self._blocked_until = time.monotonic() + min(60.0, delay * 2 ** min(self._failures, 10))
+                if not replay:
+                    if self.spill is not None:
+                        self.spill.append(batch)
+                        self.spilled += len(batch)
+                        self._spill_queue()
+                    else:
+                        self._queue.extendleft((time.monotonic(), item) for item in reversed(batch))
+            if replay:
+                self._replaying = False
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'delivered': self.delivered, 'pending': len(self._queue), 'in_flight': self._in_flight,
+                    'spilled': self.spilled, 'spill_bytes': len(self.spill) if self.spill is not None else 0,
+                    'failed_requests': self.failed_requests, 'dropped': self.dropped}
+
+    def close(self, timeout=30):
+        """
+        Delivers what is queued in memory (up to timeout seconds), spills the rest if a spill queue is configured.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            while (self._queue or self._in_flight) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            if self._queue and self.spill is not None:
+                self._spill_queue()
+            self._queue.clear()
+        self._thread.join(max(0.0, deadline - time.monotonic()))
+        self._executor.shutdown(wait=True)
+        if self.spill is not None:
+            self.spill.close()